@@ -15,6 +15,8 @@ The spectrum is produced in three flavours:
     - Using the mode   to subtract the baseline without calibrating.
     - Using the mode   to subtract the baseline and     calibrating.
     - Using the median to subtract the baseline and     calibrating.
+All of them are filled in a single pass over each event. A subset
+of them can be selected with the `spectra` parameter.
 The tasks performed are:
     - Subtract the baseline   (with different algorithms).
     - Calibrate the waveforms (not in the first case).
@@ -22,7 +24,6 @@ The tasks performed are:
     - Integrate slices.
     - Histogram the result.
 """
-from operator  import add
 from functools import partial
 
 import numpy  as np
@@ -43,27 +44,26 @@ from .  components import WfType
 from .  components import print_every
 from .  components import sensor_data
 from .  components import wf_from_files
-from .  components import waveform_binner
+
+
+SPECTRA = "adc", "mode", "median"
 
 
 @city
 def berenice(files_in, file_out, compression, event_range, print_mod,
-             detector_db, run_number, min_bin, max_bin, bin_width):
+             detector_db, run_number, min_bin, max_bin, bin_width,
+             spectra = SPECTRA):
+    for spectrum in spectra:
+        if spectrum not in SPECTRA:
+            raise ValueError(f"Unrecognized spectrum: {spectrum}. Valid options: {SPECTRA}")
+
     bin_edges   = np.arange(min_bin, max_bin, bin_width)
     bin_centres = shift_to_bin_centers(bin_edges)
     nsipm       = sensor_data(files_in[0], WfType.rwf).NSIPM
     shape       = nsipm, len(bin_centres)
 
-    subtract_mode         = fl.map(csf.subtract_mode            )
-    calibrate_with_mode   = fl.map(mode_calibrator  (detector_db, run_number))
-    calibrate_with_median = fl.map(median_calibrator(detector_db, run_number))
-
-    bin_waveforms         = fl.map(waveform_binner  (bin_edges ))
-    sum_histograms        = fl.reduce(add, np.zeros(shape, dtype=np.int))
-
-    accumulate_adc        = sum_histograms()
-    accumulate_mode       = sum_histograms()
-    accumulate_median     = sum_histograms()
+    accumulate_spectra = fl.reduce(spectra_accumulator(detector_db, run_number, bin_edges, spectra),
+                                   {spectrum: np.zeros(shape, dtype=np.int64) for spectrum in spectra})()
 
     event_count = fl.spy_count()
 
@@ -82,34 +82,38 @@ def berenice(files_in, file_out, compression, event_range, print_mod,
             pipe   = fl.pipe(fl.slice(*event_range, close_all=True),
                              event_count.spy,
                              print_every(print_mod),
-                             fl.fork(("sipm", subtract_mode        , bin_waveforms, accumulate_adc     .sink),
-                                     ("sipm", calibrate_with_mode  , bin_waveforms, accumulate_mode    .sink),
-                                     ("sipm", calibrate_with_median, bin_waveforms, accumulate_median  .sink),
-                                                                                    write_run_and_event      )),
-
-            result = dict(events_in   = event_count      .future,
-                          adc         = accumulate_adc   .future,
-                          mode        = accumulate_mode  .future,
-                          median      = accumulate_median.future,
-                          event_count =       event_count.future))
-
-        write_hist(table_name = "adc"   )(out.adc   )
-        write_hist(table_name = "mode"  )(out.mode  )
-        write_hist(table_name = "median")(out.median)
+                             fl.fork(("sipm", accumulate_spectra.sink),
+                                              write_run_and_event     )),
+
+            result = dict(events_in   =        event_count.future,
+                          spectra     = accumulate_spectra.future,
+                          event_count =        event_count.future))
+
+        for spectrum in spectra:
+            write_hist(table_name = spectrum)(out.spectra[spectrum])
         cf.copy_sensor_table(files_in[0], h5out)
 
     return out
 
 
-def mode_calibrator(detector_db, run_number):
+def spectra_accumulator(detector_db, run_number, bins, spectra):
+    """
+    Update function for `fl.reduce` which adds, in place, the
+    spectra of the SiPM waveforms of an event to the accumulated
+    ones, a dict with the histograms of each spectrum:
+        - adc   : baseline (mode) subtracted.
+        - mode  : baseline (mode) subtracted and calibrated.
+        - median: baseline (median) subtracted and calibrated.
+    Both baselines are computed in a single pass and the spectra
+    are filled from the raw waveforms, which are subtracted and
+    calibrated on the fly.
+    """
     adc_to_pes = load_db.DataSiPM(detector_db, run_number).adc_to_pes.values
-    def calibrate_with_mode(wfs):
-        return csf.sipm_subtract_mode_and_calibrate(wfs, adc_to_pes)
-    return calibrate_with_mode
 
-
-def median_calibrator(detector_db, run_number):
-    adc_to_pes = load_db.DataSiPM(detector_db, run_number).adc_to_pes.values
-    def calibrate_with_median(wfs):
-        return csf.sipm_subtract_median_and_calibrate(wfs, adc_to_pes)
-    return calibrate_with_median
+    def accumulate_spectra(histograms, wfs):
+        modes, medians = csf.modes_and_medians(wfs)
+        if "adc"    in spectra: cf.accumulate_histograms(histograms["adc"   ], wfs, bins, modes            )
+        if "mode"   in spectra: cf.accumulate_histograms(histograms["mode"  ], wfs, bins, modes  , adc_to_pes)
+        if "median" in spectra: cf.accumulate_histograms(histograms["median"], wfs, bins, medians, adc_to_pes)
+        return histograms
+    return accumulate_spectra
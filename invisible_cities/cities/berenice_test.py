@@ -9,6 +9,8 @@ from .. core.configure     import       all as all_events
 from .. core.testing_utils import assert_array_equal
 from .. core.testing_utils import assert_tables_equality
 
+from pytest import raises
+
 
 def test_berenice_sipmdarkcurrent(config_tmpdir, ICDATADIR):
     PATH_IN   = os.path.join(ICDATADIR    , 'sipmdarkcurrentdata.h5' )
@@ -63,3 +65,18 @@ def test_berenice_exact_result(ICDATADIR, output_tmpdir):
                 got      = getattr(     output_file.root, table)
                 expected = getattr(true_output_file.root, table)
                 assert_tables_equality(got, expected)
+
+
+def test_berenice_raises_ValueError_with_invalid_spectrum(ICDATADIR, output_tmpdir):
+    file_in  = os.path.join(ICDATADIR    ,   "sipmdarkcurrentdata.h5")
+    file_out = os.path.join(output_tmpdir, "berenice_bad_spectrum.h5")
+
+    conf = configure("berenice invisible_cities/config/berenice.conf".split())
+    conf.update(dict(run_number  = 4821,
+                     files_in    = file_in,
+                     file_out    = file_out,
+                     spectra     = ("adc", "mean"),
+                     event_range = all_events))
+
+    with raises(ValueError):
+        berenice(**conf)
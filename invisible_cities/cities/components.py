@@ -4,6 +4,7 @@ from collections import Sequence
 from argparse    import Namespace
 from glob        import glob
 from os.path     import expandvars
+from os.path     import basename
 from itertools   import count
 from itertools   import repeat
 from enum        import Enum
@@ -37,6 +38,9 @@ from .. core   .exceptions        import InvalidInputFileStructure
 from .. core   .configure         import                EventRange
 from .. core   .configure         import          event_range_help
 from .. core   .random_sampling   import              NoiseSampler
+from .. core   .random_sampling   import         default_cache_dir
+from .. core   .random_sampling   import           event_generator
+from .. core   .buffers           import                get_buffer
 from .. reco                      import           calib_functions as  cf
 from .. reco                      import          sensor_functions as  sf
 from .. reco                      import   calib_sensors_functions as csf
@@ -44,13 +48,16 @@ from .. reco                      import            peak_functions as pkf
 from .. reco                      import           pmaps_functions as pmf
 from .. reco                      import            hits_functions as hif
 from .. reco                      import             wfm_functions as wfm
+from .. reco                      import             dst_functions as dstf
 from .. reco   .xy_algorithms     import                    corona
 from .. filters.s1s2_filter       import               S12Selector
 from .. filters.s1s2_filter       import               pmap_filter
+from .. filters.s1s2_filter       import              pmaps_filter
 from .. database                  import                   load_db
 from .. sierpe                    import                       blr
 from .. io                        import                 mcinfo_io
-from .. io     .pmaps_io          import                load_pmaps
+from .. io     .pmaps_io          import           pmaps_in_chunks
+from .. io     .pmaps_io          import        DEFAULT_CHUNK_SIZE as DEFAULT_PMAP_CHUNK_SIZE
 from .. io     .hits_io           import              hits_from_df
 from .. io     .dst_io            import                  load_dst
 from .. io     .event_filter_io   import       event_filter_writer
@@ -206,18 +213,30 @@ def copy_mc_info(files_in     : List[str],
 
 
 # TODO: consider caching database
-def deconv_pmt(dbfile, run_number, n_baseline, selection=None):
+def deconv_pmt(dbfile, run_number, n_baseline, selection=None, *,
+               dtype=np.float64, arena=None, n_threads=1):
+    """
+    If a `BufferArena` is given as `arena`, the output is written
+    into its buffer "cwf", which is overwritten for each event.
+    The PMTs are deconvolved in `n_threads` threads.
+    """
     DataPMT    = load_db.DataPMT(dbfile, run_number = run_number)
     pmt_active = np.nonzero(DataPMT.Active.values)[0].tolist() if selection is None else selection
     coeff_c    = DataPMT.coeff_c  .values.astype(np.double)
     coeff_blr  = DataPMT.coeff_blr.values.astype(np.double)
+    filter_c   = blr.filter_coefficients(coeff_c)
 
     def deconv_pmt(RWF):
+        shape = RWF.shape[:-2] + (len(pmt_active), RWF.shape[-1])
         return blr.deconv_pmt(RWF,
                               coeff_c,
                               coeff_blr,
-                              pmt_active = pmt_active,
-                              n_baseline = n_baseline)
+                              pmt_active    = pmt_active,
+                              n_baseline    = n_baseline,
+                              filter_coeffs = filter_c,
+                              n_threads     = n_threads,
+                              dtype         = dtype,
+                              out           = get_buffer(arena, "cwf", shape, dtype))
     return deconv_pmt
 
 
@@ -308,30 +327,29 @@ def wf_from_files(paths, wf_type):
 
                 yield dict(pmt=pmt, sipm=sipm, run_number=run_number,
                            event_number=event_number, timestamp=timestamp,
-                           trigger_type=trtype, trigger_channels=trchann)
+                           trigger_type=trtype, trigger_channels=trchann,
+                           file_name=path)
 
 
-def pmap_from_files(paths):
+def pmap_from_files(paths, chunk_size=DEFAULT_PMAP_CHUNK_SIZE):
+    """Reader of the files, yields one PMap at a time, run_number,
+    event_number and timestamp. The pmap tables are read in chunks
+    of whole events of at most `chunk_size` rows."""
     for path in paths:
-        try:
-            pmaps = load_pmaps(path)
-        except tb.exceptions.NoSuchNodeError:
-            continue
-
         with tb.open_file(path, "r") as h5in:
             try:
                 run_number  = get_run_number(h5in)
                 event_info  = get_event_info(h5in)
+                event_info  = event_info.read()
+                pmaps       = pmaps_in_chunks(h5in, event_info["evt_number"],
+                                              chunk_size)
             except tb.exceptions.NoSuchNodeError:
                 continue
             except IndexError:
                 continue
 
-            check_lengths(event_info, pmaps)
-
-            for evtinfo in event_info:
-                event_number, timestamp = evtinfo.fetch_all_fields()
-                yield dict(pmap=pmaps[event_number], run_number=run_number,
+            for (event_number, timestamp), pmap in zip(event_info, pmaps):
+                yield dict(pmap=pmap, run_number=run_number,
                            event_number=event_number, timestamp=timestamp)
 
 
@@ -465,28 +483,84 @@ def build_pmap(detector_db, run_number, pmt_samp_wid, sipm_samp_wid,
     return build_pmap
 
 
-def calibrate_pmts(dbfile, run_number, n_MAU, thr_MAU):
+def calibrate_pmts(dbfile, run_number, n_MAU, thr_MAU, *, dtype=np.float64, arena=None):
+    """
+    If a `BufferArena` is given as `arena`, the outputs are written
+    into its buffers "ccwfs", "ccwfs_mau", "cwf_sum" and
+    "cwf_sum_mau", which are overwritten for each event. The
+    cumulative sums of the MAU are kept in its buffer "mau_cumsum".
+    """
     DataPMT    = load_db.DataPMT(dbfile, run_number = run_number)
     adc_to_pes = np.abs(DataPMT.adc_to_pes.values)
     adc_to_pes = adc_to_pes[adc_to_pes > 0]
 
     def calibrate_pmts(cwf):# -> CCwfs:
+        out = (get_buffer(arena, "ccwfs"      , cwf.shape   , dtype),
+               get_buffer(arena, "ccwfs_mau"  , cwf.shape   , dtype),
+               get_buffer(arena, "cwf_sum"    , cwf.shape[1], dtype),
+               get_buffer(arena, "cwf_sum_mau", cwf.shape[1], dtype))
         return csf.calibrate_pmts(cwf,
                                   adc_to_pes = adc_to_pes,
                                   n_MAU      = n_MAU,
-                                  thr_MAU    = thr_MAU)
+                                  thr_MAU    = thr_MAU,
+                                  out        = out,
+                                  dtype      = dtype,
+                                  scratch    = get_buffer(arena, "mau_cumsum",
+                                                          cwf.shape[1], np.float64))
     return calibrate_pmts
 
 
-def calibrate_sipms(dbfile, run_number, thr_sipm):
+def calibrate_sipms(dbfile, run_number, thr_sipm, *, sparse=False, dtype=np.float64, arena=None):
+    """
+    If `sparse` is True, the calibrated waveforms are returned as a
+    `SparseWfs` with the samples above threshold only. Otherwise,
+    if a `BufferArena` is given as `arena`, they are written into
+    its buffer "calibrated_sipms", which is overwritten for each
+    event.
+    """
     DataSiPM   = load_db.DataSiPM(dbfile, run_number)
     adc_to_pes = np.abs(DataSiPM.adc_to_pes.values)
 
     def calibrate_sipms(rwf):
+        out = None if sparse else get_buffer(arena, "calibrated_sipms", rwf.shape, dtype)
+        return csf.calibrate_sipms(rwf,
+                                   adc_to_pes = adc_to_pes,
+                                   thr        = thr_sipm,
+                                   bls_mode   = csf.BlsMode.mode,
+                                   sparse     = sparse,
+                                   dtype      = dtype,
+                                   out        = out)
+
+    return calibrate_sipms
+
+
+def calibrate_sipms_in_s2(dbfile, run_number, thr_sipm,
+                          s2_lmax, s2_lmin, s2_stride, s2_tmax, s2_tmin,
+                          pmt_samp_wid, sipm_samp_wid, *, sparse=False, dtype=np.float64,
+                          arena=None):
+    """
+    Same as `calibrate_sipms`, but only the SiPM samples within the
+    S2 peaks found in the S2 indices of the PMT sum are calibrated.
+    The rest are zero. These are the only ones used in the pmaps.
+    """
+    DataSiPM   = load_db.DataSiPM(dbfile, run_number)
+    adc_to_pes = np.abs(DataSiPM.adc_to_pes.values)
+    s2_time    = minmax(min = s2_tmin, max = s2_tmax)
+    s2_length  = minmax(min = s2_lmin, max = s2_lmax)
+
+    def calibrate_sipms(rwf, s2_indices):
+        windows = pkf.sipm_windows(s2_indices, s2_time, s2_length, s2_stride,
+                                   pmt_samp_wid  = pmt_samp_wid,
+                                   sipm_samp_wid = sipm_samp_wid)
+        out     = None if sparse else get_buffer(arena, "calibrated_sipms", rwf.shape, dtype)
         return csf.calibrate_sipms(rwf,
                                    adc_to_pes = adc_to_pes,
                                    thr        = thr_sipm,
-                                   bls_mode   = csf.BlsMode.mode)
+                                   bls_mode   = csf.BlsMode.mode,
+                                   windows    = windows,
+                                   sparse     = sparse,
+                                   dtype      = dtype,
+                                   out        = out)
 
     return calibrate_sipms
 
@@ -520,7 +594,15 @@ def compute_pe_resolution(rms, adc_to_pes):
                      where = adc_to_pes != 0          )
 
 
-def simulate_sipm_response(detector, run_number, wf_length, noise_cut, filter_padding):
+def simulate_sipm_response(detector, run_number, wf_length, noise_cut, filter_padding,
+                           *, arena=None):
+    """
+    If a `BufferArena` is given as `arena`, the zero-suppressed
+    waveforms are written into its buffer "sipm_sim", which is
+    overwritten for each event. The random numbers are drawn from the
+    generator passed with each event, if any (see
+    `random_event_generators`).
+    """
     datasipm      = load_db.DataSiPM (detector, run_number)
     baselines     = load_db.SiPMNoise(detector, run_number)[-1]
     noise_sampler = NoiseSampler(detector, run_number, wf_length, True)
@@ -530,12 +612,33 @@ def simulate_sipm_response(detector, run_number, wf_length, noise_cut, filter_pa
     single_pe_rms = datasipm.Sigma.values.astype(np.double)
     pe_resolution = compute_pe_resolution(single_pe_rms, adc_to_pes)
 
-    def simulate_sipm_response(sipmrd):
-        wfs = sf.simulate_sipm_response(sipmrd, noise_sampler, adc_to_pes, pe_resolution)
-        return wfm.noise_suppression(wfs, thresholds, filter_padding)
+    def simulate_sipm_response(sipmrd, rng=None):
+        wfs = sf.simulate_sipm_response(sipmrd, noise_sampler, adc_to_pes, pe_resolution, rng)
+        out = get_buffer(arena, "sipm_sim", wfs.shape, wfs.dtype)
+        return wfm.noise_suppression(wfs, thresholds, filter_padding, out=out)
     return simulate_sipm_response
 
 
+def random_event_generators(seed, *stages):
+    """
+    Returns a function that gives an independent random generator for
+    each of the `stages` of the simulation of an event, derived from
+    `seed`, the name of the input file and the event number. The
+    simulation of an event does not depend on the other events, so
+    the result is the same regardless of the order or the process in
+    which they are simulated. If `seed` is None, it is drawn from
+    numpy's global random state.
+    """
+    if seed is None:
+        seed = np.random.randint(0, 2**63, dtype=np.int64)
+
+    def random_event_generators(file_name, event_number):
+        file_name = basename(file_name)
+        return tuple(event_generator(seed, file_name, event_number, stage)
+                     for stage in stages)
+    return random_event_generators
+
+
 ####### Filters ########
 
 def peak_classifier(**params):
@@ -543,6 +646,15 @@ def peak_classifier(**params):
     return partial(pmap_filter, selector)
 
 
+def peak_batch_classifier(**params):
+    """
+    Batch version of `peak_classifier`, to be used with `batch_map`:
+    classifies the peaks of a sequence of pmaps at once.
+    """
+    selector = S12Selector(**params)
+    return partial(pmaps_filter, selector)
+
+
 def compute_xy_position(dbfile, run_number, **reco_params):
     # `reco_params` is the set of parameters for the corona
     # algorithm either for the full corona or for barycenter
@@ -567,7 +679,8 @@ def build_pointlike_event(dbfile, run_number, drift_v,
     sipm_ys    = datasipm.Y.values
     sipm_xys   = np.stack((sipm_xs, sipm_ys), axis=1)
 
-    sipm_noise = NoiseSampler(dbfile, run_number).signal_to_noise
+    sipm_noise = NoiseSampler(dbfile, run_number,
+                              cache_dir=default_cache_dir()).signal_to_noise
 
     def build_pointlike_event(pmap, selector_output, event_number, timestamp):
         evt = KrEvent(event_number, timestamp * 1e-3)
@@ -625,6 +738,100 @@ def build_pointlike_event(dbfile, run_number, drift_v,
     return build_pointlike_event
 
 
+DEFAULT_KR_BATCH_SIZE = 10000
+
+def kr_dst_builder(dbfile, run_number, drift_v, **reco_params):
+    """
+    Vectorized version of `build_pointlike_event`. Returns a
+    function that takes the pmaps, selector outputs, event numbers
+    and timestamps of a batch of events and returns their KrTable
+    rows. When `reco_params` select the overall barycenter (a
+    negative `lm_radius` or `new_lm_radius`), the positions of all
+    S2s are computed at once, otherwise `corona` is called on each.
+    """
+    datasipm = load_db.DataSiPM(dbfile, run_number)
+    sipm_xys = np.stack((datasipm.X.values, datasipm.Y.values), axis=1)
+
+    if reco_params.get("lm_radius", 0) < 0 or reco_params.get("new_lm_radius", 0) < 0:
+        xy_reco = partial(dstf.barycenters, sipm_xys=sipm_xys, Qthr=reco_params.get("Qthr", 0))
+    else:
+        reco    = compute_xy_position(dbfile, run_number, **reco_params)
+        xy_reco = partial(dstf.clusters_from_reco, sipm_xys=sipm_xys, reco=reco)
+
+    def build_kr_dst(pmaps, selector_outputs, event_numbers, timestamps):
+        return dstf.build_kr_dst(event_numbers, timestamps, pmaps, selector_outputs,
+                                 drift_v, xy_reco)
+    return build_kr_dst
+
+
+def batch_sink(effect, *, args, batch_size):
+    """
+    Like `sink`, but collecting the `args` of up to `batch_size`
+    items and calling `effect` once per batch, with one sequence
+    per arg. The last, incomplete, batch is flushed when the
+    pipeline is closed.
+    """
+    @fl.coroutine
+    def batch_loop():
+        batch = []
+        def flush():
+            nonlocal batch
+            full, batch = batch, []
+            if full:
+                effect(*zip(*full))
+        try:
+            while True:
+                data = yield
+                batch.append(tuple(data[arg] for arg in args))
+                if len(batch) == batch_size:
+                    flush()
+        finally:
+            flush()
+    return batch_loop()
+
+
+def batch_map(op, *, args, out, batch_size):
+    """
+    Like `map` with `args` and `out`, but collecting up to
+    `batch_size` items and calling `op` once per batch, with one
+    sequence per arg. `op` returns one sequence per name in `out`
+    (a single one if `out` is a name), with a value for each item.
+    The items are sent downstream, in order, once their batch has
+    been processed. The last, incomplete, batch is processed when
+    the pipeline is closed.
+    """
+    if isinstance(args, str):
+        args = args,
+
+    merged_output = isinstance(out, str)
+    if merged_output:
+        out = out,
+
+    def batch_loop(target):
+        batch = []
+        def flush():
+            columns = op(*zip(*([data[arg] for arg in args] for data in batch)))
+            if merged_output:
+                columns = columns,
+            for name, column in zip(out, columns):
+                for data, value in zip(batch, column):
+                    data[name] = value
+            for data in batch:
+                target.send(data)
+            batch.clear()
+
+        with fl.closing(target):
+            try:
+                while True:
+                    batch.append((yield))
+                    if len(batch) == batch_size:
+                        flush()
+            except GeneratorExit:
+                if batch:
+                    flush()
+    return fl.coroutine(batch_loop)
+
+
 def hit_builder(dbfile, run_number, drift_v, reco,
                 rebin_slices, rebin_method,
                 charge_type = SiPMCharge.raw):
@@ -633,7 +840,8 @@ def hit_builder(dbfile, run_number, drift_v, reco,
     sipm_ys  = datasipm.Y.values
     sipm_xys = np.stack((sipm_xs, sipm_ys), axis=1)
 
-    sipm_noise = NoiseSampler(dbfile, run_number).signal_to_noise
+    sipm_noise = NoiseSampler(dbfile, run_number,
+                              cache_dir=default_cache_dir()).signal_to_noise
 
     barycenter = partial(corona,
                          all_sipms      =  datasipm,
@@ -665,11 +873,13 @@ def hit_builder(dbfile, run_number, drift_v, reco,
         # In case of an exception, a hit is still created with a NN cluster.
         # (NN cluster is a cluster where the energy is an IC not number NN)
         # this allows to keep track of the energy associated to non reonstructed hits.
+        passed_s2s   = [peak for passed, peak in zip(selector_output.s2_peaks, pmap.s2s) if passed]
+        rebinned_s2s = iter(pmf.rebin_peaks(passed_s2s, rebin_slices, rebin_method))
         for peak_no, (passed, peak) in enumerate(zip(selector_output.s2_peaks,
                                                      pmap.s2s)):
             if not passed: continue
 
-            peak = pmf.rebin_peak(peak, rebin_slices, rebin_method)
+            peak = next(rebinned_s2s)
 
             xys  = sipm_xys[peak.sipms.ids]
             qs   = peak.sipm_charge_array(sipm_noise, charge_type,
@@ -707,6 +917,17 @@ def waveform_binner(bins):
     return bin_waveforms
 
 
+def histogram_accumulator(bins):
+    """
+    Update function for `fl.reduce` which adds, in place, the
+    histograms of the waveforms of an event to the accumulated
+    histograms (an int64 array with one row per sensor).
+    """
+    def accumulate_histograms(histograms, wfs):
+        return cf.accumulate_histograms(histograms, wfs, bins)
+    return accumulate_histograms
+
+
 def waveform_integrator(limits):
     def integrate_wfs(wfs):
         return cf.spaced_integrals(wfs, limits)[:, ::2]
@@ -1,4 +1,5 @@
 import os
+import itertools as it
 
 import numpy as np
 import tables as tb
@@ -11,9 +12,17 @@ from pytest import mark
 from pytest import raises
 from pytest import warns
 
-from .. core.configure  import EventRange as ER
-from .. core.exceptions import InvalidInputFileStructure
-from .. core            import system_of_units as units
+from hypothesis            import given
+from hypothesis            import settings
+from hypothesis.strategies import lists
+
+from .. core.configure        import EventRange as ER
+from .. core.exceptions       import InvalidInputFileStructure
+from .. core                  import system_of_units as units
+from .. core.testing_utils    import assert_PMap_equality
+from .. io  .pmaps_io         import pmap_writer
+from .. io  .run_and_event_io import run_and_event_writer
+from .. evm .pmaps_test       import pmaps
 
 from .  components import event_range
 from .  components import collect
@@ -24,6 +33,11 @@ from .  components import pmap_from_files
 from .  components import compute_xy_position
 from .  components import city
 from .  components import hits_and_kdst_from_files
+from .  components import batch_sink
+from .  components import batch_map
+from .  components import peak_classifier
+from .  components import peak_batch_classifier
+from .  components import random_event_generators
 
 from .. dataflow   import dataflow as fl
 
@@ -187,3 +201,115 @@ def test_copy_mc_info_repeated_event_numbers(ICDATADIR, config_tmpdir):
         copy_mc_info([file_in, file_in], h5out, [0,1,0,9])
         events_in_h5out = h5out.root.MC.extents.cols.evt_number[:]
         assert events_in_h5out.tolist() == [0,1,0,9]
+
+
+@mark.parametrize("chunk_size", (1, 100))
+def test_pmap_from_files_yields_all_pmaps_in_event_order(KrMC_pmaps_example, config_tmpdir, chunk_size):
+    _, true_pmaps  = KrMC_pmaps_example
+    file_out       = os.path.join(config_tmpdir, "pmap_from_files.h5")
+    event_numbers  = list(true_pmaps)[::-1]
+    with tb.open_file(file_out, "w") as h5out:
+        write_pmap       = pmap_writer         (h5out)
+        write_event_info = run_and_event_writer(h5out)
+        for event_number in event_numbers:
+            write_pmap      (true_pmaps[event_number], event_number)
+            write_event_info(-1, event_number, 0)
+
+    output = list(pmap_from_files([file_out], chunk_size=chunk_size))
+    assert [o["event_number"] for o in output] == event_numbers
+    for o in output:
+        assert_PMap_equality(o["pmap"], true_pmaps[o["event_number"]])
+
+
+@mark.parametrize("batch_size", (1, 3, 10, 20))
+def test_batch_sink_flushes_every_batch_and_on_close(batch_size):
+    batches = []
+    def effect(numbers, squares):
+        batches.append((numbers, squares))
+
+    source = (dict(n=n, n2=n**2) for n in range(10))
+    fl.push(source = source,
+            pipe   = batch_sink(effect, args=("n", "n2"), batch_size=batch_size))
+
+    assert all(len(numbers) == batch_size for numbers, _ in batches[:-1])
+    assert sum((numbers for numbers, _ in batches), ()) == tuple(range(10))
+    assert sum((squares for _, squares in batches), ()) == tuple(n**2 for n in range(10))
+
+
+@mark.parametrize("batch_size", (1, 3, 10, 20))
+def test_batch_map_same_as_map(batch_size):
+    calls = []
+    def op(numbers, offsets):
+        calls.append(len(numbers))
+        return [n**2 for n in numbers], [n + o for n, o in zip(numbers, offsets)]
+
+    source = lambda: (dict(n=n, o=10) for n in range(10))
+    expected, got = [], []
+    fl.push(source = source(),
+            pipe   = fl.pipe(fl.map(lambda n, o: (n**2, n + o), args=("n", "o"), out=("n2", "no")),
+                             fl.sink(expected.append)))
+    fl.push(source = source(),
+            pipe   = fl.pipe(batch_map(op, args=("n", "o"), out=("n2", "no"), batch_size=batch_size),
+                             fl.sink(got.append)))
+
+    assert got == expected
+    assert all(n == batch_size for n in calls[:-1])
+
+
+def test_batch_map_flushes_when_upstream_closes_the_pipeline():
+    got = []
+    fl.push(source = (dict(n=n) for n in it.count()),
+            pipe   = fl.pipe(fl.slice(7, close_all=True),
+                             batch_map(lambda ns: [-n for n in ns], args="n", out="m", batch_size=3),
+                             fl.sink(got.append, args="m")))
+    assert got == [0, -1, -2, -3, -4, -5, -6]
+
+
+@settings(max_examples=20)
+@given(lists(pmaps(), min_size=1, max_size=10))
+def test_peak_batch_classifier_same_as_peak_classifier(pmaps):
+    conf = dict(s1_nmin     = 1, s1_nmax     =    3,
+                s1_emin     = 0, s1_emax     =  1e4,
+                s1_wmin     = 0, s1_wmax     =  1e4,
+                s1_hmin     = 0, s1_hmax     =  1e4,
+                s1_ethr     = 0,
+                s2_nmin     = 1, s2_nmax     =    3,
+                s2_emin     = 0, s2_emax     =  1e5,
+                s2_wmin     = 0, s2_wmax     =  1e4,
+                s2_hmin     = 0, s2_hmax     =  1e4,
+                s2_ethr     = 0,
+                s2_nsipmmin = 1, s2_nsipmmax =  100)
+    pmaps    = [pmap for _, pmap in pmaps]
+    expected = [peak_classifier(**conf)(pmap) for pmap in pmaps]
+    got      = peak_batch_classifier(**conf)(pmaps)
+    assert len(got) == len(expected)
+    for got_, expected_ in zip(got, expected):
+        assert       got_.passed    ==       expected_.passed
+        assert tuple(got_.s1_peaks) == tuple(expected_.s1_peaks)
+        assert tuple(got_.s2_peaks) == tuple(expected_.s2_peaks)
+
+
+def test_random_event_generators_depend_only_on_seed_file_and_event():
+    generators = random_event_generators(123, "pmt", "sipm")
+    draw       = lambda *args: [rng.random(5) for rng in generators(*args)]
+
+    pmt , sipm = draw("/some/path/file_0.h5", 7)
+    assert np.all(pmt  != sipm)
+
+    # Same event in a different order, or with the file elsewhere
+    draw("/some/path/file_0.h5", 8)
+    again_pmt, again_sipm = draw("/another/path/file_0.h5", 7)
+    assert np.all(again_pmt  == pmt )
+    assert np.all(again_sipm == sipm)
+
+    # Same event number in another file
+    other_pmt, _ = draw("/some/path/file_1.h5", 7)
+    assert np.all(other_pmt != pmt)
+
+
+def test_random_event_generators_seed_from_global_state():
+    np.random.seed(1)
+    first  = random_event_generators(None, "pmt")("file_0.h5", 0)[0].random(5)
+    np.random.seed(1)
+    second = random_event_generators(None, "pmt")("file_0.h5", 0)[0].random(5)
+    assert np.all(first == second)
@@ -21,7 +21,22 @@ Besides, and only for PMTs:
 On top of that, the city can emulate the trigger algorithm of the
 detector. At the present time, only a S2 trigger is implemented, which
 processes the data in the same way as the detector and applies the same
-filters according to some predefined parameters.
+filters according to some predefined parameters. Only the trigger PMTs
+are simulated to emulate the trigger. The rest of the PMTs and the
+SiPMs are simulated only for the events that pass the trigger.
+Optionally, with `trigger_prescreen_margin`, the trigger PMTs are not
+simulated for the events that cannot pass it according to their charge
+before the electronics simulation. The margin is an estimate, not a
+bound: events with large fluctuations may be lost, so it is off by
+default.
+
+The random numbers of each event are drawn from generators derived from
+the random seed, the name of the input file and the event number, so
+the events can be simulated in `n_workers` processes with the same
+result. The city does not call `np.random.seed(random_seed)` and does
+not use numpy's global random state other than to draw the seed when
+`random_seed` is None: seeding the global state before running the
+city does not make the result reproducible, fixing `random_seed` does.
 """
 
 from functools import partial
@@ -30,10 +45,13 @@ from itertools import compress
 import numpy  as np
 import tables as tb
 
+from .. core.buffers            import      BufferArena
+from .. core.buffers            import       get_buffer
 from .. reco                    import    tbl_functions as tbl
 from .. reco                    import sensor_functions as sf
 from .. reco                    import   peak_functions as pkf
 from .. sierpe                  import fee              as FE
+from .. sierpe                  import blr
 from .. io.rwf_io               import           rwf_writer
 from .. io.run_and_event_io     import run_and_event_writer
 from .. io. event_filter_io     import  event_filter_writer
@@ -50,11 +68,11 @@ from .  components import print_every
 from .  components import collect
 from .  components import copy_mc_info
 from .  components import sensor_data
-from .  components import deconv_pmt
 from .  components import WfType
 from .  components import wf_from_files
 from .  components import simulate_sipm_response
 from .  components import compute_pe_resolution
+from .  components import random_event_generators
 
 
 @city
@@ -62,21 +80,47 @@ def diomira(files_in    , file_out      , compression   ,
             event_range , print_mod     , detector_db   ,
             run_number  , sipm_noise_cut, filter_padding,
             trigger_type, trigger_params = dict(),
-            s2_params = dict(), random_seed = None):
-    if random_seed is not None:
-        np.random.seed(random_seed)
-
+            s2_params = dict(), random_seed = None, n_workers = 1,
+            trigger_prescreen_margin = None):
     sd = sensor_data(files_in[0], WfType.mcrd)
 
-    simulate_pmt_response_  = fl.map(simulate_pmt_response (detector_db,
-                                                            run_number ),
-                                     args="pmt" , out= ("pmt_sim", "blr_sim"))
-    simulate_sipm_response_ = fl.map(simulate_sipm_response(detector_db   ,
-                                                            run_number    ,
-                                                            sd.SIPMWL     ,
-                                                            sipm_noise_cut,
-                                                            filter_padding),
-                                     args="sipm", out="sipm_sim"             )
+    # The waveforms are written before the next event is processed,
+    # so all events can share the same buffers
+    arena = BufferArena()
+
+    # The trigger PMTs and the rest of them are simulated separately,
+    # sharing the per-PMT seeds and the low frequency noise of the event,
+    # so they are part of the same simulated event
+    event_generators        = fl.map(random_event_generators(random_seed, "pmt", "sipm"),
+                                     args = ("file_name", "event_number"),
+                                     out  = ("pmt_rng"  , "sipm_rng"    ))
+    simulate_pmts           = simulate_pmt_response(detector_db, run_number)
+    sample_pmt_noise        = sf.pmt_noise_sampler (detector_db, run_number)
+    trigger_pmts            = trigger_pmt_ids(detector_db, run_number, trigger_type, trigger_params)
+    may_trigger_            = fl.map(trigger_prescreen(detector_db, run_number,
+                                                       trigger_type, trigger_params,
+                                                       trigger_prescreen_margin),
+                                     args="pmt", out="may_trigger")
+    simulate_trigger_pmts_  = fl.parallel_map(simulate_trigger_pmts(simulate_pmts   ,
+                                                                    sample_pmt_noise,
+                                                                    trigger_pmts    ),
+                                              args      = ("pmt", "pmt_rng", "may_trigger"),
+                                              out       = ("trigger_rwf", "trigger_blr", "pmt_noise"),
+                                              n_workers = n_workers)
+    simulate_pmt_response_  = fl.parallel_map(simulate_remaining_pmts(simulate_pmts, trigger_pmts),
+                                              args      = ("pmt", "pmt_rng", "pmt_noise",
+                                                           "trigger_rwf", "trigger_blr"),
+                                              out       = ("pmt_sim", "blr_sim"),
+                                              n_workers = n_workers)
+    simulate_sipm_response_ = fl.parallel_map(simulate_sipm_response(detector_db   ,
+                                                                     run_number    ,
+                                                                     sd.SIPMWL     ,
+                                                                     sipm_noise_cut,
+                                                                     filter_padding,
+                                                                     arena = arena),
+                                              args      = ("sipm", "sipm_rng"),
+                                              out       = "sipm_sim",
+                                              n_workers = n_workers)
     trigger_filter_         = select_trigger_filter(trigger_type  ,
                                                     trigger_params,
                                                     s2_params     )
@@ -84,8 +128,9 @@ def diomira(files_in    , file_out      , compression   ,
                                                      run_number    ,
                                                      trigger_type  ,
                                                      trigger_params,
-                                                     s2_params     ),
-                                     args="pmt_sim", out="trigger_sim"       )
+                                                     s2_params     ,
+                                                     arena = arena ),
+                                     args="trigger_rwf", out="trigger_sim"   )
     trigger_pass            = fl.map(trigger_filter_   ,
                                      args="trigger_sim",
                                      out="trigger_pass")
@@ -126,11 +171,14 @@ def diomira(files_in    , file_out      , compression   ,
                                                    close_all=True)      ,
                                           event_count_in.spy            ,
                                           print_every(print_mod)        ,
-                                          simulate_pmt_response_        ,
+                                          event_generators              ,
+                                          may_trigger_                  ,
+                                          simulate_trigger_pmts_        ,
                                           emulate_trigger_              ,
                                           trigger_pass                  ,
                                           fl.branch(write_evt_filter)   ,
                                           trigger_filter.filter         ,
+                                          simulate_pmt_response_        ,
                                           simulate_sipm_response_       ,
                                           fl.branch("event_number"     ,
                                                     evtnum_collect.sink),
@@ -155,14 +203,89 @@ def simulate_pmt_response(detector, run_number):
     single_pe_rms = datapmt.Sigma.values.astype(np.double)
     pe_resolution = compute_pe_resolution(single_pe_rms, adc_to_pes)
 
-    def simulate_pmt_response(pmtrd):
-        rwf, blr = sf.simulate_pmt_response(0, pmtrd[np.newaxis],
-                                            adc_to_pes, pe_resolution,
-                                            detector, run_number)
+    simulate      = sf.pmt_response_simulator(adc_to_pes, pe_resolution,
+                                              detector, run_number)
+
+    def simulate_pmt_response(pmtrd, rng=None, pmts=None, noise=None):
+        rwf, blr = simulate(pmtrd, rng, pmts, noise)
         return np.round(rwf).astype(np.int16), np.round(blr).astype(np.int16)
     return simulate_pmt_response
 
 
+def simulate_trigger_pmts(simulate, sample_noise, trigger_pmts):
+    """
+    Waveforms (RWF and BLR) of the trigger PMTs for the events that
+    may pass the trigger, along with the noise of the event, which is
+    sampled once for all PMTs. None otherwise.
+    """
+    def simulate_trigger_pmts(pmtrd, rng, may_trigger):
+        if not may_trigger or not len(trigger_pmts):
+            return None, None, None
+        noise    = sample_noise(pmtrd.shape, rng)
+        rwf, blr = simulate(pmtrd, pmts=trigger_pmts, noise=noise)
+        return rwf, blr, noise
+    return simulate_trigger_pmts
+
+
+def simulate_remaining_pmts(simulate, trigger_pmts):
+    """
+    Waveforms (RWF and BLR) of all PMTs, reusing those of the trigger
+    PMTs, and the noise of the event, if they have been simulated
+    already.
+    """
+    def simulate_remaining_pmts(pmtrd, rng, noise, trigger_rwf, trigger_blr):
+        if trigger_rwf is None:
+            return simulate(pmtrd, rng)
+
+        others   = np.setdiff1d(np.arange(len(pmtrd)), trigger_pmts)
+        rwf, blr = simulate(pmtrd, pmts=others, noise=noise)
+        all_rwf  = np.empty((len(pmtrd), rwf.shape[1]), dtype=rwf.dtype)
+        all_blr  = np.empty((len(pmtrd), blr.shape[1]), dtype=blr.dtype)
+        all_rwf[others], all_rwf[trigger_pmts] = rwf, trigger_rwf
+        all_blr[others], all_blr[trigger_pmts] = blr, trigger_blr
+        return all_rwf, all_blr
+    return simulate_remaining_pmts
+
+
+def trigger_pmt_ids(detector_db, run_number, trigger_type, trigger_params):
+    """
+    Positions (IC ids) of the PMTs used by the trigger.
+    """
+    if trigger_type != "S2":
+        return []
+    datapmt = load_db.DataPMT(detector_db, run_number)
+    return sf.convert_channel_id_to_IC_id(datapmt, trigger_params["tr_channels"]).tolist()
+
+
+def trigger_prescreen(detector_db, run_number, trigger_type, trigger_params, margin):
+    """
+    Returns a function that tells, from the photoelectrons of an
+    event before the electronics simulation, whether it may pass the
+    trigger. Each peak counted by the trigger needs a charge above
+    `min_charge` in one of the trigger PMTs, which is estimated as
+    the number of photoelectrons times the gain of the PMT, increased
+    by a factor 1 + `margin` to cover the fluctuations and the noise.
+    The margin is not a bound on those, so events may be rejected
+    that would have passed the trigger. All events may pass if there
+    is no trigger or `margin` is None.
+    """
+    min_charge = trigger_params.get("min_charge", 0) * trigger_params.get("data_mc_ratio", 1)
+    if trigger_type != "S2" or margin is None or min_charge <= 0:
+        def may_trigger(pmtrd):
+            return True
+        return may_trigger
+
+    IC_ids     = trigger_pmt_ids(detector_db, run_number, trigger_type, trigger_params)
+    datapmt    = load_db.DataPMT(detector_db, run_number)
+    adc_to_pes = np.abs(datapmt.adc_to_pes.values[IC_ids]).astype(np.double)
+    n_peaks    = trigger_params["min_number_channels"]
+
+    def may_trigger(pmtrd):
+        charges = np.sum(pmtrd[IC_ids], axis=1) * adc_to_pes * (1 + margin)
+        return np.sum(np.floor(charges / min_charge)) >= n_peaks
+    return may_trigger
+
+
 
 def select_trigger_filter(trigger_type, trigger_params, s2_params):
     if   trigger_type is None:
@@ -191,7 +314,8 @@ def select_trigger_filter(trigger_type, trigger_params, s2_params):
         raise ValueError(f"Invalid trigger type: {repr(trigger_type)}")
 
 
-def emulate_trigger(detector_db, run_number, trigger_type, trigger_params, s2_params):
+def emulate_trigger(detector_db, run_number, trigger_type, trigger_params, s2_params,
+                    *, arena=None):
     if   trigger_type is None:
         def do_nothing(*args, **kwargs):
             pass
@@ -200,7 +324,7 @@ def emulate_trigger(detector_db, run_number, trigger_type, trigger_params, s2_pa
         channels   = trigger_params["tr_channels"]
         min_height = trigger_params["min_height"]
         datapmt    = load_db.DataPMT(detector_db, run_number)
-        IC_ids     = sf.convert_channel_id_to_IC_id(datapmt, channels).tolist()
+        IC_ids     = trigger_pmt_ids(detector_db, run_number, trigger_type, trigger_params)
         n_baseline = s2_params.pop("n_baseline")
         s2_params  = dict(time         = minmax(min = s2_params["s2_tmin"        ],
                                                 max = s2_params["s2_tmax"        ]),
@@ -213,7 +337,16 @@ def emulate_trigger(detector_db, run_number, trigger_type, trigger_params, s2_pa
             if channel not in compress(datapmt.ChannelID, datapmt.Active.values):
                 raise ValueError("Cannot trigger on a masked PMT")
 
-        deconvolver = deconv_pmt(detector_db, run_number, n_baseline, IC_ids)
+        # The input holds only the trigger PMTs
+        coeff_c   = datapmt.coeff_c  .values.astype(np.double)[IC_ids]
+        coeff_blr = datapmt.coeff_blr.values.astype(np.double)[IC_ids]
+        filter_c  = blr.filter_coefficients(coeff_c)
+
+        def deconvolver(rwfs):
+            return blr.deconv_pmt(rwfs, coeff_c, coeff_blr,
+                                  n_baseline    = n_baseline,
+                                  filter_coeffs = filter_c,
+                                  out           = get_buffer(arena, "cwf", rwfs.shape))
 
         def get_indices(cwf):
             return pkf.indices_and_wf_above_threshold(cwf, thr=min_height)[0]
@@ -222,6 +355,9 @@ def emulate_trigger(detector_db, run_number, trigger_type, trigger_params, s2_pa
             return pkf.find_peaks(cwf, idx, Pk=S2, pmt_ids=[-1], **s2_params)
 
         def emulate_trigger(rwfs):
+            if rwfs is None:
+                # Rejected by the prescreening
+                return dict()
             cwfs = deconvolver(rwfs)
             peak_data = dict()
             for ID, cwf in zip(IC_ids, cwfs):
@@ -1,4 +1,5 @@
 import os
+import inspect
 import tables as tb
 import numpy  as np
 import pandas as pd
@@ -17,9 +18,16 @@ from .. io  .mcinfo_io     import            load_mchits_df
 from .. io  .mcinfo_io     import       load_mcparticles_df
 
 from .. core                import fit_functions as fitf
+from .. core                import system_of_units as units
 from .. core.core_functions import shift_to_bin_centers
 
-from .  diomira import diomira
+from .. dataflow            import dataflow as fl
+
+from .  diomira    import diomira
+from .  diomira    import simulate_trigger_pmts
+from .  diomira    import trigger_prescreen
+from .  diomira    import simulate_remaining_pmts
+from .  components import random_event_generators
 
 
 def test_diomira_identify_bug(ICDATADIR):
@@ -165,26 +173,17 @@ def test_diomira_read_multiple_files(ICDATADIR, output_tmpdir):
 
 
 def test_diomira_exact_result(ICDATADIR, output_tmpdir):
-    file_in     = os.path.join(ICDATADIR                                      ,
-                               "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.MCRD.h5")
     file_out    = os.path.join(output_tmpdir                                  ,
                                "exact_result_diomira.h5"                      )
     true_output = os.path.join(ICDATADIR                                      ,
                                "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.CRWF.h5")
 
-    conf = configure("diomira invisible_cities/config/diomira.conf".split())
-    conf.update(dict(run_number   = -6340,
-                     files_in     = file_in,
-                     file_out     = file_out,
-                     trigger_type = None,
-                     event_range  = all_events))
-
-    # Set a specific seed because we want the result to be
-    # repeatible. Go back to original state after running.
-    original_random_state = np.random.get_state()
-    np.random.seed(123456789)
+    # The reference is produced with this configuration, which fixes
+    # the random seed, writing to the reference file
+    conf_file = os.path.join(ICDATADIR, "config", "diomira_exact_result.conf")
+    conf      = configure(f"diomira {conf_file}".split())
+    conf.update(dict(file_out = file_out))
     diomira(**conf)
-    np.random.set_state(original_random_state)
 
     tables = ("RD/pmtrwf"      ,  "RD/pmtblr" , "RD/sipmrwf",
               "Run/events"     , "Run/runInfo",
@@ -206,6 +205,212 @@ def test_diomira_can_fix_random_seed(output_tmpdir):
     diomira(**conf)
 
 
+def test_diomira_result_does_not_depend_on_n_workers(ICDATADIR, output_tmpdir):
+    file_in  = os.path.join(ICDATADIR, "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.MCRD.h5")
+
+    file_outs = []
+    for n_workers in (1, 2):
+        file_out = os.path.join(output_tmpdir, f"diomira_{n_workers}_workers.h5")
+        conf     = configure("diomira invisible_cities/config/diomira.conf".split())
+        conf.update(dict(run_number   = -6340,
+                         files_in     = file_in,
+                         file_out     = file_out,
+                         trigger_type = None,
+                         event_range  = all_events,
+                         random_seed  = 123,
+                         n_workers    = n_workers))
+        diomira(**conf)
+        file_outs.append(file_out)
+
+    tables = "RD/pmtrwf", "RD/pmtblr", "RD/sipmrwf", "Run/events"
+    with tb.open_file(file_outs[0]) as one_worker:
+        with tb.open_file(file_outs[1]) as two_workers:
+            for table in tables:
+                got      = getattr(two_workers.root, table)
+                expected = getattr( one_worker.root, table)
+                assert_tables_equality(got, expected)
+
+
+@mark.slow
+@mark.parametrize("min_charge", (5000 * units.adc, 20000 * units.adc))
+def test_diomira_trigger_prescreen_keeps_accepted_events(ICDATADIR, output_tmpdir, min_charge):
+    file_in = os.path.join(ICDATADIR, 'electrons_40keV_z250_MCRD.h5')
+
+    file_outs = []
+    for margin in (None, 1.0):
+        file_out = os.path.join(output_tmpdir, f"diomira_prescreen_{margin}.h5")
+        conf     = configure('diomira invisible_cities/config/diomira.conf'.split())
+        conf.update(dict(files_in                 = file_in,
+                         file_out                 = file_out,
+                         event_range              = all_events,
+                         random_seed              = 123,
+                         trigger_prescreen_margin = margin))
+        conf["trigger_params"].update(dict(min_charge = min_charge,
+                                           max_charge = 1e9 * units.adc))
+        diomira(**conf)
+        file_outs.append(file_out)
+
+    tables = "Filters/trigger", "Run/events", "RD/pmtrwf", "RD/pmtblr", "RD/sipmrwf"
+    with tb.open_file(file_outs[0]) as no_prescreen:
+        with tb.open_file(file_outs[1]) as prescreen:
+            for table in tables:
+                got      = getattr(   prescreen.root, table)
+                expected = getattr(no_prescreen.root, table)
+                assert_tables_equality(got, expected)
+
+
+def test_diomira_trigger_prescreen_is_off_by_default():
+    margin    = inspect.signature(diomira).parameters["trigger_prescreen_margin"].default
+    conf      = configure('diomira invisible_cities/config/diomira.conf'.split())
+    prescreen = trigger_prescreen(conf["detector_db"] , conf["run_number"],
+                                  conf["trigger_type"], conf["trigger_params"], margin)
+    assert margin is None
+    # Not even an empty event is rejected
+    assert prescreen(np.zeros((12, 10)))
+
+
+def fake_pmt_simulation():
+    """
+    A simulation of the PMTs with the same structure as that of
+    `sensor_functions.pmt_response_simulator`: the noise of the event
+    (the seeds of each PMT and a noise shared by all of them) and the
+    waveforms of a subset of the PMTs, counting how many times the
+    noise is sampled.
+    """
+    n_calls = []
+
+    def sample_noise(shape, rng):
+        n_calls.append(1)
+        n_pmt, n_samples = shape
+        pmt_seeds        = rng.integers(0, 2**63, size=n_pmt, dtype=np.int64)
+        return pmt_seeds, rng.normal(0, 1, shape)
+
+    def simulate(pmtrd, rng=None, pmts=None, noise=None):
+        pmts               = np.arange(len(pmtrd)) if pmts is None else pmts
+        pmt_seeds, lowFreq = sample_noise(pmtrd.shape, rng) if noise is None else noise
+        gains = [np.random.default_rng(pmt_seeds[pmt]).uniform(0.5, 1.5, pmtrd.shape[1])
+                 for pmt in pmts]
+        rwf   = pmtrd[pmts] * gains + lowFreq[pmts]
+        return rwf, -rwf
+
+    return simulate, sample_noise, n_calls
+
+
+def test_simulate_remaining_pmts_reuses_trigger_pmts():
+    n_pmt, n_samples = 5, 10
+    pmtrd            = np.arange(n_pmt * n_samples).reshape(n_pmt, n_samples)
+    trigger_pmts     = [3, 1]
+    simulate, sample_noise, n_calls = fake_pmt_simulation()
+
+    trigger = simulate_trigger_pmts  (simulate, sample_noise, trigger_pmts)
+    others  = simulate_remaining_pmts(simulate,               trigger_pmts)
+
+    trigger_rwf, trigger_blr, noise = trigger(pmtrd, np.random.default_rng(1), True)
+    rwf        , blr                = others (pmtrd, None, noise, trigger_rwf, trigger_blr)
+    # The noise is sampled only once for the whole event
+    assert len(n_calls) == 1
+
+    expected_rwf, expected_blr = simulate(pmtrd, np.random.default_rng(1))
+    assert np.all(rwf == expected_rwf)
+    assert np.all(blr == expected_blr)
+
+    # Rejected by the prescreening: nothing is simulated
+    assert trigger(pmtrd, np.random.default_rng(1), False) == (None, None, None)
+    # No trigger: all PMTs are simulated at once
+    rwf, blr = simulate_remaining_pmts(simulate, [])(pmtrd, np.random.default_rng(1),
+                                                     None, None, None)
+    assert np.all(rwf == expected_rwf)
+
+
+def test_diomira_trigger_prescreen_does_not_change_accepted_events():
+    n_pmt, n_samples = 5, 20
+    trigger_pmts     = [3, 1]
+    min_charge       = 800
+    simulate, sample_noise, _ = fake_pmt_simulation()
+
+    rng    = np.random.default_rng(123)
+    pmtrds = [rng.poisson(lam, (n_pmt, n_samples)) for lam in rng.uniform(5, 30, 50)]
+
+    def prescreen(pmtrd):
+        # The gain fluctuates by less than a factor 2
+        return 2 * np.sum(pmtrd[trigger_pmts]) >= min_charge
+
+    def no_prescreen(pmtrd):
+        return True
+
+    def simulate_events(may_trigger):
+        event_generators = random_event_generators(123, "pmt")
+        trigger          = simulate_trigger_pmts  (simulate, sample_noise, trigger_pmts)
+        others           = simulate_remaining_pmts(simulate,               trigger_pmts)
+        accepted         = {}
+        for event_number, pmtrd in enumerate(pmtrds):
+            pmt_rng, = event_generators("file.h5", event_number)
+            trigger_rwf, trigger_blr, noise = trigger(pmtrd, pmt_rng, may_trigger(pmtrd))
+            if trigger_rwf is None or np.sum(trigger_rwf) < min_charge:
+                continue
+            accepted[event_number] = others(pmtrd, pmt_rng, noise, trigger_rwf, trigger_blr)
+        return accepted
+
+    expected = simulate_events(no_prescreen)
+    got      = simulate_events(   prescreen)
+    # The test is meaningful only if both cases happen
+    assert 0 < len(expected) < len(pmtrds)
+    assert not all(map(prescreen, pmtrds))
+
+    assert got.keys() == expected.keys()
+    for event_number, (rwf, blr) in got.items():
+        expected_rwf, expected_blr = expected[event_number]
+        assert np.all(rwf == expected_rwf)
+        assert np.all(blr == expected_blr)
+
+
+@mark.parametrize("n_workers", (1, 3))
+def test_diomira_pmt_stages_reproduce_events_independently(n_workers):
+    # Each event is simulated from its own random streams, so the output
+    # does not depend on the number of workers nor on the event order
+    n_pmt, n_samples = 5, 20
+    trigger_pmts     = [3, 1]
+    simulate, sample_noise, _ = fake_pmt_simulation()
+
+    rng    = np.random.default_rng(456)
+    events = [dict(file_name="file.h5", event_number=event_number,
+                   pmt=rng.poisson(10, (n_pmt, n_samples)), may_trigger=True)
+              for event_number in range(12)]
+
+    def simulate_events(events, n_workers):
+        event_generators = fl.map(random_event_generators(123, "pmt"),
+                                  args = ("file_name", "event_number"),
+                                  out  = ("pmt_rng",))
+        trigger_         = fl.parallel_map(simulate_trigger_pmts(simulate, sample_noise, trigger_pmts),
+                                           args       = ("pmt", "pmt_rng", "may_trigger"),
+                                           out        = ("trigger_rwf", "trigger_blr", "pmt_noise"),
+                                           n_workers  = n_workers,
+                                           chunk_size = 2)
+        others_          = fl.parallel_map(simulate_remaining_pmts(simulate, trigger_pmts),
+                                           args       = ("pmt", "pmt_rng", "pmt_noise",
+                                                         "trigger_rwf", "trigger_blr"),
+                                           out        = ("pmt_sim", "blr_sim"),
+                                           n_workers  = n_workers,
+                                           chunk_size = 2)
+        simulated = {}
+        def store(event_number, pmt_sim, blr_sim):
+            simulated[event_number] = pmt_sim, blr_sim
+
+        fl.push(source = (dict(event) for event in events),
+                pipe   = fl.pipe(event_generators, trigger_, others_,
+                                 fl.sink(store, args=("event_number", "pmt_sim", "blr_sim"))))
+        return simulated
+
+    expected = simulate_events(events, 1)
+    got      = simulate_events(events[::-1], n_workers)
+
+    assert got.keys() == expected.keys()
+    for event_number, (rwf, blr) in got.items():
+        expected_rwf, expected_blr = expected[event_number]
+        assert np.all(rwf == expected_rwf)
+        assert np.all(blr == expected_blr)
+
+
 ## to run the following test, use the --runslow option with pytest
 @mark.veryslow
 def test_diomira_reproduces_singlepe(ICDATADIR, output_tmpdir):
@@ -39,7 +39,7 @@ from operator import attrgetter
 import tables as tb
 
 from .. reco                import        tbl_functions as tbl
-from .. io.         kdst_io import            kr_writer
+from .. io.         kdst_io import       kr_rows_writer
 from .. io.run_and_event_io import run_and_event_writer
 from .. io. event_filter_io import  event_filter_writer
 
@@ -50,9 +50,11 @@ from .. dataflow.dataflow import pipe
 from .  components import city
 from .  components import print_every
 from .  components import pmap_from_files
-from .  components import peak_classifier
-from .  components import compute_xy_position
-from .  components import build_pointlike_event  as build_pointlike_event_
+from .  components import peak_batch_classifier
+from .  components import batch_map
+from .  components import batch_sink
+from .  components import kr_dst_builder
+from .  components import DEFAULT_KR_BATCH_SIZE
 
 
 @city
@@ -68,17 +70,16 @@ def dorothea(files_in, file_out, compression, event_range, print_mod, detector_d
     #                          new_lm_radius of new_local_maximum
     # msipm         =  1       minimum number of SiPMs in a Cluster
 
-    classify_peaks        = fl.map(peak_classifier(**locals()),
-                                   args = "pmap",
-                                   out  = "selector_output")
+    # The peaks are classified, and the Kr DST is built, in batches
+    classify_peaks        = batch_map(peak_batch_classifier(**locals()),
+                                      args       = "pmap",
+                                      out        = "selector_output",
+                                      batch_size = DEFAULT_KR_BATCH_SIZE)
 
     pmap_passed           = fl.map(attrgetter("passed"), args="selector_output", out="pmap_passed")
     pmap_select           = fl.count_filter(bool, args="pmap_passed")
 
-    reco_algo             = compute_xy_position(detector_db, run_number, **global_reco_params)
-    build_pointlike_event = fl.map(build_pointlike_event_(detector_db, run_number, drift_v, reco_algo),
-                                   args = ("pmap", "selector_output", "event_number", "timestamp"),
-                                   out  = "pointlike_event"                                       )
+    build_kr_dst          = kr_dst_builder(detector_db, run_number, drift_v, **global_reco_params)
 
     event_count_in        = fl.spy_count()
     event_count_out       = fl.spy_count()
@@ -87,7 +88,10 @@ def dorothea(files_in, file_out, compression, event_range, print_mod, detector_d
 
         # Define writers...
         write_event_info      = fl.sink(run_and_event_writer(h5out                ), args=("run_number", "event_number", "timestamp"))
-        write_pointlike_event = fl.sink(           kr_writer(h5out                ), args="pointlike_event")
+        write_kr_rows         =             kr_rows_writer(h5out                )
+        write_pointlike_event = batch_sink(lambda *batch: write_kr_rows(build_kr_dst(*batch)),
+                                           args       = ("pmap", "selector_output", "event_number", "timestamp"),
+                                           batch_size = DEFAULT_KR_BATCH_SIZE)
         write_pmap_filter     = fl.sink( event_filter_writer(h5out, "s12_selector"), args=("event_number", "pmap_passed"))
 
         return push(source = pmap_from_files(files_in),
@@ -100,7 +104,6 @@ def dorothea(files_in, file_out, compression, event_range, print_mod, detector_d
                         fl.branch(write_pmap_filter)          ,
                         pmap_select          .filter          ,
                         event_count_out      .spy             ,
-                        build_pointlike_event                 ,
                         fl.fork(write_pointlike_event         ,
                                 write_event_info              )),
                     result = dict(events_in  = event_count_in .future,
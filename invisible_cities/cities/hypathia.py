@@ -14,12 +14,18 @@ without simulating the electronics. This includes:
     - Find pulses in the PMT-summed waveform.
     - Match the time window of the PMT pulse with those in the SiPMs.
     - Build the PMap object.
+
+The random numbers of each event are drawn from generators derived from
+the random seed, the name of the input file and the event number, so
+the events can be simulated in `n_workers` processes with the same
+result. The city does not call `np.random.seed(random_seed)` and does
+not use numpy's global random state other than to draw the seed when
+`random_seed` is None: seeding the global state before running the
+city does not make the result reproducible, fixing `random_seed` does.
 """
 import numpy  as np
 import tables as tb
 
-from functools import partial
-
 from .. reco                  import sensor_functions     as sf
 from .. reco                  import tbl_functions        as tbl
 from .. reco                  import peak_functions       as pkf
@@ -46,6 +52,7 @@ from .  components import get_number_of_active_pmts
 from .  components import compute_and_write_pmaps
 from .  components import simulate_sipm_response
 from .  components import calibrate_sipms
+from .  components import random_event_generators
 
 
 @city
@@ -53,7 +60,8 @@ def hypathia(files_in, file_out, compression, event_range, print_mod, detector_d
              sipm_noise_cut, filter_padding, thr_sipm, thr_sipm_type, pmt_wfs_rebin, pmt_pe_rms,
              s1_lmin, s1_lmax, s1_tmin, s1_tmax, s1_rebin_stride, s1_stride, thr_csum_s1,
              s2_lmin, s2_lmax, s2_tmin, s2_tmax, s2_rebin_stride, s2_stride, thr_csum_s2, thr_sipm_s2,
-             pmt_samp_wid=25*units.ns, sipm_samp_wid=1*units.mus):
+             pmt_samp_wid=25*units.ns, sipm_samp_wid=1*units.mus,
+             random_seed=None, n_workers=1):
     if   thr_sipm_type.lower() == "common":
         # In this case, the threshold is a value in pes
         sipm_thr = thr_sipm
@@ -70,15 +78,20 @@ def hypathia(files_in, file_out, compression, event_range, print_mod, detector_d
     #### Define data transformations
     sd = sensor_data(files_in[0], WfType.mcrd)
 
+    event_generators = fl.map(random_event_generators(random_seed, "pmt", "sipm"),
+                              args = ("file_name", "event_number"),
+                              out  = ("pmt_rng"  , "sipm_rng"    ))
+
     # Raw WaveForm to Corrected WaveForm
     mcrd_to_rwf      = fl.map(rebin_pmts(pmt_wfs_rebin),
                               args = "pmt",
                               out  = "rwf")
 
     # Add single pe fluctuation to pmts
-    simulate_pmt = fl.map(partial(sf.charge_fluctuation, single_pe_rms=pmt_pe_rms),
-                          args = "rwf",
-                          out = "ccwfs")
+    simulate_pmt = fl.parallel_map(fluctuate_pmts(pmt_pe_rms),
+                                   args      = ("rwf", "pmt_rng"),
+                                   out       = "ccwfs",
+                                   n_workers = n_workers)
 
     # Compute pmt sum
     pmt_sum          = fl.map(pmts_sum, args = 'ccwfs',
@@ -90,10 +103,12 @@ def hypathia(files_in, file_out, compression, event_range, print_mod, detector_d
                               out  = ("s1_indices", "s2_indices", "s2_energies"))
 
     # SiPMs simulation
-    simulate_sipm_response_  = fl.map(simulate_sipm_response(detector_db, run_number,
-                                                             sd.SIPMWL, sipm_noise_cut,
-                                                             filter_padding),
-                                     item="sipm")
+    simulate_sipm_response_  = fl.parallel_map(simulate_sipm_response(detector_db, run_number,
+                                                                      sd.SIPMWL, sipm_noise_cut,
+                                                                      filter_padding),
+                                               args      = ("sipm", "sipm_rng"),
+                                               out       = "sipm",
+                                               n_workers = n_workers)
 
     # Sipm calibration function expects waveform as int16
     discretize_signal = fl.map(lambda rwf: np.round(rwf).astype(np.int16),
@@ -128,6 +143,7 @@ def hypathia(files_in, file_out, compression, event_range, print_mod, detector_d
                       pipe   = pipe(fl.slice(*event_range, close_all=True),
                                     print_every(print_mod),
                                     event_count_in.spy,
+                                    event_generators,
                                     mcrd_to_rwf,
                                     simulate_pmt,
                                     pmt_sum,
@@ -163,6 +179,12 @@ def rebin_pmts(rebin_stride):
     return rebin_pmts
 
 
+def fluctuate_pmts(single_pe_rms):
+    def fluctuate_pmts(rwfs, rng):
+        return sf.charge_fluctuation(rwfs, single_pe_rms, rng)
+    return fluctuate_pmts
+
+
 def pmts_sum(rwfs):
     return rwfs.sum(axis=0)
 
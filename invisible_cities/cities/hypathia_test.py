@@ -1,7 +1,6 @@
 import os
 
 import tables as tb
-import numpy  as np
 
 from .. core.configure import configure
 from .. core.testing_utils  import assert_tables_equality
@@ -10,22 +9,15 @@ from . hypathia import hypathia
 
 
 def test_hypathia_exact_result(ICDATADIR, output_tmpdir):
-    file_in     = os.path.join(ICDATADIR    ,      "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.MCRD.h5")
     file_out    = os.path.join(output_tmpdir,                          "exact_result_hypathia.h5")
     true_output = os.path.join(ICDATADIR    , "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.hypathia.h5")
 
-    conf = configure("hypathia invisible_cities/config/hypathia.conf".split())
-    conf.update(dict(run_number   = -6340,
-                     files_in     = file_in,
-                     file_out     = file_out,
-                     event_range  = (0, 2)))
-
-    # Set a specific seed because we want the result to be
-    # repeatible. Go back to original state after running.
-    original_random_state = np.random.get_state()
-    np.random.seed(123456789)
+    # The reference is produced with this configuration, which fixes
+    # the random seed, writing to the reference file
+    conf_file = os.path.join(ICDATADIR, "config", "hypathia_exact_result.conf")
+    conf      = configure(f"hypathia {conf_file}".split())
+    conf.update(dict(file_out = file_out))
     hypathia(**conf)
-    np.random.set_state(original_random_state)
 
     tables = (  "PMAPS/S1"         ,   "PMAPS/S2"        , "PMAPS/S2Si"     ,
                 "PMAPS/S1Pmt"      ,   "PMAPS/S2Pmt"     ,
@@ -38,3 +30,28 @@ def test_hypathia_exact_result(ICDATADIR, output_tmpdir):
                 got      = getattr(     output_file.root, table)
                 expected = getattr(true_output_file.root, table)
                 assert_tables_equality(got, expected)
+
+
+def test_hypathia_result_does_not_depend_on_n_workers(ICDATADIR, output_tmpdir):
+    file_in = os.path.join(ICDATADIR, "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.MCRD.h5")
+
+    file_outs = []
+    for n_workers in (1, 2):
+        file_out = os.path.join(output_tmpdir, f"hypathia_{n_workers}_workers.h5")
+        conf     = configure("hypathia invisible_cities/config/hypathia.conf".split())
+        conf.update(dict(run_number  = -6340,
+                         files_in    = file_in,
+                         file_out    = file_out,
+                         event_range = (0, 2),
+                         random_seed = 123,
+                         n_workers   = n_workers))
+        hypathia(**conf)
+        file_outs.append(file_out)
+
+    tables = "PMAPS/S1", "PMAPS/S2", "PMAPS/S2Si", "PMAPS/S1Pmt", "PMAPS/S2Pmt"
+    with tb.open_file(file_outs[0]) as one_worker:
+        with tb.open_file(file_outs[1]) as two_workers:
+            for table in tables:
+                got      = getattr(two_workers.root, table)
+                expected = getattr( one_worker.root, table)
+                assert_tables_equality(got, expected)
@@ -16,11 +16,13 @@ This includes a number of tasks:
     - Match the time window of the PMT pulse with those in the SiPMs.
     - Build the PMap object.
 """
+import numpy  as np
 import tables as tb
 
 from .. reco                  import tbl_functions        as tbl
 from .. core.random_sampling  import NoiseSampler         as SiPMsNoiseSampler
 from .. core                  import system_of_units      as units
+from .. core.buffers          import BufferArena
 from .. io  .run_and_event_io import run_and_event_writer
 from .. io  .trigger_io       import       trigger_writer
 
@@ -36,6 +38,7 @@ from .  components import copy_mc_info
 from .  components import deconv_pmt
 from .  components import calibrate_pmts
 from .  components import calibrate_sipms
+from .  components import calibrate_sipms_in_s2
 from .  components import zero_suppress_wfs
 from .  components import WfType
 from .  components import wf_from_files
@@ -48,7 +51,8 @@ def irene(files_in, file_out, compression, event_range, print_mod, detector_db,
           n_baseline, n_mau, thr_mau, thr_sipm, thr_sipm_type,
           s1_lmin, s1_lmax, s1_tmin, s1_tmax, s1_rebin_stride, s1_stride, thr_csum_s1,
           s2_lmin, s2_lmax, s2_tmin, s2_tmax, s2_rebin_stride, s2_stride, thr_csum_s2, thr_sipm_s2,
-          pmt_samp_wid=25*units.ns, sipm_samp_wid=1*units.mus):
+          pmt_samp_wid=25*units.ns, sipm_samp_wid=1*units.mus, sipm_s2_windows=False,
+          sipm_sparse_wfs=False, precision="double", n_threads=1):
     if   thr_sipm_type.lower() == "common":
         # In this case, the threshold is a value in pes
         sipm_thr = thr_sipm
@@ -62,15 +66,30 @@ def irene(files_in, file_out, compression, event_range, print_mod, detector_db,
         raise ValueError(f"Unrecognized thr type: {thr_sipm_type}. "
                           "Only valid options are 'common' and 'individual'")
 
+    if   precision.lower() == "double": dtype = np.float64
+    elif precision.lower() == "single": dtype = np.float32
+    else:
+        raise ValueError(f"Unrecognized precision: {precision}. "
+                          "Only valid options are 'single' and 'double'")
+
     #### Define data transformations
 
+    # The peaks hold copies of the samples they are built from,
+    # so the waveforms of all events can share the same buffers.
+    arena = BufferArena()
+
     # Raw WaveForm to Corrected WaveForm
-    rwf_to_cwf       = fl.map(deconv_pmt(detector_db, run_number, n_baseline),
+    rwf_to_cwf       = fl.map(deconv_pmt(detector_db, run_number, n_baseline,
+                                         dtype     = dtype,
+                                         arena     = arena,
+                                         n_threads = n_threads),
                               args = "pmt",
                               out  = "cwf")
 
     # Corrected WaveForm to Calibrated Corrected WaveForm
-    cwf_to_ccwf      = fl.map(calibrate_pmts(detector_db, run_number, n_mau, thr_mau),
+    cwf_to_ccwf      = fl.map(calibrate_pmts(detector_db, run_number, n_mau, thr_mau,
+                                             dtype = dtype,
+                                             arena = arena),
                               args = "cwf",
                               out  = ("ccwfs", "ccwfs_mau", "cwf_sum", "cwf_sum_mau"))
 
@@ -79,9 +98,24 @@ def irene(files_in, file_out, compression, event_range, print_mod, detector_db,
                               args = ("cwf_sum", "cwf_sum_mau"),
                               out  = ("s1_indices", "s2_indices", "s2_energies"))
 
-    # Remove baseline and calibrate SiPMs
-    sipm_rwf_to_cal  = fl.map(calibrate_sipms(detector_db, run_number, sipm_thr),
-                              item = "sipm")
+    # Remove baseline and calibrate SiPMs, everywhere or only
+    # where they are used to build the S2s, optionally keeping
+    # only the samples above threshold in a sparse form
+    if sipm_s2_windows:
+        sipm_rwf_to_cal = fl.map(calibrate_sipms_in_s2(detector_db, run_number, sipm_thr,
+                                                       s2_lmax, s2_lmin, s2_stride, s2_tmax, s2_tmin,
+                                                       pmt_samp_wid, sipm_samp_wid,
+                                                       sparse = sipm_sparse_wfs,
+                                                       dtype  = dtype,
+                                                       arena  = arena),
+                                 args = ("sipm", "s2_indices"),
+                                 out  = "sipm")
+    else:
+        sipm_rwf_to_cal = fl.map(calibrate_sipms(detector_db, run_number, sipm_thr,
+                                                 sparse = sipm_sparse_wfs,
+                                                 dtype  = dtype,
+                                                 arena  = arena),
+                                 item = "sipm")
 
     event_count_in  = fl.spy_count()
     event_count_out = fl.spy_count()
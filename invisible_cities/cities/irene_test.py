@@ -342,6 +342,79 @@ def test_irene_exact_result(ICDATADIR, output_tmpdir):
                 assert_tables_equality(got, expected)
 
 
+def test_irene_sipm_s2_windows_gives_the_same_pmaps(ICDATADIR, output_tmpdir):
+    file_in   = os.path.join(ICDATADIR    , "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.RWF.h5")
+    file_outs = [os.path.join(output_tmpdir, f"irene_sipm_s2_windows_{windows}.h5")
+                 for windows in (False, True)]
+
+    for file_out, windows in zip(file_outs, (False, True)):
+        conf = configure("irene invisible_cities/config/irene.conf".split())
+        conf.update(dict(run_number      = -6340,
+                         files_in        = file_in,
+                         file_out        = file_out,
+                         event_range     = all_events,
+                         sipm_s2_windows = windows))
+        irene(**conf)
+
+    with tb.open_file(file_outs[0]) as expected_file:
+        with tb.open_file(file_outs[1]) as got_file:
+            for table in ("PMAPS/S1", "PMAPS/S2", "PMAPS/S2Si", "PMAPS/S1Pmt", "PMAPS/S2Pmt"):
+                got      = getattr(     got_file.root, table)
+                expected = getattr(expected_file.root, table)
+                assert_tables_equality(got, expected)
+
+@mark.parametrize("sipm_s2_windows", (False, True))
+def test_irene_sipm_sparse_wfs_gives_the_same_pmaps(ICDATADIR, output_tmpdir, sipm_s2_windows):
+    file_in   = os.path.join(ICDATADIR    , "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.RWF.h5")
+    file_outs = [os.path.join(output_tmpdir, f"irene_sipm_sparse_wfs_{sparse}_{sipm_s2_windows}.h5")
+                 for sparse in (False, True)]
+
+    for file_out, sparse in zip(file_outs, (False, True)):
+        conf = configure("irene invisible_cities/config/irene.conf".split())
+        conf.update(dict(run_number      = -6340,
+                         files_in        = file_in,
+                         file_out        = file_out,
+                         event_range     = all_events,
+                         sipm_s2_windows = sipm_s2_windows,
+                         sipm_sparse_wfs = sparse))
+        irene(**conf)
+
+    # The sparse SiPM waveforms are stored in single precision
+    expected = load_pmaps(file_outs[0])
+    got      = load_pmaps(file_outs[1])
+    assert sorted(got) == sorted(expected)
+    for evt in expected:
+        for got_s2, expected_s2 in zip(got[evt].s2s, expected[evt].s2s):
+            assert np.all     (got_s2.sipms.ids           == expected_s2.sipms.ids)
+            assert np.allclose(got_s2.sipms.all_waveforms, expected_s2.sipms.all_waveforms, rtol=1e-6)
+
+
+def test_irene_single_precision_close_to_double(ICDATADIR, output_tmpdir):
+    file_in   = os.path.join(ICDATADIR    , "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.RWF.h5")
+    file_outs = [os.path.join(output_tmpdir, f"irene_precision_{precision}.h5")
+                 for precision in ("double", "single")]
+
+    for file_out, precision in zip(file_outs, ("double", "single")):
+        conf = configure("irene invisible_cities/config/irene.conf".split())
+        conf.update(dict(run_number  = -6340,
+                         files_in    = file_in,
+                         file_out    = file_out,
+                         event_range = all_events,
+                         precision   = precision))
+        irene(**conf)
+
+    double = load_pmaps(file_outs[0])
+    single = load_pmaps(file_outs[1])
+    assert sorted(single) == sorted(double)
+    for evt in double:
+        assert len(single[evt].s1s) == len(double[evt].s1s)
+        assert len(single[evt].s2s) == len(double[evt].s2s)
+        for got, expected in zip(single[evt].s2s, double[evt].s2s):
+            assert np.isclose(got.total_energy, expected.total_energy, rtol=1e-4)
+            assert np.isclose(got.total_charge, expected.total_charge, rtol=1e-4)
+            assert np.isclose(got.time_at_max_energy, expected.time_at_max_energy)
+
+
 def test_irene_filters_empty_pmaps(ICDATADIR, output_tmpdir):
     file_in  = os.path.join(ICDATADIR                                     ,
                             "Kr83_nexus_v5_03_00_ACTIVE_7bar_3evts.RWF.h5")
@@ -26,6 +26,7 @@ from .. dataflow.dataflow import pipe
 from .. dataflow.dataflow import fork
 from .. dataflow.dataflow import sink
 
+from .. core.buffers        import BufferArena
 from .. reco                import tbl_functions as tbl
 from .. io.          rwf_io import           rwf_writer
 from .. io.run_and_event_io import run_and_event_writer
@@ -35,7 +36,7 @@ from .. io.run_and_event_io import run_and_event_writer
 
 @city
 def isidora(files_in, file_out, compression, event_range, print_mod,
-            detector_db, run_number, n_baseline):
+            detector_db, run_number, n_baseline, n_threads=1):
     """
     The city of ISIDORA performs a fast processing from raw data
     (pmtrwf and sipmrwf) to BLR wavefunctions.
@@ -43,7 +44,12 @@ def isidora(files_in, file_out, compression, event_range, print_mod,
     """
     sd = sensor_data(files_in[0], WfType.rwf)
 
-    rwf_to_cwf = fl.map(deconv_pmt(detector_db, run_number, n_baseline), args="pmt", out="cwf")
+    # The waveforms are written before the next event is processed,
+    # so all events can share the same buffers
+    arena      = BufferArena()
+    rwf_to_cwf = fl.map(deconv_pmt(detector_db, run_number, n_baseline,
+                                   arena=arena, n_threads=n_threads),
+                        args="pmt", out="cwf")
 
     with tb.open_file(file_out, "w", filters=tbl.filters(compression)) as h5out:
         RWF        = partial(rwf_writer, h5out, group_name='BLR')
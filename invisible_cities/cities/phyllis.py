@@ -33,7 +33,6 @@ The tasks performed are:
     - Integrate slices.
     - Histrogram the result.
 """
-from operator  import add
 from functools import partial
 
 import numpy  as np
@@ -55,7 +54,7 @@ from .  components import WfType
 from .  components import print_every
 from .  components import sensor_data
 from .  components import wf_from_files
-from .  components import waveform_binner
+from .  components import histogram_accumulator
 from .  components import deconv_pmt
 from .  components import waveform_integrator
 
@@ -90,8 +89,7 @@ def phyllis(files_in, file_out, compression, event_range, print_mod, detector_db
     processing        = fl.map(proc, args="pmt", out="cwf")
     integrate_light   = fl.map(waveform_integrator(light_limits))
     integrate_dark    = fl.map(waveform_integrator( dark_limits))
-    bin_waveforms     = fl.map(waveform_binner    (  bin_edges ))
-    sum_histograms    = fl.reduce(add, np.zeros(shape, dtype=np.int))
+    sum_histograms    = fl.reduce(histogram_accumulator(bin_edges), np.zeros(shape, dtype=np.int64))
     accumulate_light  = sum_histograms()
     accumulate_dark   = sum_histograms()
     event_count       = fl.spy_count()
@@ -111,9 +109,9 @@ def phyllis(files_in, file_out, compression, event_range, print_mod, detector_db
                              event_count.spy,
                              print_every(print_mod),
                              processing,
-                             fl.fork(("cwf", integrate_light, bin_waveforms, accumulate_light   .sink),
-                                     ("cwf", integrate_dark , bin_waveforms, accumulate_dark    .sink),
-                                                                             write_run_and_event      )),
+                             fl.fork(("cwf", integrate_light, accumulate_light   .sink),
+                                     ("cwf", integrate_dark , accumulate_dark    .sink),
+                                                              write_run_and_event      )),
 
             result = dict(events_in   = event_count     .future,
                           spe         = accumulate_light.future,
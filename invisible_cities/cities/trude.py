@@ -28,7 +28,6 @@ The tasks performed are:
     - Integrate slices.
     - Histrogram the result.
 """
-from operator  import add
 from functools import partial
 
 import numpy  as np
@@ -49,7 +48,7 @@ from .  components import WfType
 from .  components import print_every
 from .  components import sensor_data
 from .  components import wf_from_files
-from .  components import waveform_binner
+from .  components import histogram_accumulator
 from .  components import waveform_integrator
 
 
@@ -82,8 +81,7 @@ def trude(files_in, file_out, compression, event_range, print_mod,
     subtract_baseline = fl.map(csf.sipm_processing[proc_mode], args="sipm", out="bls")
     integrate_light   = fl.map(waveform_integrator(light_limits))
     integrate_dark    = fl.map(waveform_integrator( dark_limits))
-    bin_waveforms     = fl.map(waveform_binner    (  bin_edges ))
-    sum_histograms    = fl.reduce(add, np.zeros(shape, dtype=np.int))
+    sum_histograms    = fl.reduce(histogram_accumulator(bin_edges), np.zeros(shape, dtype=np.int64))
     accumulate_light  = sum_histograms()
     accumulate_dark   = sum_histograms()
     event_count       = fl.spy_count()
@@ -103,9 +101,9 @@ def trude(files_in, file_out, compression, event_range, print_mod,
                              event_count.spy,
                              print_every(print_mod),
                              subtract_baseline,
-                             fl.fork(("bls", integrate_light, bin_waveforms, accumulate_light   .sink),
-                                     ("bls", integrate_dark , bin_waveforms, accumulate_dark    .sink),
-                                                                             write_run_and_event      )),
+                             fl.fork(("bls", integrate_light, accumulate_light   .sink),
+                                     ("bls", integrate_dark , accumulate_dark    .sink),
+                                                              write_run_and_event      )),
 
             result = dict(events_in   = event_count     .future,
                           spe         = accumulate_light.future,
@@ -0,0 +1,38 @@
+import numpy as np
+
+
+class BufferArena:
+    """
+    Arrays reused from one event to the next. Each buffer is
+    identified by a name and is only reallocated when the requested
+    shape or type changes, so a stream of events of the same size is
+    processed without allocating new waveforms. The contents of a
+    buffer are overwritten when it is requested again, so they must
+    not be kept beyond the processing of the current event.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.float64):
+        shape  = tuple(np.atleast_1d(shape).tolist())
+        dtype  = np.dtype(dtype)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def __len__(self):
+        return len(self._buffers)
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+def get_buffer(arena, name, shape, dtype=np.float64):
+    """
+    Buffer `name` of `arena` or a new array if `arena` is None.
+    """
+    if arena is None:
+        return np.empty(shape, dtype=dtype)
+    return arena.get(name, shape, dtype)
@@ -0,0 +1,34 @@
+import numpy as np
+
+from . buffers       import BufferArena
+from . buffers       import get_buffer
+from . testing_utils import peak_allocated_memory
+
+
+def test_buffer_arena_reuses_buffers_of_the_same_shape_and_type():
+    arena  = BufferArena()
+    buffer = arena.get("wfs", (3, 100), np.float32)
+    assert buffer.shape == (3, 100)
+    assert buffer.dtype == np.float32
+    assert arena.get("wfs", (3, 100), np.float32) is buffer
+    assert arena.get("sum",     100 , np.float32) is not buffer
+    assert len(arena)   == 2
+    assert arena.nbytes == 4 * (300 + 100)
+
+
+def test_buffer_arena_reallocates_when_shape_or_type_change():
+    arena  = BufferArena()
+    buffer = arena.get("wfs", (3, 100))
+    assert arena.get("wfs", (3, 100), np.float32) is not buffer
+    assert arena.get("wfs", (4, 100), np.float32).shape == (4, 100)
+    assert len(arena) == 1
+
+
+def test_buffer_arena_steady_state_does_not_allocate():
+    arena = BufferArena()
+    arena.get("wfs", (12, 52000))
+    assert peak_allocated_memory(arena.get, "wfs", (12, 52000)) < 1000
+
+
+def test_get_buffer_without_arena_allocates_new_arrays():
+    assert get_buffer(None, "wfs", 10) is not get_buffer(None, "wfs", 10)
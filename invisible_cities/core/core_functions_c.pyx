@@ -1,30 +1,320 @@
-
+# distutils: extra_compile_args = -fopenmp
+# distutils: extra_link_args    = -fopenmp
+"""
+Compiled kernels for the waveform primitives used across the
+package. The per-sensor kernels release the GIL and process the
+sensors (rows) in parallel with `n_threads` threads.
+"""
+cimport cython
 cimport numpy as np
 import  numpy as np
 
-from cpython cimport bool
+from cpython         cimport bool
+from cython.parallel cimport prange
+
+
+ctypedef fused float_t:
+    np.float32_t
+    np.float64_t
 
+ctypedef fused sample_t:
+    np.int16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
 
-cpdef rebin_array(double [:] arr, int stride, bool mean=False, bool remainder=False):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef rebin_array(const double [:] arr, int stride, bool mean=False, bool remainder=False):
     """
     rebin arr by a factor stride, using method (ex: np.sum or np.mean), keep the remainder in the
     last bin or not
     """
-    cdef int lenb = len(arr) // stride
-    cdef double [:] rebinned
+    cdef Py_ssize_t n    = arr.shape[0]
+    cdef Py_ssize_t lenb = n // stride
+    cdef Py_ssize_t nout = lenb + 1 if remainder and n % stride != 0 else lenb
+    cdef double [:] rebinned = np.empty(nout)
+    cdef bint       average  = mean
+    cdef Py_ssize_t i, j, s, f
+    cdef double     total
 
-    if remainder and len(arr) % stride != 0:
-        rebinned = np.empty(lenb + 1)
-        if mean: rebinned[-1] = np.mean(arr[lenb*stride:])
-        else   : rebinned[-1] = np.sum (arr[lenb*stride:])
-    else:
-        rebinned = np.empty(lenb)
-
-    cdef int i, s, f
-    for i in range(lenb):
-        s = i * stride
-        f = s + stride
-        if mean: rebinned[i] = np.mean(arr[s:f])
-        else   : rebinned[i] = np.sum (arr[s:f])
+    with nogil:
+        for i in range(nout):
+            s     = i * stride
+            f     = min(s + stride, n)
+            total = 0
+            for j in range(s, f):
+                total += arr[j]
+            rebinned[i] = total / (f - s) if average else total
 
     return np.asarray(rebinned)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _suppress_wf(float_t [:] wf,
+                       float_t [:] out,
+                       float_t     thr,
+                       Py_ssize_t  padding) nogil:
+    # Same as `wfm_functions.suppress_wf`: the samples not below
+    # `thr` (including nan) are kept, along with those in
+    # [i - padding, i + padding) around each of them, except for
+    # the last sample of the waveform, which is only kept if it is
+    # not below `thr` itself.
+    # Single forward pass that only reads samples not written yet,
+    # so `out` can be `wf` itself: `last` is the last sample not
+    # below `thr` up to k and `next_` the first one from k on (n if
+    # there is none), found by scanning ahead.
+    cdef Py_ssize_t n     = wf.shape[0]
+    cdef Py_ssize_t last  = -1
+    cdef Py_ssize_t next_ = -1
+    cdef Py_ssize_t k
+    cdef bint       keep
+    if padding < 0: padding = 0
+
+    for k in range(n):
+        if next_ < k:
+            next_ = k
+            while next_ < n and wf[next_] <= thr:
+                next_ += 1
+        if next_ == k:
+            last = k
+
+        keep = ((last  >= 0 and (k == last or k < min(last  + padding, n - 1))) or
+                (next_ <  n and  k >= next_ - padding and k < min(next_ + padding, n - 1)))
+        out[k] = wf[k] if keep else 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def suppress_wfs(float_t          [:, :] wfs,
+                 float_t          [:]    thresholds,
+                 const np.int64_t [:]    padding,
+                 float_t          [:, :] out,
+                 int                     n_threads = 1):
+    """
+    Zero-suppress each row of `wfs` with its threshold and padding,
+    writing the result into `out`, which can be `wfs` itself.
+    """
+    cdef Py_ssize_t i
+    for i in prange(wfs.shape[0], nogil=True, num_threads=n_threads, schedule="static"):
+        _suppress_wf(wfs[i], out[i], thresholds[i], padding[i])
+    return np.asarray(out)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def zero_below(float_t      [:, :] wfs,
+               const double [:]    thresholds,
+               int                 n_threads = 1):
+    """
+    Set to zero, in place, the samples of each row of `wfs` that
+    are not above its threshold. The comparison is done in double
+    precision.
+    """
+    cdef Py_ssize_t i, j
+    for i in prange(wfs.shape[0], nogil=True, num_threads=n_threads, schedule="static"):
+        for j in range(wfs.shape[1]):
+            if not wfs[i, j] > thresholds[i]:
+                wfs[i, j] = 0
+    return np.asarray(wfs)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef float_t _pairwise_sum(sample_t * a, Py_ssize_t n, Py_ssize_t stride, float_t zero) nogil:
+    # Sum of n samples `stride` elements apart in the order numpy's
+    # add.reduce uses for floats (pairwise summation in blocks of 128
+    # with 8 accumulators), so the result is bit-identical to it.
+    cdef float_t    r[8]
+    cdef float_t    res = zero
+    cdef Py_ssize_t i, j, n2
+    if n < 8:
+        for i in range(n):
+            res = res + <float_t> a[i * stride]
+        return res
+    if n <= 128:
+        for j in range(8):
+            r[j] = <float_t> a[j * stride]
+        i = 8
+        while i < n - n % 8:
+            for j in range(8):
+                r[j] = r[j] + <float_t> a[(i + j) * stride]
+            i = i + 8
+        res = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+        while i < n:
+            res = res + <float_t> a[i * stride]
+            i = i + 1
+        return res
+    n2 = n // 2
+    n2 = n2 - n2 % 8
+    return (_pairwise_sum(a              , n2    , stride, zero) +
+            _pairwise_sum(a + n2 * stride, n - n2, stride, zero))
+
+
+cdef inline float_t _window_sum(sample_t * a, Py_ssize_t n, Py_ssize_t stride, float_t zero) nogil:
+    # Like np.add.reduceat: the first sample plus the rest
+    return <float_t> a[0] + _pairwise_sum(a + stride, n - 1, stride, zero)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline Py_ssize_t _window_stop(const np.int64_t [:] starts, Py_ssize_t k, Py_ssize_t n) nogil:
+    # Windows that do not increase hold their first sample only
+    cdef Py_ssize_t stop = starts[k + 1] if k + 1 < starts.shape[0] else n
+    return stop if stop > starts[k] else starts[k] + 1
+
+
+def _check_windows(wfs_shape, starts, out_shape):
+    # The kernels do not check bounds
+    n_rows, n_samples = wfs_shape[0], wfs_shape[1]
+    if len(starts) and (np.min(starts) < 0 or np.max(starts) >= n_samples):
+        raise IndexError(f"Window starts must be in [0, {n_samples})")
+    if out_shape[0] != n_rows or out_shape[1] != len(starts):
+        raise ValueError(f"Output must have shape ({n_rows}, {len(starts)})")
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def window_sums(sample_t         [:, :] wfs,
+                const np.int64_t [:]    starts,
+                float_t          [:, :] out,
+                int                     n_threads = 1):
+    """
+    Sum of the samples in [starts[k], starts[k+1]) of each row of
+    `wfs` (up to the end of the row for the last window) into
+    `out[:, k]`, bit-identical to np.add.reduceat(wfs, starts,
+    axis=1, dtype=out.dtype).
+    """
+    _check_windows(wfs.shape, np.asarray(starts), out.shape)
+    _window_sums(wfs, starts, out, n_threads)
+    return np.asarray(out)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _window_sums(sample_t         [:, :] wfs,
+                       const np.int64_t [:]    starts,
+                       float_t          [:, :] out,
+                       int                     n_threads):
+    cdef Py_ssize_t step = wfs.strides[1] // sizeof(sample_t)
+    cdef float_t    zero = 0
+    cdef Py_ssize_t i, k, start
+    for i in prange(wfs.shape[0], nogil=True, num_threads=n_threads, schedule="static"):
+        for k in range(starts.shape[0]):
+            start     = starts[k]
+            out[i, k] = _window_sum(&wfs[i, start], _window_stop(starts, k, wfs.shape[1]) - start,
+                                    step, zero)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def weighted_rebin(const double     [:]    times,
+                   const double     [:]    widths,
+                   sample_t         [:, :] wfs,
+                   const np.int64_t [:]    starts,
+                   float_t          [:, :] out,
+                   int                     n_threads = 1):
+    """
+    Rebin the samples in [starts[k], starts[k+1]) into bin k. The
+    sums of `wfs` are written into `out` and the times, weighted with
+    the clipped-at-zero sum over rows of each sample (unweighted if
+    all weights are zero), and the summed widths are returned. Same
+    output, bit by bit, as `peak_functions.rebin_at`.
+    """
+    _check_windows(wfs.shape, np.asarray(starts), out.shape)
+    if times.shape[0] != wfs.shape[1] or widths.shape[0] != wfs.shape[1]:
+        raise ValueError("times, widths and waveforms must have the same number of samples")
+    _window_sums(wfs, starts, out, n_threads)
+
+    cdef Py_ssize_t n_samples       = wfs.shape[1]
+    cdef double [:] weights         = np.zeros(n_samples)
+    cdef double [:] weighted        = np.empty(n_samples)
+    cdef double [:] rebinned_times  = np.empty(starts.shape[0])
+    cdef double [:] rebinned_widths = np.empty(starts.shape[0])
+    cdef double     zero = 0
+    cdef Py_ssize_t i, j, k, start, n
+    cdef double     w, sum_w, sum_tw
+    cdef Py_ssize_t step = wfs.strides[1] // sizeof(sample_t)
+    cdef double   * w_p  = &weights[0]
+    cdef sample_t * row
+
+    with nogil:
+        # Row by row, so the samples are read in memory order
+        for i in range(wfs.shape[0]):
+            row = &wfs[i, 0]
+            for j in range(n_samples):
+                w_p[j] = w_p[j] + <double> row[j * step]
+        for j in range(n_samples):
+            w = weights[j]
+            if w < 0: w = 0
+            weights [j] = w
+            weighted[j] = w * times[j]
+
+    for k in prange(starts.shape[0], nogil=True, num_threads=n_threads, schedule="static"):
+        start  = starts[k]
+        n      = _window_stop(starts, k, n_samples) - start
+        sum_w  = _window_sum(&weights [start], n, 1, zero)
+        sum_tw = _window_sum(&weighted[start], n, 1, zero)
+        if sum_w > 0:
+            rebinned_times[k] = sum_tw / sum_w
+        else:
+            rebinned_times[k] = _window_sum(<double *> &times[start], n, 1, zero) / n
+        rebinned_widths[k] = _window_sum(<double *> &widths[start], n, 1, zero)
+    return np.asarray(rebinned_times), np.asarray(rebinned_widths)
+
+
+cdef inline Py_ssize_t _floor_div(Py_ssize_t a, Py_ssize_t b) nogil:
+    return a // b if a >= 0 else -((b - 1 - a) // b)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _fir_decimate(const double [:] x,
+                        const double [:] h,
+                        Py_ssize_t       q,
+                        Py_ssize_t       offset,
+                        double       [:] out) nogil:
+    # Each non-zero input sample x[i] is added to the outputs m with
+    # 0 <= q * m + offset - i < len(h), so zeros cost nothing.
+    cdef Py_ssize_t n_taps = h.shape[0]
+    cdef Py_ssize_t n_out  = out.shape[0]
+    cdef Py_ssize_t i, m, m_min, m_max
+    cdef double     v
+
+    for m in range(n_out):
+        out[m] = 0
+    for i in range(x.shape[0]):
+        v = x[i]
+        if v == 0: continue
+        m_min = -_floor_div(offset - i, q)
+        m_max =  _floor_div(i - offset + n_taps - 1, q)
+        if m_min < 0     : m_min = 0
+        if m_max >= n_out: m_max = n_out - 1
+        for m in range(m_min, m_max + 1):
+            out[m] += v * h[q * m + offset - i]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fir_decimate(const double [:, :] x,
+                 const double [:]    h,
+                 Py_ssize_t          q,
+                 Py_ssize_t          offset,
+                 double       [:, :] out,
+                 int                 n_threads = 1):
+    """
+    Filter each row of `x` with the FIR filter `h` and keep one
+    sample out of `q`, computing only the samples kept:
+    out[:, m] = sum_k h[k] x[:, q m + offset - k], with x = 0 outside
+    the row. The cost is proportional to the number of non-zero
+    samples of `x` times len(h) / q.
+    """
+    cdef Py_ssize_t r
+    for r in prange(x.shape[0], nogil=True, num_threads=n_threads, schedule="dynamic"):
+        _fir_decimate(x[r], h, q, offset, out[r])
+    return np.asarray(out)
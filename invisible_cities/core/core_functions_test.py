@@ -19,6 +19,7 @@ from hypothesis.strategies  import composite
 from hypothesis.extra.numpy import arrays
 
 from .testing_utils import random_length_float_arrays
+from .testing_utils import execution_time
 from .              import core_functions   as core
 from .              import core_functions_c as core_c
 from .              import  fit_functions   as fitf
@@ -298,6 +299,238 @@ def test_rebin_array_remainder():
                     assert i == len(arr[s:]) // stride
                     assert v == min(stride, len(arr[s:][i * stride:]))
 
+
+def test_rebin_array_mean():
+    arr      = np.arange(10, dtype=np.double)
+    expected = [0.5, 2.5, 4.5, 6.5, 8.5]
+    npt.assert_allclose(core_c.rebin_array(arr, 2, mean=True), expected)
+
+
+def suppress_wf_reference(wf, thr, padding):
+    wf        = np.copy(wf)
+    below_thr = wf <= thr
+    for i in np.flatnonzero(~below_thr):
+        below_thr[max(i - padding, 0) : min(i + padding, len(wf) - 1)] = False
+    wf[below_thr] = 0
+    return wf
+
+
+@mark.parametrize("dtype", (np.float32, np.float64))
+@mark.parametrize("n_threads", (1, 3))
+def test_suppress_wfs_same_as_python(dtype, n_threads):
+    rng        = np.random.RandomState(123)
+    wfs        = rng.normal(0, 1, size=(20, 200)).astype(dtype)
+    wfs[0, 10] = np.nan
+    thresholds = rng.uniform(1, 3, size=20)
+    padding    = rng.randint(0, 10, size=20)
+    expected   = [suppress_wf_reference(wf, thr, pad)
+                  for wf, thr, pad in zip(wfs, thresholds.astype(dtype), padding)]
+
+    out = np.empty_like(wfs)
+    core_c.suppress_wfs(wfs, thresholds.astype(dtype), padding.astype(np.int64), out, n_threads)
+    npt.assert_array_equal(out, expected)
+
+
+@mark.parametrize("dtype", (np.float32, np.float64))
+@mark.parametrize("padding", (0, 2, 7))
+def test_suppress_wfs_in_place_same_as_out_of_place(dtype, padding):
+    rng        = np.random.RandomState(321)
+    wfs        = rng.normal(0, 1, size=(20, 200)).astype(dtype)
+    thresholds = rng.uniform(1, 3, size=20).astype(dtype)
+    padding    = np.full(20, padding, dtype=np.int64)
+
+    expected = core_c.suppress_wfs(wfs, thresholds, padding, np.empty_like(wfs))
+    in_place = core_c.suppress_wfs(wfs, thresholds, padding, wfs)
+    npt.assert_array_equal(in_place, expected)
+    npt.assert_array_equal(wfs     , expected)
+
+
+def test_suppress_wfs_in_place_keeps_padding_before_peak():
+    wfs      = np.array([[0.5, 0.7, 5., 0.2, 0.1]])
+    expected = np.array([[0.5, 0.7, 5., 0.2, 0. ]])
+    args     = np.array([1.]), np.array([2], dtype=np.int64)
+    npt.assert_array_equal(core_c.suppress_wfs(wfs, *args, np.empty_like(wfs)), expected)
+    npt.assert_array_equal(core_c.suppress_wfs(wfs, *args, wfs               ), expected)
+
+
+@mark.parametrize("dtype", (np.float32, np.float64))
+def test_zero_below(dtype):
+    wfs        = np.array([[0, 1, 2, 3], [3, 2, np.nan, 0]], dtype=dtype)
+    thresholds = np.array([1, 2.5])
+    expected   = np.array([[0, 0, 2, 3], [3, 0, 0, 0]], dtype=dtype)
+    core_c.zero_below(wfs, thresholds)
+    npt.assert_array_equal(wfs, expected)
+
+
+@mark.parametrize("q offset".split(), ((1, 0), (4, 5), (25, 250)))
+@mark.parametrize("n_threads", (1, 3))
+def test_fir_decimate_same_as_filter_and_slice(q, offset, n_threads):
+    rng       = np.random.RandomState(789)
+    x         = rng.normal(size=(4, 1000))
+    x[x < 1]  = 0
+    h         = rng.normal(size=501)
+    n_out     = 1000 // q
+    filtered  = np.array([np.convolve(row, h) for row in x])
+    expected  = np.zeros((4, n_out))
+    m         = np.arange(n_out)
+    valid     = q * m + offset < filtered.shape[1]
+    expected[:, valid] = filtered[:, q * m[valid] + offset]
+
+    out = np.empty((4, n_out))
+    core_c.fir_decimate(x, h, q, offset, out, n_threads)
+    npt.assert_allclose(out, expected, rtol=1e-12, atol=1e-12)
+
+
+@mark.parametrize("dtype out_dtype".split(),
+                  ((np.int16  , np.float64),
+                   (np.int64  , np.float64),
+                   (np.float32, np.float32),
+                   (np.float64, np.float64),
+                   (np.float64, np.float32)))
+@mark.parametrize("n_threads", (1, 3))
+def test_window_sums_same_as_reduceat(dtype, out_dtype, n_threads):
+    rng = np.random.RandomState(456)
+    wfs = rng.uniform(-100, 100, size=(10, 1000)).astype(dtype)
+    # Short and long windows, including the pairwise summation blocks
+    starts   = np.array([0, 1, 3, 10, 17, 25, 153, 160, 449, 700], dtype=np.int64)
+    expected = np.add.reduceat(wfs, starts, axis=1, dtype=out_dtype)
+
+    out = np.empty((10, len(starts)), dtype=out_dtype)
+    core_c.window_sums(wfs, starts, out, n_threads)
+    npt.assert_array_equal(out, expected)
+
+
+def test_window_sums_non_contiguous_input():
+    wfs      = np.random.RandomState(654).uniform(size=(5, 600))[::2, 3::3]
+    starts   = np.array([0, 50, 51, 180], dtype=np.int64)
+    expected = np.add.reduceat(wfs, starts, axis=1)
+
+    out = np.empty((3, len(starts)))
+    npt.assert_array_equal(core_c.window_sums(wfs, starts, out), expected)
+
+
+@mark.parametrize("starts out_shape error".split(),
+                  (([0, 10], (2, 2), IndexError),
+                   ([-1, 5], (2, 2), IndexError),
+                   ([0,  5], (2, 3), ValueError),
+                   ([0,  5], (3, 2), ValueError)))
+def test_window_sums_raises_on_inconsistent_input(starts, out_shape, error):
+    wfs = np.ones((2, 10))
+    with raises(error):
+        core_c.window_sums(wfs, np.array(starts, dtype=np.int64), np.empty(out_shape))
+
+
+def weighted_rebin_reference(times, widths, wfs, starts):
+    weights = np.sum(wfs, axis=0, dtype=np.float64).clip(0)
+    n_in    = np.diff(np.append(starts, len(times)))
+    sum_w   = np.add.reduceat(weights        , starts)
+    sum_tw  = np.add.reduceat(weights * times, starts)
+    mean_t  = np.add.reduceat(          times, starts) / n_in
+    return (np.divide(sum_tw, sum_w, out=mean_t, where=sum_w > 0),
+            np.add.reduceat(widths, starts),
+            np.add.reduceat(wfs   , starts, axis=1,
+                            dtype=np.float32 if wfs.dtype == np.float32 else np.float64))
+
+
+@mark.parametrize("dtype", (np.int32, np.float32, np.float64))
+@mark.parametrize("n_threads", (1, 3))
+def test_weighted_rebin_same_as_numpy(dtype, n_threads):
+    rng      = np.random.RandomState(987)
+    wfs      = rng.uniform(-5, 50, size=(12, 2000)).astype(dtype)
+    # All weights are zero in the second window
+    wfs[:, 40:80] = -1
+    times    = np.cumsum(rng.uniform(20, 30, size=2000))
+    widths   = np.diff(np.append(0, times))
+    starts   = np.array([0, 40, 80, 81, 300, 1023, 1500], dtype=np.int64)
+    expected = weighted_rebin_reference(times, widths, wfs, starts)
+
+    out = np.empty((12, len(starts)), dtype=expected[2].dtype)
+    got = core_c.weighted_rebin(times, widths, wfs, starts, out, n_threads) + (out,)
+    for got_, expected_ in zip(got, expected):
+        npt.assert_array_equal(got_, expected_)
+
+
+def test_weighted_rebin_raises_ValueError_with_wrong_number_of_samples():
+    wfs    = np.ones((2, 10))
+    starts = np.array([0, 5], dtype=np.int64)
+    with raises(ValueError):
+        core_c.weighted_rebin(np.arange(9.), np.ones(10), wfs, starts, np.empty((2, 2)))
+
+
+@mark.benchmark
+def test_suppress_wfs_faster_than_python():
+    rng        = np.random.RandomState(123)
+    wfs        = rng.normal(0, 1, size=(1792, 800))
+    thresholds = np.full(1792, 2.)
+    padding    = np.full(1792, 3, dtype=np.int64)
+
+    def reference(wfs, thresholds, padding):
+        return [suppress_wf_reference(wf, thr, pad) for wf, thr, pad in zip(wfs, thresholds, padding)]
+
+    python   = execution_time(reference          , wfs, thresholds, padding)
+    compiled = execution_time(core_c.suppress_wfs, wfs, thresholds, padding, np.empty_like(wfs))
+    print(f"suppress_wfs: {compiled * 1e3:.1f} ms, python: {python * 1e3:.1f} ms")
+    assert compiled < python
+
+
+@mark.benchmark
+def test_zero_below_faster_than_numpy():
+    rng        = np.random.RandomState(123)
+    wfs        = rng.normal(0, 1, size=(1792, 800))
+    thresholds = np.full(1792, 1.)
+
+    def reference(wfs, thresholds):
+        wfs[~(wfs > thresholds[:, np.newaxis])] = 0
+
+    numpy    = execution_time(reference        , wfs.copy(), thresholds)
+    compiled = execution_time(core_c.zero_below, wfs.copy(), thresholds)
+    print(f"zero_below: {compiled * 1e3:.1f} ms, numpy: {numpy * 1e3:.1f} ms")
+    assert compiled < numpy
+
+
+@mark.benchmark
+def test_window_sums_faster_than_reduceat():
+    wfs    = np.random.RandomState(123).uniform(size=(1792, 800)).astype(np.float32)
+    starts = np.arange(0, 800, 2, dtype=np.int64)
+    out    = np.empty((1792, len(starts)), dtype=np.float32)
+
+    numpy    = execution_time(np.add.reduceat   , wfs, starts, axis=1)
+    compiled = execution_time(core_c.window_sums, wfs, starts, out)
+    print(f"window_sums: {compiled * 1e3:.1f} ms, reduceat: {numpy * 1e3:.1f} ms")
+    assert compiled < numpy
+
+
+@mark.benchmark
+def test_weighted_rebin_faster_than_numpy():
+    wfs    = np.random.RandomState(123).uniform(size=(1792, 800)).astype(np.float32)
+    times  = np.arange(800) * 1e3
+    widths = np.full(800, 1e3)
+    starts = np.arange(0, 800, 2, dtype=np.int64)
+    out    = np.empty((1792, len(starts)), dtype=np.float32)
+
+    numpy    = execution_time(weighted_rebin_reference, times, widths, wfs, starts)
+    compiled = execution_time(core_c.weighted_rebin  , times, widths, wfs, starts, out)
+    print(f"weighted_rebin: {compiled * 1e3:.1f} ms, numpy: {numpy * 1e3:.1f} ms")
+    assert compiled < numpy
+
+
+@mark.benchmark
+def test_fir_decimate_faster_than_filter_and_slice():
+    rng      = np.random.RandomState(123)
+    x        = rng.normal(size=(12, 20000))
+    x[x < 2] = 0
+    h        = rng.normal(size=1001)
+    out      = np.empty((12, 20000 // 40))
+
+    def reference(x, h):
+        return np.array([np.convolve(row, h)[:20000:40] for row in x])
+
+    numpy    = execution_time(reference          , x, h)
+    compiled = execution_time(core_c.fir_decimate, x, h, 40, 0, out)
+    print(f"fir_decimate: {compiled * 1e3:.1f} ms, convolve: {numpy * 1e3:.1f} ms")
+    assert compiled < numpy
+
+
 def test_define_window():
     mu, sigma = 100, 0.2 # mean and standard deviation
     sgn = np.random.normal(mu, sigma, 10000)
@@ -1,8 +1,12 @@
-from enum import Enum
+import os
+import hashlib
+
+from enum       import Enum
+from contextlib import suppress
 
 import numpy as np
 
-from scipy.signal import fftconvolve
+from scipy.fftpack import next_fast_len
 
 from typing       import       Tuple
 
@@ -32,6 +36,88 @@ def sample_discrete_distribution(bin_centres : np.array,
                             size = size)
 
 
+def random_generator(rng : np.random.Generator = None) -> np.random.Generator:
+    """
+    `rng` or, if None, a new generator seeded from numpy's global
+    random state, so that np.random.seed keeps making the results
+    reproducible.
+    """
+    if rng is not None:
+        return rng
+    return np.random.default_rng(np.random.randint(0, 2**63, dtype=np.int64))
+
+
+def event_generator(seed : int, *keys) -> np.random.Generator:
+    """
+    Independent random generator for each combination of `keys`
+    (integers, such as run and event numbers, or strings, such as
+    file names) of a given seed, regardless of the order in which
+    they are processed.
+    """
+    entropy = [seed]
+    for key in keys:
+        if isinstance(key, str):
+            digest = hashlib.sha1(key.encode()).digest()[:8]
+            entropy.extend((1, int.from_bytes(digest, "little")))
+        else:
+            key = int(key)
+            entropy.extend((0, int(key < 0), abs(key)))
+    return np.random.default_rng(np.random.SeedSequence(entropy))
+
+
+def discrete_distributions_sampler(bin_centres : np.array,
+                                   bin_weights : np.array):
+    """
+    Returns a function that takes `size` samples of each of the
+    distributions given by the rows of `bin_weights` at once, with
+    an inverse CDF, using the random generator passed (see
+    `random_generator`). Rows without weights give zeros.
+
+    The cumulative tables are computed only once, as integers with
+    the 52 bits of precision of a double. The inverse CDF starts at
+    the bin given by a guide table (the first bin of each of
+    `n_guide` equal parts of the CDF) and moves forward, so each
+    sample takes one or two steps on average instead of a search.
+    """
+    bin_weights     = np.asarray(bin_weights, dtype=np.double)
+    n_dists, n_bins = bin_weights.shape
+    bits            = 52
+    guide_bits      = int(np.ceil(np.log2(n_bins))) + 1
+    unit            = 2**bits
+
+    cdfs        = np.cumsum(bin_weights, axis=1)
+    empty       = cdfs[:, -1] <= 0
+    cdfs[empty] = 1
+    cdfs       /= cdfs[:, -1:]
+    ticks       = np.floor(cdfs * unit).astype(np.int64)
+
+    # First bin above the start of each part of the CDF, as an index
+    # of the flattened tables
+    starts      = np.arange(2**guide_bits, dtype=np.int64) << (bits - guide_bits)
+    guide       = np.array([np.searchsorted(row, starts, side="right") for row in ticks])
+    guide      += np.arange(n_dists)[:, np.newaxis] * n_bins
+    guide       = guide.ravel()
+    ticks       = ticks.ravel()
+
+    bin_centres = np.asarray(bin_centres)
+    values      = np.where(empty[:, np.newaxis], 0, bin_centres[np.newaxis]).ravel()
+    row_guides  = np.arange(n_dists, dtype=np.int64)[:, np.newaxis] << guide_bits
+
+    def sample(size : int = 1, rng : np.random.Generator = None) -> np.array:
+        draws   = random_generator(rng).integers(0, unit, size=(n_dists, size), dtype=np.int64)
+        indices = guide[(draws >> (bits - guide_bits)) + row_guides].ravel()
+        draws   = draws.ravel()
+
+        # The last bin of each row ends at `unit`, above any draw
+        moving = np.flatnonzero(ticks[indices] <= draws)
+        while len(moving):
+            indices[moving] += 1
+            moving = moving[ticks[indices[moving]] <= draws[moving]]
+        return values[indices].reshape(n_dists, size)
+
+    return sample
+
+
 def uniform_smearing(max_deviation : np.array,
                      size : Tuple = 1) -> np.array:
     return np.random.uniform(-max_deviation,
@@ -77,6 +163,77 @@ def pad_pdfs(bins    : np.array,
     return padded_bins, padded_spectra
 
 
+def multi_sample_pdfs(pdfs         : np.array,
+                      sample_width : int) -> np.array:
+    """
+    Distribution of the sum of `sample_width` samples of each of the
+    distributions given by the rows of `pdfs`, as obtained with
+    `sample_width - 1` convolutions with fftconvolve(..., mode="same").
+    Each convolution is cropped to the original bins, so the
+    probability that leaves them is lost at every step, as it was.
+    All rows are convolved at once through their spectra, in
+    batches to limit the memory used.
+    """
+    pdfs   = np.asarray(pdfs, dtype=np.double)
+    n_bins = pdfs.shape[1]
+    if sample_width == 1:
+        return pdfs.copy()
+
+    n_fft = next_fast_len(2 * n_bins - 1)
+    start = (n_bins - 1) // 2
+    batch = max(1, 2**22 // n_fft)
+    out   = np.empty_like(pdfs)
+    for first in range(0, len(pdfs), batch):
+        spectra = np.fft.rfft(pdfs[first:first + batch], n_fft, axis=1)
+        summed  = pdfs[first:first + batch]
+        for _ in range(sample_width - 1):
+            summed = np.fft.irfft(spectra * np.fft.rfft(summed, n_fft, axis=1), n_fft, axis=1)
+            summed = summed[:, start:start + n_bins]
+        out[first:first + batch] = summed
+    return out
+
+
+def default_cache_dir() -> str:
+    """
+    Directory where the distributions that are expensive to compute
+    are stored: $ICCACHEDIR if defined and not empty. Otherwise
+    None, so nothing is cached unless the user asks for it.
+    """
+    return os.environ.get("ICCACHEDIR") or None
+
+
+def cached_array(cache_dir : str, name : str, compute) -> np.array:
+    """
+    Array stored as `name` in `cache_dir` or, if it is not there,
+    the result of `compute()`, which is then stored. Nothing is
+    stored if `cache_dir` is None or cannot be written.
+    """
+    if cache_dir is None:
+        return compute()
+
+    filename = os.path.join(cache_dir, name + ".npy")
+    try:
+        return np.load(filename)
+    except (OSError, ValueError):
+        pass
+
+    array = compute()
+    # Written under a temporary name so that other jobs never
+    # read a partial file, which is removed if anything fails
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_filename, "wb") as file:
+            np.save(file, array)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        pass
+    finally:
+        with suppress(OSError):
+            os.remove(tmp_filename)
+    return array
+
+
 def general_thresholds(xbins : np.array,
                        probs : np.array,
                        noise_cut : float) -> np.array:
@@ -111,7 +268,8 @@ class NoiseSampler:
                  detector    : str,
                  run_number  : int,
                  sample_size : int = 1,
-                 smear       : bool = True):
+                 smear       : bool = True,
+                 cache_dir   : str = None):
         """Sample a histogram as if it was a PDF.
 
         Parameters
@@ -124,6 +282,10 @@ class NoiseSampler:
             If True, the samples are uniformly smeared to simulate
             a continuous distribution. If False, the samples are
             always the center of the histograms' bins. Default is True.
+        cache_dir: str, optional
+            Directory where the multi-sample distributions are stored
+            to be reused by other jobs (see `default_cache_dir`). They
+            are not stored if None (default).
 
         Attributes
         ---------
@@ -141,10 +303,14 @@ class NoiseSampler:
         (self.probs,
          self.xbins,
          self.baselines) = DB.SiPMNoise(detector, run_number)
+        datasipm         = DB.DataSiPM (detector, run_number)
+        self.detector    = detector
+        self.run_number  = run_number
+        self.cache_dir   = cache_dir
         self.nsamples    = sample_size
         self.smear       = smear
-        self.active      = DB.DataSiPM(detector, run_number).Active.values[:, np.newaxis]
-        self.adc_to_pes  = DB.DataSiPM(detector, run_number).adc_to_pes.values.astype(np.double)[:, np.newaxis]
+        self.active      = datasipm.Active.values[:, np.newaxis]
+        self.adc_to_pes  = datasipm.adc_to_pes.values.astype(np.double)[:, np.newaxis]
         self.nsensors    = self.active.size
 
         self.probs       = np.apply_along_axis(normalize_distribution, 1,
@@ -152,23 +318,21 @@ class NoiseSampler:
         self.baselines   = self.baselines[:, np.newaxis]
         self.dx          = np.diff(self.xbins)[0] * 0.5
 
-        self._sampler    = partial(sample_discrete_distribution,
-                                   self.xbins,
-                                   size = self.nsamples)
-        self._smearer    = partial(uniform_smearing,
-                                   max_deviation = self.dx,
-                                   size          = (self.nsensors,
-                                                    self.nsamples))
+        self._sampler    = discrete_distributions_sampler(self.xbins, self.probs)
 
     def mask(self, array):
         """Set to 0 those rows corresponding to masked sensors"""
         return array * self.active
 
-    def sample(self):
-        """Take a set of samples from each pdf."""
-        sample  = np.apply_along_axis(self._sampler, 1, self.probs)
+    def sample(self, rng : np.random.Generator = None):
+        """
+        Take a set of samples from each pdf, all sensors at once,
+        using the random generator `rng` (see `random_generator`).
+        """
+        rng    = random_generator(rng)
+        sample = self._sampler(self.nsamples, rng)
         if self.smear:
-            sample += self._smearer()
+            sample += rng.uniform(-self.dx, self.dx, size=sample.shape)
         sample = self.adc_to_pes * sample + self.baselines
         return self.mask(sample)
 
@@ -275,12 +439,14 @@ class NoiseSampler:
             the requested sample_width and padded for symmetry
             around zero.
         """
+        pdfs = pad_pdfs(self.xbins, self.probs)[1]
         if sample_width == 1:
-            return pad_pdfs(self.xbins, self.probs)[1]
-
-        mapping = map(fftconvolve                                      ,
-                      self.multi_sample_distributions(               1),
-                      self.multi_sample_distributions(sample_width - 1),
-                      np.full(self.probs.shape[0], "same")             )
-
-        return np.array(tuple(mapping))
+            return pdfs
+
+        # The name includes a digest of the spectra so that a change
+        # in the database is never hidden by the cache
+        detector = os.path.basename(str(self.detector))
+        digest   = hashlib.sha1(pdfs.tobytes()).hexdigest()[:16]
+        name     = f"sipm_pdfs_{detector}_{self.run_number}_{sample_width}_{digest}"
+        return cached_array(self.cache_dir, name,
+                            partial(multi_sample_pdfs, pdfs, sample_width))
@@ -1,5 +1,9 @@
+import os
+
 import numpy as np
 
+from scipy.signal import fftconvolve
+
 from flaky  import   flaky
 from pytest import    mark
 from pytest import fixture
@@ -18,6 +22,11 @@ from ..database.load_db import DataSiPM
 from . random_sampling  import normalize_distribution
 from . random_sampling  import sample_discrete_distribution
 from . random_sampling  import uniform_smearing
+from . random_sampling  import discrete_distributions_sampler
+from . random_sampling  import event_generator
+from . random_sampling  import multi_sample_pdfs
+from . random_sampling  import cached_array
+from . random_sampling  import default_cache_dir
 from . random_sampling  import inverse_cdf_index
 from . random_sampling  import inverse_cdf
 from . random_sampling  import pad_pdfs
@@ -86,6 +95,55 @@ def test_sample_discrete_distribution_invalid_input(distribution, nsamples):
     assert not np.any(samples)
 
 
+@given(valid_distributions(),
+       integers(min_value = 1, max_value = 10))
+def test_discrete_distributions_sampler_valid_input(distribution, nsamples):
+    domain, frequencies = distribution
+    bin_weights = np.stack([frequencies, np.zeros_like(frequencies)])
+    samples     = discrete_distributions_sampler(domain, bin_weights)(nsamples)
+    assert samples.shape == (2, nsamples)
+    assert np.all(np.in1d(samples[0], domain[frequencies > 0]))
+    assert not np.any(samples[1])
+
+
+def test_discrete_distributions_sampler_stats():
+    domain      = np.arange(10)
+    bin_weights = np.array([[0, 1, 2, 3, 4, 0, 0, 0, 0, 0],
+                            [0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
+                            [1, 0, 0, 0, 0, 0, 0, 0, 0, 1e-3]])
+    sample      = discrete_distributions_sampler(domain, bin_weights)
+    samples     = sample(100000, np.random.default_rng(123))
+
+    for row, weights in zip(samples, bin_weights):
+        counts   = np.bincount(row.astype(int), minlength=len(domain))
+        expected = weights / weights.sum() * len(row)
+        assert np.all(counts[weights == 0] == 0)
+        assert np.allclose(counts, expected, atol=5 * expected**0.5 + 1)
+
+
+def test_discrete_distributions_sampler_is_reproducible():
+    sample = discrete_distributions_sampler(np.arange(3), np.ones((4, 3)))
+    first  = sample(10, np.random.default_rng(123))
+    second = sample(10, np.random.default_rng(123))
+    assert np.all(first == second)
+
+
+def test_event_generator():
+    draw = lambda *args: event_generator(*args).random(10)
+    assert np.all(draw(1, 6400, 2) == draw(1,  6400, 2))
+    assert np.all(draw(1, 6400, 2) != draw(2,  6400, 2))
+    assert np.all(draw(1, 6400, 2) != draw(1, -6400, 2))
+    assert np.all(draw(1, 6400, 2) != draw(1,  6400, 3))
+    assert np.all(draw(1, 6400, 2) != draw(1,  6400, 2, 0))
+
+
+def test_event_generator_with_file_names():
+    draw = lambda *args: event_generator(*args).random(10)
+    assert np.all(draw(1, "a.h5", np.int32(2)) == draw(1, "a.h5", 2))
+    assert np.all(draw(1, "a.h5", 2) != draw(1, "b.h5", 2))
+    assert np.all(draw(1, "a.h5", 2) != draw(1, "a.h5", 2, "pmt"))
+
+
 @given(floats(min_value = 1e-2,
               max_value = 1e+2),
        sensible_sizes)
@@ -232,6 +290,13 @@ def test_noise_sampler_attributes(datasipm, noise_sampler):
     assert np.allclose(av_noise[active == 1], true_av_noise, rtol = 1e-8)
 
 
+def test_noise_sampler_sample_is_reproducible(noise_sampler):
+    noise_sampler, *_ = noise_sampler
+    first  = noise_sampler.sample(np.random.default_rng(123))
+    second = noise_sampler.sample(np.random.default_rng(123))
+    assert np.all(first == second)
+
+
 def test_noise_sampler_take_sample(datasipm, noise_sampler):
     noise_sampler, _, smear, *_ = noise_sampler
     samples = noise_sampler.sample()
@@ -273,6 +338,78 @@ def test_noise_sampler_compute_thresholds(datasipm, noise_sampler, pes_to_adc, a
         assert truth == threshold_counts[i]
 
 
+@mark.parametrize("n_bins"      , (50, 51))
+@mark.parametrize("sample_width", (1, 2, 3, 6))
+def test_multi_sample_pdfs_same_as_repeated_convolution(n_bins, sample_width):
+    # Spectra in the middle of the range, as the padded ones, so no
+    # probability is lost at the edges by the repeated convolution
+    rng      = np.random.RandomState(n_bins)
+    x        = np.arange(n_bins) - n_bins // 2 - rng.uniform(0, 1, size=(5, 1))
+    pdfs     = np.exp(-0.5 * x**2) * rng.uniform(0.5, 1, size=(5, n_bins))
+    pdfs    /= pdfs.sum(axis=1)[:, np.newaxis]
+    expected = pdfs
+    for _ in range(sample_width - 1):
+        expected = np.array([fftconvolve(pdf, previous, "same")
+                             for pdf, previous in zip(pdfs, expected)])
+
+    assert np.allclose(multi_sample_pdfs(pdfs, sample_width), expected, atol=1e-15)
+
+
+@mark.parametrize("sample_width", (2, 3, 6))
+def test_multi_sample_pdfs_crops_after_each_convolution(sample_width):
+    # Spectra at both edges, so the repeated convolution loses
+    # probability that would otherwise come back within the bins
+    # (the sum of a low and a high value)
+    n_bins   = 41
+    rng      = np.random.RandomState(sample_width)
+    pdfs     = rng.uniform(0, 1, size=(4, n_bins))
+    pdfs[:, 5:-5] = 0
+    pdfs    /= pdfs.sum(axis=1)[:, np.newaxis]
+    expected = pdfs
+    for _ in range(sample_width - 1):
+        expected = np.array([fftconvolve(pdf, previous, "same")
+                             for pdf, previous in zip(pdfs, expected)])
+
+    got = multi_sample_pdfs(pdfs, sample_width)
+    assert np.all(got.sum(axis=1) < 0.5)
+    assert np.allclose(got, expected, atol=1e-15)
+
+
+def test_cached_array(output_tmpdir):
+    cache_dir = os.path.join(output_tmpdir, "cache")
+    array     = np.arange(10.)
+    computed  = []
+    def compute():
+        computed.append(True)
+        return array
+
+    assert np.all(cached_array(cache_dir, "array", compute) == array)
+    assert np.all(cached_array(cache_dir, "array", compute) == array)
+    assert len(computed) == 1
+    assert os.listdir(cache_dir) == ["array.npy"]
+
+    assert np.all(cached_array(None, "array", compute) == array)
+    assert len(computed) == 2
+
+
+def test_cached_array_removes_temporary_file_on_failure(output_tmpdir, monkeypatch):
+    cache_dir = os.path.join(output_tmpdir, "failing_cache")
+    array     = np.arange(10.)
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(np, "save", fail)
+    assert np.all(cached_array(cache_dir, "array", lambda: array) == array)
+    assert os.listdir(cache_dir) == []
+
+
+@mark.parametrize("cache_dir", (None, "", "some/dir"))
+def test_default_cache_dir_only_from_environment(monkeypatch, cache_dir):
+    if cache_dir is None: monkeypatch.delenv("ICCACHEDIR", raising=False)
+    else                : monkeypatch.setenv("ICCACHEDIR", cache_dir)
+    assert default_cache_dir() == (cache_dir or None)
+
+
 def test_noise_sampler_multi_sample_distributions(noise_sampler):
     noise_sampler, *_ = noise_sampler
 
@@ -1,3 +1,6 @@
+import timeit
+import tracemalloc
+
 import numpy  as np
 import pandas as pd
 
@@ -201,3 +204,41 @@ def assert_hit_equality(a_hit, b_hit):
     assert a_hit.Xpeak        == approx (b_hit.Xpeak      )
     assert a_hit.Ypeak        == approx (b_hit.Ypeak      )
     assert a_hit.peak_number  == exactly(b_hit.peak_number)
+
+
+def peak_allocated_memory(fn, *args, **kwargs):
+    """
+    Maximum memory (in bytes) held at any time by the objects
+    allocated during the call `fn(*args, **kwargs)`, as traced by
+    `tracemalloc`, including numpy array data. The tracing state
+    of `tracemalloc` is left as it was. If it is already tracing
+    and the peak cannot be reset (python < 3.9), it is restarted,
+    which discards the traces recorded so far.
+    """
+    was_tracing = tracemalloc.is_tracing()
+    if was_tracing and hasattr(tracemalloc, "reset_peak"):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1] - before
+
+    n_frames = tracemalloc.get_traceback_limit()
+    tracemalloc.stop()
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        if was_tracing:
+            tracemalloc.start(n_frames)
+
+
+def execution_time(fn, *args, repeat=5, **kwargs):
+    """
+    Shortest time (in seconds) of `repeat` calls to
+    `fn(*args, **kwargs)`. The benchmarks compare implementations
+    run on the same machine rather than absolute times, so the
+    shortest time, the least affected by other processes, is used.
+    """
+    return min(timeit.repeat(lambda: fn(*args, **kwargs), repeat=repeat, number=1))
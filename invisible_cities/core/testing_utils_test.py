@@ -1,3 +1,6 @@
+import time
+import tracemalloc
+
 import numpy as np
 
 from pytest                       import mark
@@ -9,6 +12,8 @@ from hypothesis.     extra.pandas import column
 from hypothesis.     extra.pandas import range_indexes
 from . testing_utils              import all_elements_close
 from . testing_utils              import assert_tables_equality
+from . testing_utils              import peak_allocated_memory
+from . testing_utils              import execution_time
 
 
 @flaky(max_runs=2)
@@ -41,3 +46,25 @@ def test_assert_tables_equality_withNaN():
     table = np.array([('Rex', 9, 81.0), ('Fido', 3, np.nan)],
                      dtype=[('name', 'U10'), ('age', 'i4'), ('weight', 'f4')])
     assert_tables_equality(table, table)
+
+
+@mark.parametrize("tracing", (False, True))
+def test_peak_allocated_memory_keeps_tracing_state(tracing):
+    if tracing: tracemalloc.start()
+    else      : tracemalloc.stop ()
+    try:
+        allocated = peak_allocated_memory(np.ones, 100000)
+        assert allocated >= 8 * 100000
+        assert tracemalloc.is_tracing() == tracing
+    finally:
+        tracemalloc.stop()
+
+
+def test_execution_time_is_the_shortest_call():
+    calls = []
+    def fn(duration):
+        calls.append(duration)
+        time.sleep(duration * len(calls))
+
+    assert 0.01 <= execution_time(fn, 0.01, repeat=3) < 0.02
+    assert len(calls) == 3
@@ -9,6 +9,8 @@ import builtins
 import functools
 import itertools as it
 import copy
+import multiprocessing
+import sys
 
 from collections import namedtuple
 from functools   import wraps
@@ -16,6 +18,7 @@ from asyncio     import Future
 from contextlib  import contextmanager
 from argparse    import Namespace
 from operator    import itemgetter
+from concurrent.futures import ProcessPoolExecutor
 
 
 @contextmanager
@@ -82,6 +85,81 @@ def map(op=None, *, args=None, out=None, item=None):
     return coroutine(map_loop)
 
 
+# Operations of the running `parallel_map`s. The workers are forked
+# after the operation is registered, so they find it here and it
+# needs not be picklable.
+_parallel_ops = {}
+_parallel_op_keys = it.count()
+
+def _call_parallel_op(key, *values):
+    return _parallel_ops[key](*values)
+
+def _fork_context():
+    # Forking is not available on Windows and is not safe on macOS,
+    # where system libraries may use threads
+    if sys.platform == "darwin" or "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context("fork")
+
+
+def parallel_map(op, *, args, out, n_workers=1, chunk_size=None):
+    """
+    Like `map` with `args` and `out`, but `op` is applied in
+    `n_workers` processes to chunks of `chunk_size` items (4 per
+    worker by default), which are sent downstream in the order in
+    which they arrived. Only ops whose arguments and results are
+    picklable are supported, as they are sent between processes.
+    `op` itself is inherited by the workers, which are forked, so it
+    needs not be picklable, but it must not rely on state changed by
+    previous items. With one worker, or where processes cannot be
+    forked (Windows and macOS), this is the same as `map`.
+    """
+    if n_workers <= 1 or _fork_context() is None:
+        return map(op, args=args, out=out)
+
+    if _exactly_one(args):
+        args = args,
+
+    merged_output = _exactly_one(out)
+    if merged_output:
+        out = out,
+
+    if chunk_size is None:
+        chunk_size = 4 * n_workers
+
+    def map_loop(target):
+        key = next(_parallel_op_keys)
+        _parallel_ops[key] = op
+        context = _fork_context()
+        pending = []
+
+        def flush():
+            values  = zip(*([data[arg] for arg in args] for data in pending))
+            results = executor.map(_call_parallel_op, it.repeat(key), *values)
+            for data, trans in zip(pending, results):
+                if merged_output:
+                    trans = trans,
+                for name, value in zip(out, trans):
+                    data[name] = value
+                target.send(data)
+            pending.clear()
+
+        try:
+            with closing(target), ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+                try:
+                    while True:
+                        pending.append((yield))
+                        if len(pending) == chunk_size:
+                            flush()
+                except GeneratorExit:
+                    if pending:
+                        flush()
+        finally:
+            del _parallel_ops[key]
+
+    return coroutine(map_loop)
+
+
 def filter(predicate, *, args=None):
     if args is None:
         def filter_loop(target):
@@ -68,6 +68,69 @@ def test_map():
     assert result == list(map(the_operation, the_source))
 
 
+@parametrize("n_workers chunk_size".split(),
+             ((1, None),
+              (2, None),
+              (3,    4)))
+def test_parallel_map(n_workers, chunk_size):
+
+    # 'parallel_map' works like 'map' on the items of the pipe, but
+    # the operation is applied in several processes. The items come
+    # out in the same order, even if the last chunk is not full.
+
+    # The operation needs not be picklable
+    offset = 100
+    def the_operation(n, m): return n*m + offset, n-m
+
+    the_source = [dict(n=n, m=2*n) for n in range(11)]
+
+    result = []
+    the_sink = df.sink(result.append)
+
+    df.push(source = the_source,
+            pipe   = df.pipe(df.parallel_map(the_operation,
+                                             args       = ("n", "m"),
+                                             out        = ("nm", "d"),
+                                             n_workers  = n_workers,
+                                             chunk_size = chunk_size),
+                             the_sink))
+
+    expected = [dict(n=n, m=2*n, nm=2*n*n + offset, d=-n) for n in range(11)]
+    assert result == expected
+
+
+@mark.parametrize("platform start_methods".split(),
+                  (("win32" , ["spawn"]                   ),
+                   ("darwin", ["fork", "spawn", "forkserver"])))
+def test_parallel_map_falls_back_to_map_without_fork(monkeypatch, platform, start_methods):
+    monkeypatch.setattr(df.sys, "platform", platform)
+    monkeypatch.setattr(df.multiprocessing, "get_all_start_methods", lambda: start_methods)
+
+    def no_process_pool(*args, **kwargs):
+        raise AssertionError("no processes must be started")
+    monkeypatch.setattr(df, "ProcessPoolExecutor", no_process_pool)
+
+    # The operation needs not be picklable either
+    result = []
+    df.push(source = range(10),
+            pipe   = df.pipe(df.map(lambda n: dict(n=n)),
+                             df.parallel_map(lambda n: n*n, args="n", out="n2",
+                                             n_workers=4, chunk_size=3),
+                             df.sink(result.append, args="n2")))
+    assert result == [n*n for n in range(10)]
+
+
+def test_parallel_map_stopped_by_slice():
+    result = []
+    df.push(source = range(20),
+            pipe   = df.pipe(df.slice(5, close_all=True),
+                             df.map(lambda n: dict(n=n)),
+                             df.parallel_map(lambda n: n*n, args="n", out="n2",
+                                             n_workers=2, chunk_size=3),
+                             df.sink(result.append, args="n2")))
+    assert result == [0, 1, 4, 9, 16]
+
+
 def test_pipe():
 
     # The basic syntax requires any element of a pipeline to be passed
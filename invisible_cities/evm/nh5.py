@@ -122,6 +122,36 @@ class S2Si(tb.IsDescription):
     ene   = tb.Float32Col(pos=5) # energy in pes
 
 
+class PMapEvent(tb.IsDescription):
+    """Event index of the compact pmap format.
+    The peaks of the event are rows [first_peak, first_peak + n_peaks)
+    of the PMapPeak table.
+    """
+    event      = tb. Int32Col(pos=0)
+    first_peak = tb.UInt64Col(pos=1)
+    n_peaks    = tb.UInt16Col(pos=2)
+
+
+class PMapPeak(tb.IsDescription):
+    """Peak descriptor of the compact pmap format.
+    Each peak is stored as contiguous blocks in the sample arrays:
+    n_samples times and bin widths starting at sample_start,
+    n_pmts  pmt  ids starting at pmt_start  and n_pmts  x n_samples
+    energies starting at pmt_wf_start, and the same for sipms.
+    """
+    event         = tb. Int32Col(pos= 0)
+    peak          = tb. UInt8Col(pos= 1) # peak number within its signal type
+    signal_type   = tb. UInt8Col(pos= 2) # 1 for S1, 2 for S2
+    n_samples     = tb.UInt32Col(pos= 3)
+    n_pmts        = tb.UInt16Col(pos= 4)
+    n_sipms       = tb.UInt16Col(pos= 5)
+    sample_start  = tb.UInt64Col(pos= 6)
+    pmt_start     = tb.UInt64Col(pos= 7)
+    pmt_wf_start  = tb.UInt64Col(pos= 8)
+    sipm_start    = tb.UInt64Col(pos= 9)
+    sipm_wf_start = tb.UInt64Col(pos=10)
+
+
 class KrTable(tb.IsDescription):
     event   = tb.  Int32Col(pos= 0)
     time    = tb.Float64Col(pos= 1)
@@ -9,6 +9,29 @@ from .. core.core_functions  import weighted_mean_and_std
 from .. types.ic_types       import      AutoNameEnumBase
 
 
+class _cached_property:
+    """
+    Read-only attribute computed on first access and cached in the
+    instance.
+    """
+    def __init__(self, method):
+        self.method  = method
+        self.__doc__ = method.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        cache = instance.__dict__
+        name  = self.method.__name__
+        if name not in cache:
+            cache[name] = self.method(instance)
+        return cache[name]
+
+    def __set__(self, instance, value):
+        raise AttributeError(f"can't set attribute {self.method.__name__}")
+
+
 class SiPMCharge(AutoNameEnumBase):
     raw             = auto()
     signal_to_noise = auto()
@@ -39,13 +62,31 @@ class _Peak:
         self.pmts       = pmts
         self.sipms      = sipms
 
-        i_max                   = np.argmax(self.pmts.sum_over_sensors)
-        self.time_at_max_energy = self.times[i_max]
-        self.height             = np.max(self.pmts.sum_over_sensors)
-        self.total_energy       = self.energy_above_threshold(0)
-        self.total_charge       = self.charge_above_threshold(0)
-        self.width              = self. width_above_threshold(0)
-        self.rms                = self.   rms_above_threshold(0)
+    # Peak properties are only computed when requested, as
+    # many peaks are discarded or rebinned before they are used.
+    @_cached_property
+    def time_at_max_energy(self):
+        return self.times[np.argmax(self.pmts.sum_over_sensors)]
+
+    @_cached_property
+    def height(self):
+        return np.max(self.pmts.sum_over_sensors)
+
+    @_cached_property
+    def total_energy(self):
+        return self.energy_above_threshold(0)
+
+    @_cached_property
+    def total_charge(self):
+        return self.charge_above_threshold(0)
+
+    @_cached_property
+    def width(self):
+        return self.width_above_threshold(0)
+
+    @_cached_property
+    def rms(self):
+        return self.rms_above_threshold(0)
 
     def energy_above_threshold(self, thr):
         i_above_thr  = self.pmts.where_above_threshold(thr)
@@ -140,10 +181,18 @@ class _SensorResponses:
 
         self.ids              = np.array(ids, copy=False, ndmin=1)
         self.all_waveforms    = np.array(wfs, copy=False, ndmin=2)
-        self.sum_over_sensors = np.sum(self.all_waveforms, axis=0)
-        self.sum_over_times   = np.sum(self.all_waveforms, axis=1)
 
-        self._wfs_dict        = dict(zip(self.ids, self.all_waveforms))
+    @_cached_property
+    def sum_over_sensors(self):
+        return np.sum(self.all_waveforms, axis=0)
+
+    @_cached_property
+    def sum_over_times(self):
+        return np.sum(self.all_waveforms, axis=1)
+
+    @_cached_property
+    def _wfs_dict(self):
+        return dict(zip(self.ids, self.all_waveforms))
 
     def waveform(self, sensor_id):
         return self._wfs_dict[sensor_id]
@@ -192,6 +192,45 @@ def test_Peak_width_correct():
     assert peak.width == nsamples
 
 
+@given(peaks())
+def test_Peak_properties_are_computed_on_first_access(pks):
+    _, peak = pks
+    properties = ("time_at_max_energy", "height", "total_energy",
+                  "total_charge", "width", "rms")
+    assert not set(properties) & set(vars(peak))
+
+    height = peak.height
+    assert "height" in vars(peak)
+    assert peak.height is height
+    assert not set(properties[2:]) & set(vars(peak))
+
+
+@given(peaks())
+def test_Peak_properties_are_read_only(pks):
+    _, peak = pks
+    with raises(AttributeError):
+        peak.height = 0
+    with raises(AttributeError):
+        peak.pmts.sum_over_sensors = 0
+    assert peak.height == np.max(peak.pmts.sum_over_sensors)
+
+
+class _EagerPeak:
+    # Previous implementation, where all the properties of the peak
+    # and of its sensor responses were computed when it was built.
+    # Used as reference in benchmarks.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for responses in (self.pmts, self.sipms):
+            responses.sum_over_sensors, responses.sum_over_times, responses._wfs_dict
+        (self.time_at_max_energy, self.height, self.total_energy,
+         self.total_charge      , self.width , self.rms         )
+
+
+class EagerS1(_EagerPeak, S1): pass
+class EagerS2(_EagerPeak, S2): pass
+
+
 def _get_indices_above_thr(sr, thr):
     return np.where(sr.sum_over_sensors > thr)[0]
 
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class SparseWfs:
+    """
+    Zero-suppressed waveforms of a set of sensors, stored row by row
+    (compressed sparse row format): the samples kept for sensor `i`
+    are at times `indices[indptr[i]:indptr[i+1]]` (in increasing
+    order), with values `values[indptr[i]:indptr[i+1]]` in single
+    precision. All other samples are zero.
+    """
+    def __init__(self, indptr, indices, values, n_samples):
+        self.indptr  = np.asarray(indptr , dtype=np.int64  )
+        self.indices = np.asarray(indices, dtype=np.int32  )
+        self.values  = np.asarray(values , dtype=np.float32)
+        self.shape   = len(self.indptr) - 1, int(n_samples)
+
+    @classmethod
+    def from_mask(cls, wfs, mask, n_samples=None, samples=None):
+        """
+        Keep the values of `wfs` where `mask` is True. The columns of
+        `wfs` are the samples given by `samples` (all of them by
+        default) of waveforms with `n_samples` samples.
+        """
+        n_rows, n_cols = wfs.shape
+        n_samples      = n_cols if n_samples is None else n_samples
+
+        # The flat positions are much faster to find than the
+        # (row, column) pairs and come in the same order
+        flat          = np.flatnonzero(mask)
+        rows, indices = np.divmod(flat, n_cols)
+        indptr        = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+
+        if samples is not None:
+            indices = np.asarray(samples)[indices]
+        return cls(indptr, indices, np.ravel(wfs).take(flat), n_samples)
+
+    @classmethod
+    def from_dense(cls, wfs):
+        wfs = np.asarray(wfs)
+        return cls.from_mask(wfs, wfs != 0)
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    def rows(self):
+        """Sensor (row) of each stored value."""
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def to_dense(self):
+        wfs = np.zeros(self.shape, dtype=np.float32)
+        wfs[self.rows(), self.indices] = self.values
+        return wfs
+
+    def rebinned_window(self, start, stop, rebin_stride=1, all_sensors=False):
+        """
+        Samples in [start, stop) merged in groups of `rebin_stride`
+        as in `peak_functions.rebin_times_and_waveforms`. Returns
+        the sensor ids and their (dense, double precision) rebinned
+        waveforms: all sensors if `all_sensors`, otherwise only those
+        with some sample in the window.
+        """
+        stop      = min(stop, self.shape[1])
+        start     = min(start, stop)
+        stride    = max(rebin_stride, 1)
+        n_bins    = -(-(stop - start) // stride)
+        in_window = (self.indices >= start) & (self.indices < stop)
+        rows      = self.rows()[in_window]
+        bins      = (self.indices[in_window] - start) // stride
+
+        if all_sensors:
+            ids = np.arange(self.shape[0])
+        else:
+            present = np.bincount(rows, minlength=self.shape[0]) > 0
+            ids     = np.flatnonzero(present)
+            rows    = np.cumsum(present)[rows] - 1
+
+        wfs = np.bincount(rows * n_bins + bins,
+                          weights   = self.values[in_window],
+                          minlength = len(ids) * n_bins)
+        return ids, wfs.reshape(len(ids), n_bins)
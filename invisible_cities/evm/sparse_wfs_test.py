@@ -0,0 +1,68 @@
+import numpy as np
+
+from numpy.testing import assert_allclose
+from numpy.testing import assert_array_equal
+from pytest        import mark
+
+from hypothesis                import given
+from hypothesis.strategies     import integers
+from hypothesis.strategies     import floats
+from hypothesis.strategies     import composite
+from hypothesis.extra.numpy    import arrays
+
+from .. reco.peak_functions import rebin_times_and_waveforms
+from .  sparse_wfs          import SparseWfs
+
+
+@composite
+def sparse_wfs(draw):
+    n_sensors = draw(integers(1, 10))
+    n_samples = draw(integers(1, 50))
+    values    = draw(arrays(np.float32, (n_sensors, n_samples),
+                            elements=floats(-10, 100, width=32)))
+    keep      = draw(arrays(bool      , (n_sensors, n_samples)))
+    return np.where(keep, values, 0)
+
+
+@given(sparse_wfs())
+def test_sparse_wfs_to_dense_recovers_wfs(wfs):
+    sparse = SparseWfs.from_dense(wfs)
+    assert sparse.shape == wfs.shape
+    assert sparse.nnz   == np.count_nonzero(wfs)
+    assert_array_equal(sparse.to_dense(), wfs)
+
+
+def test_sparse_wfs_from_mask_with_samples():
+    wfs     = np.array([[1, 2, 3],
+                        [4, 5, 6]], dtype=np.float32)
+    mask    = np.array([[True, False,  True],
+                        [False, False, True]])
+    samples = np.array([2, 5, 7])
+    sparse  = SparseWfs.from_mask(wfs, mask, n_samples=10, samples=samples)
+
+    expected       = np.zeros((2, 10), dtype=np.float32)
+    expected[0, 2] = 1
+    expected[0, 7] = 3
+    expected[1, 7] = 6
+    assert_array_equal(sparse.indptr, [0, 2, 3])
+    assert_array_equal(sparse.to_dense(), expected)
+
+
+@mark.parametrize("all_sensors", (False, True))
+@given(wfs   = sparse_wfs(),
+       start = integers(0, 50),
+       size  = integers(1, 60),
+       rebin = integers(0, 7))
+def test_sparse_wfs_rebinned_window_equals_dense(all_sensors, wfs, start, size, rebin):
+    stop        = start + size
+    sparse      = SparseWfs.from_dense(wfs)
+    ids, window = sparse.rebinned_window(start, stop, rebin, all_sensors=all_sensors)
+
+    times       = np.arange(wfs.shape[1])[start:stop]
+    _, _, dense = rebin_times_and_waveforms(times, times, wfs[:, start:stop].astype(np.float64), rebin)
+    if not all_sensors:
+        assert np.all(np.any(wfs[ids, start:stop], axis=1))
+        assert np.count_nonzero(np.any(wfs[:, start:stop], axis=1)) == len(ids)
+
+    assert window.shape == (len(ids), dense.shape[1])
+    assert_allclose(window, dense[ids])
@@ -2,6 +2,7 @@ from argparse  import Namespace
 from functools import partial
 from textwrap  import dedent
 from typing    import Sequence
+from typing    import List
 
 import numpy as np
 
@@ -63,6 +64,69 @@ class S12SelectorOutput:
     __repr__ = __str__
 
 
+class PeakSummaries:
+    """
+    Columnar summary of the peaks of a batch of events, as used
+    by the S12Selector.
+
+    It contains, with one entry per peak, in event order:
+        - energy: energy above threshold.
+        - width : width  above threshold.
+        - height: height of the peak.
+        - nsipm : number of sipms in the peak.
+    and the number of peaks of each event in `n_peaks`.
+    """
+    def __init__(self,
+                 n_peaks : np.ndarray,
+                 energy  : np.ndarray,
+                 width   : np.ndarray,
+                 height  : np.ndarray,
+                 nsipm   : np.ndarray):
+        self.n_peaks = n_peaks
+        self.energy  = energy
+        self.width   = width
+        self.height  = height
+        self.nsipm   = nsipm
+
+    @property
+    def event(self) -> np.ndarray:
+        """Index of the event of each peak."""
+        return np.repeat(np.arange(self.n_peaks.size), self.n_peaks)
+
+    def split(self, peak_values : np.ndarray) -> List[np.ndarray]:
+        """Split an array with one entry per peak into events."""
+        return np.split(peak_values, np.cumsum(self.n_peaks)[:-1])
+
+
+def summarize_peaks(peaks_per_event : Sequence[Sequence[_Peak]],
+                    thr             : float) -> PeakSummaries:
+    """
+    Computes the summary of the peaks of each event. The peaks
+    of all events are concatenated and reduced at once.
+    """
+    n_peaks = np.array(list(map(len, peaks_per_event)), dtype=int)
+    peaks   = [peak for peaks in peaks_per_event for peak in peaks]
+    if not peaks:
+        empty = np.empty(0)
+        return PeakSummaries(n_peaks, empty, empty, empty, np.empty(0, dtype=int))
+
+    n_samples = [peak.times.size for peak in peaks]
+    starts    = np.cumsum([0] + n_samples[:-1])
+    energies  = np.concatenate([peak.pmts.sum_over_sensors for peak in peaks])
+    widths    = np.concatenate([peak.bin_widths            for peak in peaks])
+    above_thr = energies > thr
+
+    return PeakSummaries(n_peaks,
+                         energy = np.add    .reduceat(np.where(above_thr, energies, 0), starts),
+                         width  = np.add    .reduceat(np.where(above_thr, widths  , 0), starts),
+                         height = np.maximum.reduceat(energies, starts),
+                         nsipm  = np.array([peak.sipms.ids.size for peak in peaks]))
+
+
+def _contains(interval : minmax, x : np.ndarray) -> np.ndarray:
+    return (interval.min <= x) & (x <= interval.max)
+
+
 class S12Selector:
     def __init__(self, **kwds):
         conf = Namespace(**kwds)
@@ -97,6 +161,22 @@ class S12Selector:
             f4 = nsipm.contains(peak.sipms.ids.size)
         return f1 and f2 and f3 and f4
 
+    @staticmethod
+    def valid_summaries(summaries : PeakSummaries,
+                        energy    : minmax,
+                        width     : minmax,
+                        height    : minmax,
+                        nsipm     : minmax = None) -> np.ndarray:
+        """Vectorized version of `valid_peak`. Returns a boolean
+        mask with the outcome of the filter for each peak in the
+        summaries."""
+        valid = (_contains(energy, summaries.energy) &
+                 _contains(width , summaries.width ) &
+                 _contains(height, summaries.height))
+        if nsipm:
+            valid &= _contains(nsipm, summaries.nsipm)
+        return valid
+
     @staticmethod
     def select_valid_peaks(peaks  : Sequence[_Peak],
                            thr    : float,
@@ -117,6 +197,20 @@ class S12Selector:
         valid_peaks   = tuple(map(peak_is_valid, peaks))
         return valid_peaks
 
+    def select_s1_summaries(self, s1s : PeakSummaries) -> np.ndarray:
+        """
+        Takes the summaries of a batch of S1s and returns a mask
+        with the outcome of the filter for each peak.
+        """
+        return self.valid_summaries(s1s, self.s1e, self.s1w, self.s1h)
+
+    def select_s2_summaries(self, s2s : PeakSummaries) -> np.ndarray:
+        """
+        Takes the summaries of a batch of S2s and returns a mask
+        with the outcome of the filter for each peak.
+        """
+        return self.valid_summaries(s2s, self.s2e, self.s2w, self.s2h, self.nsi)
+
     def select_s1(self, s1s : Sequence[_Peak]) -> Sequence[bool]:
         """
         Takes a sequence of S1s and returns a sequence with the
@@ -161,6 +255,38 @@ class S12Selector:
     __repr__ = __str__
 
 
+def select_events(selector : S12Selector,
+                  s1s      : PeakSummaries,
+                  s2s      : PeakSummaries):
+    """Filters the peaks of a batch of events given their summaries.
+    Returns a boolean flag for each event indicating whether it
+    has passed the filter and the masks of selected S1s and S2s,
+    with one entry per peak."""
+    s1_peaks = selector.select_s1_summaries(s1s)
+    s2_peaks = selector.select_s2_summaries(s2s)
+
+    n_events = s1s.n_peaks.size
+    n_s1     = np.bincount(s1s.event, weights=s1_peaks, minlength=n_events)
+    n_s2     = np.bincount(s2s.event, weights=s2_peaks, minlength=n_events)
+    passed   = _contains(selector.s1n, n_s1) & _contains(selector.s2n, n_s2)
+    return passed, s1_peaks, s2_peaks
+
+
+def pmaps_filter(selector : S12Selector,
+                 pmaps    : Sequence[PMap]) -> List[S12SelectorOutput]:
+    """Batch version of `pmap_filter`, giving the same output for
+    each pmap. The peaks of all pmaps are summarized and filtered
+    at once, which pays off for batches of more than a few events."""
+    s1s = summarize_peaks([pmap.s1s for pmap in pmaps], selector.s1_ethr)
+    s2s = summarize_peaks([pmap.s2s for pmap in pmaps], selector.s2_ethr)
+
+    passed, s1_peaks, s2_peaks = select_events(selector, s1s, s2s)
+    return [S12SelectorOutput(bool(ok), tuple(s1_mask), tuple(s2_mask))
+            for ok, s1_mask, s2_mask in zip(passed,
+                                            s1s.split(s1_peaks),
+                                            s2s.split(s2_peaks))]
+
+
 def pmap_filter(selector : S12Selector,
                 pmap     : PMap) -> S12SelectorOutput:
     """Takes the event pmaps
@@ -5,16 +5,25 @@ from hypothesis             import given
 from hypothesis.strategies  import lists
 from hypothesis.strategies  import integers
 from hypothesis.strategies  import booleans
+from hypothesis.strategies  import floats
 from hypothesis.strategies  import composite
+from pytest                 import approx
+from pytest                 import mark
 
 from .. evm.pmaps   import  PMTResponses
 from .. evm.pmaps   import SiPMResponses
 from .. evm.pmaps   import S1
 from .. evm.pmaps   import S2
 from .. evm.pmaps   import PMap
+from .. evm.pmaps_test import pmaps
+from .. evm.pmaps_test import EagerS1
+from .. evm.pmaps_test import EagerS2
+from .. core.testing_utils import execution_time
 from .  s1s2_filter import S12SelectorOutput
 from .  s1s2_filter import S12Selector
 from .  s1s2_filter import pmap_filter
+from .  s1s2_filter import pmaps_filter
+from .  s1s2_filter import summarize_peaks
 
 
 @composite
@@ -229,3 +238,78 @@ def test_pmap_filter(selector_conf,
     assert       filter_output.passed    ==       truth.passed
     assert tuple(filter_output.s1_peaks) == tuple(truth.s1_peaks)
     assert tuple(filter_output.s2_peaks) == tuple(truth.s2_peaks)
+
+
+@given(lists(pmaps(), max_size=5), floats(0, 50))
+def test_summarize_peaks(pmaps, thr):
+    peaks_per_event = [pmap.s2s for _, pmap in pmaps]
+    summaries       = summarize_peaks(peaks_per_event, thr)
+    peaks           = [peak for peaks in peaks_per_event for peak in peaks]
+
+    assert summaries.n_peaks == approx(list(map(len, peaks_per_event)))
+    assert summaries.energy  == approx([peak.energy_above_threshold(thr) for peak in peaks])
+    assert summaries.width   == approx([peak. width_above_threshold(thr) for peak in peaks])
+    assert summaries.height  == approx([peak.height                      for peak in peaks])
+    assert summaries.nsipm   == approx([peak.sipms.ids.size              for peak in peaks])
+
+
+@given(lists(pmaps(), max_size=5))
+def test_pmaps_filter_same_as_peak_by_peak(pmaps):
+    conf     = dict(s1_nmin     = 0, s1_nmax     =    2, s1_ethr = 10,
+                    s1_emin     = 0, s1_emax     =  200,
+                    s1_wmin     = 0, s1_wmax     =  500,
+                    s1_hmin     = 0, s1_hmax     =  100,
+                    s2_nmin     = 1, s2_nmax     =    3, s2_ethr = 10,
+                    s2_emin     = 0, s2_emax     = 1000,
+                    s2_wmin     = 0, s2_wmax     =  800,
+                    s2_hmin     = 0, s2_hmax     =  300,
+                    s2_nsipmmin = 2, s2_nsipmmax =    4)
+    selector = S12Selector(**conf)
+    pmaps    = [pmap for _, pmap in pmaps]
+    outputs  = pmaps_filter(selector, pmaps)
+
+    assert len(outputs) == len(pmaps)
+    for output, pmap in zip(outputs, pmaps):
+        s1_peaks = [S12Selector.valid_peak(s1, selector.s1_ethr, selector.s1e,
+                                           selector.s1w, selector.s1h)
+                    for s1 in pmap.s1s]
+        s2_peaks = [S12Selector.valid_peak(s2, selector.s2_ethr, selector.s2e,
+                                           selector.s2w, selector.s2h, selector.nsi)
+                    for s2 in pmap.s2s]
+        passed   = (selector.s1n.contains(np.count_nonzero(s1_peaks)) and
+                    selector.s2n.contains(np.count_nonzero(s2_peaks)))
+
+        assert       output.passed    ==       passed
+        assert tuple(output.s1_peaks) == tuple(s1_peaks)
+        assert tuple(output.s2_peaks) == tuple(s2_peaks)
+
+
+@mark.benchmark
+def test_pmap_filter_faster_than_with_eager_peaks(selector_conf):
+    # Like Penthesilea: the peaks are built when the pmaps are read
+    # and then classified
+    rng  = np.random.default_rng(28)
+    data = []
+    for _ in range(50):
+        s1s = [(np.arange(10.), np.ones(10), rng.uniform(0, 1, size=(12, 10)))
+               for _ in range(10)]
+        s2s = [(np.arange(40.), np.ones(40), rng.uniform(0, 30, size=(12, 40)),
+                rng.choice(1792, size=50, replace=False), rng.uniform(0, 5, size=(50, 40)))
+               for _ in range(2)]
+        data.append((s1s, s2s))
+
+    def classify(S1, S2):
+        selector = S12Selector(**selector_conf)
+        for s1s, s2s in data:
+            pmap = PMap([S1(times, widths, PMTResponses(np.arange(12), wfs),
+                            SiPMResponses.build_empty_instance())
+                         for times, widths, wfs in s1s],
+                        [S2(times, widths, PMTResponses(np.arange(12), pmt_wfs),
+                            SiPMResponses(sipm_ids, sipm_wfs))
+                         for times, widths, pmt_wfs, sipm_ids, sipm_wfs in s2s])
+            pmap_filter(selector, pmap)
+
+    lazy  = execution_time(classify,      S1,      S2)
+    eager = execution_time(classify, EagerS1, EagerS2)
+    print(f"pmap building and selection: {lazy * 1e3:.1f} ms, with eager peaks: {eager * 1e3:.1f} ms")
+    assert lazy < eager
@@ -3,7 +3,7 @@ from .. evm.nh5  import KrTable
 from .. evm.nh5  import PSFfactors
 
 
-def kr_writer(hdf5_file, *, compression='ZLIB4'):
+def _make_kr_table(hdf5_file, compression):
     kr_table = make_table(hdf5_file,
                           group       = 'DST',
                           name        = 'Events',
@@ -12,12 +12,28 @@ def kr_writer(hdf5_file, *, compression='ZLIB4'):
                           compression = compression)
     # Mark column to index after populating table
     kr_table.set_attr('columns_to_index', ['event'])
+    return kr_table
+
+
+def kr_writer(hdf5_file, *, compression='ZLIB4'):
+    kr_table = _make_kr_table(hdf5_file, compression)
 
     def write_kr(kr_event):
         kr_event.store(kr_table)
     return write_kr
 
 
+def kr_rows_writer(hdf5_file, *, compression='ZLIB4'):
+    """Same as kr_writer, but takes structured arrays of KrTable
+    rows, as given by `dst_functions.build_kr_dst`, and appends
+    them in a single call."""
+    kr_table = _make_kr_table(hdf5_file, compression)
+
+    def write_kr_rows(rows):
+        kr_table.append(rows)
+    return write_kr_rows
+
+
 def psf_writer(hdf5_file, **kwargs):
     psf_table = make_table(hdf5_file,
                            group       = "PSF",
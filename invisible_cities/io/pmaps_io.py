@@ -1,4 +1,5 @@
-from functools import partial
+from functools       import partial
+from collections.abc import Mapping
 
 import numpy  as np
 import tables as tb
@@ -10,40 +11,43 @@ from .. evm .pmaps         import S1
 from .. evm .pmaps         import S2
 from .. evm .pmaps         import PMap
 from .. evm                import nh5     as table_formats
+from .. core.exceptions    import InvalidInputFileStructure
 from .. reco.tbl_functions import filters as tbl_filters
 
 
+DEFAULT_CHUNK_SIZE = 1000000
+
+
+def _rows(table, n_rows, **columns):
+    rows = np.empty(n_rows, dtype=table.dtype)
+    for name, values in columns.items():
+        rows[name] = values
+    return rows
+
+
 def store_peak(pmt_table, pmti_table, si_table,
                peak, peak_number, event_number):
-    pmt_row  =  pmt_table.row
-    pmti_row = pmti_table.row
-
-    for i, t in enumerate(peak.times):
-        pmt_row['event' ] = event_number
-        pmt_row['peak'  ] = peak_number
-        pmt_row['time'  ] = t
-        pmt_row['bwidth'] = peak.bin_widths[i]
-        pmt_row['ene'   ] = peak.pmts.sum_over_sensors[i]
-        pmt_row.append()
-
-    for pmt_id in peak.pmts.ids:
-        for e in peak.pmts.waveform(pmt_id):
-            pmti_row['event'] = event_number
-            pmti_row['peak' ] =  peak_number
-            pmti_row['npmt' ] = pmt_id
-            pmti_row['ene'  ] = e
-            pmti_row.append()
+    n_samples = peak.times.size
+    pmt_table .append(_rows(pmt_table, n_samples,
+                            event  = event_number,
+                            peak   = peak_number,
+                            time   = peak.times,
+                            bwidth = peak.bin_widths,
+                            ene    = peak.pmts.sum_over_sensors))
+
+    pmti_table.append(_rows(pmti_table, peak.pmts.all_waveforms.size,
+                            event  = event_number,
+                            peak   = peak_number,
+                            npmt   = np.repeat(peak.pmts.ids, n_samples),
+                            ene    = peak.pmts.all_waveforms.flatten()))
 
     if si_table is None: return
 
-    si_row = si_table.row
-    for sipm_id in peak.sipms.ids:
-        for q in peak.sipms.waveform(sipm_id):
-            si_row['event'] = event_number
-            si_row['peak' ] =  peak_number
-            si_row['nsipm'] = sipm_id
-            si_row['ene'  ] = q
-            si_row.append()
+    si_table  .append(_rows(si_table, peak.sipms.ids.size * n_samples,
+                            event  = event_number,
+                            peak   = peak_number,
+                            nsipm  = np.repeat(peak.sipms.ids, n_samples),
+                            ene    = peak.sipms.all_waveforms.flatten()))
 
 
 def store_pmap(tables, pmap, event_number):
@@ -54,11 +58,89 @@ def store_pmap(tables, pmap, event_number):
         store_peak(s2_table, s2i_table, si_table, s2, peak_number, event_number)
 
 
-def pmap_writer(file, *, compression="ZLIB4"):
+def pmap_writer(file, *, compression="ZLIB4", compact=False):
+    if compact:
+        tables = _make_compact_tables(file, compression=compression)
+        return partial(store_pmap_compact, tables)
+
     tables = _make_tables(file, compression=compression)
     return partial(store_pmap, tables)
 
 
+def store_pmap_compact(tables, pmap, event_number):
+    """
+    Store a PMap in the compact format: one descriptor row per
+    peak, the peak samples appended as contiguous blocks to the
+    sample arrays and one row in the event index. Each array is
+    appended to once per event. As in the table format, events
+    without peaks are not stored.
+    """
+    (events, peaks,
+     times, widths,
+     pmt_ids, pmt_wfs, sipm_ids, sipm_wfs) = tables
+
+    all_peaks  = list(pmap.s1s) + list(pmap.s2s)
+    if not all_peaks: return
+
+    types      = [1] * len(pmap.s1s) + [2] * len(pmap.s2s)
+    numbers    = list(range(len(pmap.s1s))) + list(range(len(pmap.s2s)))
+    n_samples  = np.array([peak.times      .size for peak in all_peaks], dtype=np.int64)
+    n_pmts     = np.array([peak.pmts .ids  .size for peak in all_peaks], dtype=np.int64)
+    n_sipms    = np.array([peak.sipms.ids  .size for peak in all_peaks], dtype=np.int64)
+
+    def starts(array, sizes):
+        return array.nrows + np.cumsum(sizes) - sizes
+
+    peaks.append(_rows(peaks, len(all_peaks),
+                       event         = event_number,
+                       peak          = numbers,
+                       signal_type   = types,
+                       n_samples     = n_samples,
+                       n_pmts        = n_pmts,
+                       n_sipms       = n_sipms,
+                       sample_start  = starts(times   , n_samples          ),
+                       pmt_start     = starts(pmt_ids , n_pmts             ),
+                       pmt_wf_start  = starts(pmt_wfs , n_pmts  * n_samples),
+                       sipm_start    = starts(sipm_ids, n_sipms            ),
+                       sipm_wf_start = starts(sipm_wfs, n_sipms * n_samples)))
+
+    events.append(_rows(events, 1,
+                        event      = event_number,
+                        first_peak = peaks.nrows - len(all_peaks),
+                        n_peaks    = len(all_peaks)))
+
+    def concatenate(arrays, dtype):
+        arrays = list(arrays)
+        return np.concatenate(arrays).astype(dtype) if arrays else np.empty(0, dtype)
+
+    times   .append(concatenate((peak.times                       for peak in all_peaks), times   .dtype))
+    widths  .append(concatenate((peak.bin_widths                  for peak in all_peaks), widths  .dtype))
+    pmt_ids .append(concatenate((peak.pmts .ids                   for peak in all_peaks), pmt_ids .dtype))
+    pmt_wfs .append(concatenate((peak.pmts .all_waveforms.ravel() for peak in all_peaks), pmt_wfs .dtype))
+    sipm_ids.append(concatenate((peak.sipms.ids                   for peak in all_peaks), sipm_ids.dtype))
+    sipm_wfs.append(concatenate((peak.sipms.all_waveforms.ravel() for peak in all_peaks), sipm_wfs.dtype))
+
+
+def _make_compact_tables(hdf5_file, *, compression="ZLIB4"):
+    compr       = tbl_filters(compression)
+    pmaps_group = hdf5_file.create_group(hdf5_file.root, 'PMAPS')
+    make_table  = partial(hdf5_file.create_table , pmaps_group, filters=compr)
+    make_array  = partial(hdf5_file.create_earray, pmaps_group, filters=compr, shape=(0,))
+
+    events   = make_table('Events'  , table_formats.PMapEvent,         "Event index")
+    peaks    = make_table('Peaks'   , table_formats.PMapPeak ,    "Peak descriptors")
+    times    = make_array('Times'   , tb.Float32Atom(), title=       "Sample times")
+    widths   = make_array('Widths'  , tb.Float32Atom(), title=  "Sample bin widths")
+    pmt_ids  = make_array('PmtIds'  , tb.  Int16Atom(), title=            "Pmt ids")
+    pmt_wfs  = make_array('PmtWfs'  , tb.Float32Atom(), title=    "Pmt waveforms")
+    sipm_ids = make_array('SipmIds' , tb.  Int16Atom(), title=           "SiPM ids")
+    sipm_wfs = make_array('SipmWfs' , tb.Float32Atom(), title=   "SiPM waveforms")
+
+    # Mark column to be indexed
+    events.set_attr('columns_to_index', ['event'])
+    return events, peaks, times, widths, pmt_ids, pmt_wfs, sipm_ids, sipm_wfs
+
+
 def _make_tables(hdf5_file, *, compression="ZLIB4"):
     compr       = tbl_filters(compression)
     pmaps_group = hdf5_file.create_group(hdf5_file.root, 'PMAPS')
@@ -89,14 +171,20 @@ def load_pmaps_as_df(filename):
                 to_df(pmap.S2Pmt.read()) if 'S2Pmt' in pmap else None)
 
 
-# Hack fix to allow loading pmaps without individual pmts. Used in load_pmaps
+# Hack fix to allow loading pmaps without individual pmts.
+# Used in load_pmaps_dfs_to_dict
 def _build_ipmtdf_from_sumdf(sumdf):
     ipmtdf = sumdf.copy()
     ipmtdf = ipmtdf.rename(index=str, columns={'time': 'npmt'})
     ipmtdf['npmt'] = -1
     return ipmtdf
 
-def load_pmaps(filename):
+
+def load_pmaps_dfs_to_dict(filename):
+    """
+    Pandas-based implementation of `load_pmaps`. Slow, but kept
+    as a reference for the array-based one.
+    """
     pmap_dict = {}
     s1df, s2df, sidf, s1pmtdf, s2pmtdf = load_pmaps_as_df(filename)
     # Hack fix to allow loading pmaps without individual pmts
@@ -141,23 +229,463 @@ def load_pmaps(filename):
     return pmap_dict
 
 
+def read_pmap_tables(h5f, start=None, stop=None):
+    """
+    Read rows [start, stop) of the five pmap tables as structured
+    arrays. The individual pmt tables are None if not present.
+    """
+    pmap = h5f.root.PMAPS
+    def read(name):
+        return getattr(pmap, name).read(start, stop) if name in pmap else None
+    return tuple(map(read, ("S1", "S2", "S2Si", "S1Pmt", "S2Pmt")))
+
+
+def load_pmaps(filename):
+    """
+    Read all the pmaps in a file. Returns a mapping from event
+    number to PMap. The tables are read in bulk and the PMap of
+    each event is built when it is accessed. Both the table and
+    the compact formats are supported.
+    """
+    with tb.open_file(filename, 'r') as h5f:
+        pmap = h5f.root.PMAPS
+        if is_compact(pmap):
+            return read_compact_pmaps(pmap)
+        return PMapTables(*read_pmap_tables(h5f))
+
+
+def read_pmap(h5f, event_number):
+    """
+    Read the PMap of a single event, selecting its rows by event
+    number instead of reading the whole file. Raises KeyError if
+    the event is not in the file.
+    """
+    pmap      = h5f.root.PMAPS
+    condition = "event == {}".format(int(event_number))
+    if is_compact(pmap):
+        index = pmap.Events.read_where(condition)
+        if not len(index):
+            raise KeyError(event_number)
+        first = int(index["first_peak"][0])
+        pmaps = read_compact_pmaps(pmap, first, first + int(index["n_peaks"][0]))
+    else:
+        def read(name):
+            return getattr(pmap, name).read_where(condition) if name in pmap else None
+        pmaps = PMapTables(*map(read, ("S1", "S2", "S2Si", "S1Pmt", "S2Pmt")))
+    return pmaps[event_number]
+
+
+def _event_blocks(table, chunk_size):
+    """
+    Find the contiguous blocks of rows belonging to the same event
+    reading only the event column, `chunk_size` rows at a time.
+    Returns the event number of each block along with its first
+    and last+1 row.
+    """
+    events, starts = [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=int)]
+    previous_event = None
+    for start in range(0, table.nrows, chunk_size):
+        event         = table.read(start, start + chunk_size, field="event")
+        new_block     = np.ones(len(event), dtype=bool)
+        new_block[1:] = event[1:] != event[:-1]
+        if previous_event is not None:
+            new_block[0] = event[0] != previous_event
+
+        events.append(event[new_block])
+        starts.append(np.flatnonzero(new_block) + start)
+        previous_event = event[-1]
+
+    events = np.concatenate(events)
+    starts = np.concatenate(starts)
+    stops  = np.append(starts[1:], table.nrows)
+    return events, starts, stops
+
+
+def _event_row_ranges(event_blocks, event_numbers):
+    """
+    First and last+1 row of each event in `event_numbers` given
+    the event blocks of a table. Events not present in the table
+    get an empty range.
+    """
+    starts_evt = np.zeros(len(event_numbers), dtype=int)
+    stops_evt  = np.zeros(len(event_numbers), dtype=int)
+    events, starts, stops = event_blocks
+    if not len(events):
+        return starts_evt, stops_evt
+
+    if len(events) != len(np.unique(events)):
+        raise InvalidInputFileStructure("Rows of the same event are not contiguous")
+
+    order = np.argsort(events)
+    index = np.searchsorted(events, event_numbers, sorter=order)
+    index = order[np.clip(index, 0, len(events) - 1)]
+    found = events[index] == event_numbers
+
+    starts_evt[found] = starts[index[found]]
+    stops_evt [found] = stops [index[found]]
+    return starts_evt, stops_evt
+
+
+def pmaps_in_chunks(h5f, event_numbers, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the PMap of each event in `event_numbers`, in the given
+    order, reading the pmap tables in chunks of whole events. A
+    chunk spans at most `chunk_size` rows of each table, unless a
+    single event is larger than that. Only one chunk is kept in
+    memory at a time. The event boundaries are found, and checked
+    against `event_numbers`, before the first event is read.
+    """
+    pmap          = h5f.root.PMAPS
+    event_numbers = np.asarray(event_numbers)
+    if is_compact(pmap):
+        return _compact_pmaps_in_chunks(pmap, event_numbers, chunk_size)
+
+    tables  = [getattr(pmap, name) if name in pmap else None
+               for name in ("S1", "S2", "S2Si", "S1Pmt", "S2Pmt")]
+    no_rows = np.empty(0, dtype=np.int32), np.empty(0, dtype=int), np.empty(0, dtype=int)
+    blocks  = [no_rows if table is None else _event_blocks(table, chunk_size)
+               for table in tables]
+
+    s1_events, s2_events = blocks[0][0], blocks[1][0]
+    if len(np.union1d(s1_events, s2_events)) != len(event_numbers):
+        raise InvalidInputFileStructure("Input data tables have different sizes")
+
+    ranges = [_event_row_ranges(block, event_numbers) for block in blocks]
+    starts = np.stack([start for start, _ in ranges], axis=1)
+    stops  = np.stack([stop  for _, stop  in ranges], axis=1)
+
+    def read_chunk(chunk_starts, chunk_stops):
+        return PMapTables(*(None if table is None else table.read(start, stop)
+                            for table, start, stop in zip(tables, chunk_starts, chunk_stops)))
+
+    return _pmaps_in_chunks(event_numbers, starts, stops, read_chunk, chunk_size)
+
+
+def _compact_pmaps_in_chunks(pmap, event_numbers, chunk_size):
+    """
+    `pmaps_in_chunks` for the compact format. The peaks of each
+    event are found through the event index, and only the
+    descriptors of the first and last peak of each event are
+    read to plan the chunks, limiting the number of descriptors
+    and of elements of each sample array.
+    """
+    index = pmap.Events.read()
+    if len(index) != len(event_numbers):
+        raise InvalidInputFileStructure("Input data tables have different sizes")
+
+    events = index["event"]
+    order  = np.argsort(events)
+    found  = order[np.searchsorted(events, event_numbers, sorter=order).clip(0, len(events) - 1)]
+    if not np.array_equal(events[found], event_numbers):
+        raise InvalidInputFileStructure("Input data tables have different sizes")
+
+    first_peak = index["first_peak"][found].astype(np.int64)
+    last_peak  = index["n_peaks"   ][found].astype(np.int64) + first_peak - 1
+    has_peaks  = last_peak >= first_peak
+    first_rows = pmap.Peaks.read_coordinates(first_peak[has_peaks])
+    last_rows  = pmap.Peaks.read_coordinates( last_peak[has_peaks])
+
+    starts = [np.where(has_peaks, first_peak    , 0)]
+    stops  = [np.where(has_peaks,  last_peak + 1, 0)]
+    last_blocks = _compact_blocks(last_rows)
+    for name, (array_starts, _) in _compact_blocks(first_rows).items():
+        last_starts, last_sizes = last_blocks[name]
+        starts.append(np.zeros(len(event_numbers), dtype=np.int64))
+        stops .append(np.zeros(len(event_numbers), dtype=np.int64))
+        starts[-1][has_peaks] = array_starts
+        stops [-1][has_peaks] = last_starts + last_sizes
+
+    def read_chunk(chunk_starts, chunk_stops):
+        return read_compact_pmaps(pmap, chunk_starts[0], chunk_stops[0])
+
+    return _pmaps_in_chunks(event_numbers,
+                            np.stack(starts, axis=1),
+                            np.stack(stops , axis=1),
+                            read_chunk, chunk_size)
+
+
+def _pmaps_in_chunks(event_numbers, starts, stops, read_chunk, chunk_size):
+    """
+    Group consecutive events in chunks spanning at most
+    `chunk_size` rows of each table, given the first and last+1
+    row of each event in each table (one column per table).
+    `read_chunk` takes the first and last+1 row of the chunk in
+    each table and returns a mapping from event number to PMap.
+    The span of the chunk is bounded, not only its number of
+    rows, because the rows of consecutive events need not be
+    close to each other when the tables are not written in the
+    order of `event_numbers`.
+    """
+    no_rows  = np.iinfo(int).max
+    has_rows = stops > starts
+    starts   = np.where(has_rows, starts, no_rows)
+    stops    = np.where(has_rows, stops ,       0)
+
+    def pmaps():
+        first        = 0
+        chunk_starts = np.full (starts.shape[1], no_rows)
+        chunk_stops  = np.zeros(starts.shape[1], dtype=int)
+        for last in range(len(event_numbers) + 1):
+            end_of_file = last == len(event_numbers)
+            if not end_of_file:
+                new_starts = np.minimum(chunk_starts, starts[last])
+                new_stops  = np.maximum(chunk_stops ,  stops[last])
+                too_wide   = np.any(new_stops - new_starts > chunk_size)
+
+            if last > first and (end_of_file or too_wide):
+                chunk = read_chunk(np.minimum(chunk_starts, chunk_stops), chunk_stops)
+                for event_number in event_numbers[first:last]:
+                    yield chunk[event_number]
+                first = last
+                if not end_of_file:
+                    new_starts, new_stops = starts[last], stops[last]
+
+            if not end_of_file:
+                chunk_starts, chunk_stops = new_starts, new_stops
+
+    return pmaps()
+
+
+def is_compact(pmap_group):
+    """Whether a PMAPS group is written in the compact format."""
+    return "Peaks" in pmap_group
+
+
+def _compact_blocks(peaks):
+    """
+    First element and size of the block of each peak in each of
+    the sample arrays of the compact format.
+    """
+    n_samples = peaks["n_samples"].astype(np.int64)
+    n_pmts    = peaks["n_pmts"   ].astype(np.int64)
+    n_sipms   = peaks["n_sipms"  ].astype(np.int64)
+    start     = lambda column: peaks[column].astype(np.int64)
+    return dict(Times   = (start("sample_start" ), n_samples          ),
+                Widths  = (start("sample_start" ), n_samples          ),
+                PmtIds  = (start("pmt_start"    ), n_pmts             ),
+                PmtWfs  = (start("pmt_wf_start" ), n_pmts  * n_samples),
+                SipmIds = (start("sipm_start"   ), n_sipms            ),
+                SipmWfs = (start("sipm_wf_start"), n_sipms * n_samples))
+
+
+def read_compact_pmaps(pmap_group, start=None, stop=None):
+    """
+    Read the peak descriptors [start, stop) of a compact pmap
+    group together with the part of each sample array they refer
+    to. Returns a mapping from event number to PMap.
+    """
+    peaks   = pmap_group.Peaks.read(start, stop)
+    arrays  = {}
+    offsets = {}
+    for name, (starts, sizes) in _compact_blocks(peaks).items():
+        first = int(np.min(starts         )) if len(peaks) else 0
+        last  = int(np.max(starts + sizes)) if len(peaks) else 0
+        arrays [name] = getattr(pmap_group, name).read(first, last)
+        offsets[name] = first
+    return CompactPMaps(peaks, arrays, offsets)
+
+
+def _peak_blocks(table):
+    """
+    Find the contiguous blocks of rows belonging to the same
+    (event, peak) pair. Returns the event and peak numbers of
+    each block along with its first and last+1 row.
+    """
+    event = table["event"]
+    peak  = table["peak" ]
+    if not len(event):
+        empty = np.empty(0, dtype=int)
+        return event, peak, empty, empty
+
+    new_block     = np.ones(len(event), dtype=bool)
+    new_block[1:] = (event[1:] != event[:-1]) | (peak[1:] != peak[:-1])
+    starts        = np.flatnonzero(new_block)
+    stops         = np.append(starts[1:], len(event))
+    return event[starts], peak[starts], starts, stops
+
+
+def _bin_widths_from_times(times):
+    ## Old file without bin widths saved
+    ## Calculate 'fake' widths from times
+    time_diff = np.diff(times)
+    if len(time_diff) == 0:
+        return np.full(1, 1000)
+    elif np.all(time_diff == time_diff[0]):
+        ## S1-like
+        return np.full(times.shape, time_diff[0])
+    else:
+        ## S2-like, round to closest mus
+        binw = time_diff.max().round(-3)
+        return np.full(times.shape, binw)
+
+
+class _PeakTable:
+    """
+    Row-range index of the peaks of one signal type (S1 or S2).
+    Holds the sum table, the individual pmt table (or None for
+    old files) and, for S2s, the sipm table.
+    """
+    def __init__(self, sum_table, pmt_table, si_table=None):
+        self.sum_table = sum_table
+        self.pmt_table = pmt_table
+        self.si_table  = si_table
+
+        (events, self.peaks,
+         self.starts, self.stops) = _peak_blocks(sum_table)
+
+        if pmt_table is not None:
+            (pmt_events, pmt_peaks,
+             self.pmt_starts, self.pmt_stops) = _peak_blocks(pmt_table)
+            if not (np.array_equal(pmt_events, events    ) and
+                    np.array_equal(pmt_peaks , self.peaks)):
+                raise InvalidInputFileStructure("Pmap sum and pmt tables do not match")
+
+        if si_table is not None:
+            si_events, si_peaks, si_starts, si_stops = _peak_blocks(si_table)
+            si_keys        = zip(si_events.tolist(), si_peaks.tolist())
+            si_ranges      = zip(si_starts.tolist(), si_stops.tolist())
+            self.si_ranges = dict(zip(si_keys, si_ranges))
+
+        (self.event_numbers,
+         self.first_block  ,
+         self.n_blocks     ) = np.unique(events, return_index  = True,
+                                                 return_counts = True)
+
+    def block_range(self, event_number):
+        i = np.searchsorted(self.event_numbers, event_number)
+        if i == len(self.event_numbers) or self.event_numbers[i] != event_number:
+            return range(0)
+        return range(self.first_block[i], self.first_block[i] + self.n_blocks[i])
+
+    def build_peak(self, peak_type, event_number, block):
+        start, stop = self.starts[block], self.stops[block]
+        rows        = self.sum_table[start:stop]
+        times       = rows["time"]
+        if "bwidth" in rows.dtype.names: widths = rows["bwidth"]
+        else                           : widths = _bin_widths_from_times(times)
+
+        if self.pmt_table is None:
+            # Hack fix to allow loading pmaps without individual pmts
+            pmt_ids = np.array([-1])
+            pmt_wfs = rows["ene"][np.newaxis]
+        else:
+            pmt_rows = self.pmt_table[self.pmt_starts[block]:self.pmt_stops[block]]
+            pmt_ids  = pmt_rows["npmt"][::times.size]
+            pmt_wfs  = pmt_rows["ene" ].reshape(pmt_ids.size, times.size)
+
+        sipm_r = SiPMResponses.build_empty_instance()
+        if self.si_table is not None:
+            peak_number = int(self.peaks[block])
+            si_range    = self.si_ranges.get((event_number, peak_number))
+            if si_range is not None:
+                si_rows  = self.si_table[slice(*si_range)]
+                sipm_ids = si_rows["nsipm"][::times.size]
+                sipm_wfs = si_rows["ene"  ].reshape(sipm_ids.size, times.size)
+                sipm_r   = SiPMResponses(sipm_ids, sipm_wfs)
+
+        return peak_type(times, widths, PMTResponses(pmt_ids, pmt_wfs), sipm_r)
+
+    def build_peaks(self, peak_type, event_number):
+        return [self.build_peak(peak_type, event_number, block)
+                for block in self.block_range(event_number)]
+
+
+class PMapTables(Mapping):
+    """
+    Read-only mapping from event number to PMap built from the
+    contents of the pmap tables. Event and peak boundaries are
+    found once on construction and each PMap is built from array
+    slices when requested.
+    """
+    def __init__(self, s1, s2, si, s1pmt, s2pmt):
+        self._s1s = _PeakTable(s1, s1pmt)
+        self._s2s = _PeakTable(s2, s2pmt, si)
+
+        self._event_numbers = np.union1d(self._s1s.event_numbers,
+                                         self._s2s.event_numbers).tolist()
+        self._event_set     = set(self._event_numbers)
+
+    def __getitem__(self, event_number):
+        if event_number not in self._event_set:
+            raise KeyError(event_number)
+
+        event_number = int(event_number)
+        return PMap(self._s1s.build_peaks(S1, event_number),
+                    self._s2s.build_peaks(S2, event_number))
+
+    def __iter__(self):
+        return iter(self._event_numbers)
+
+    def __len__(self):
+        return len(self._event_numbers)
+
+
+class CompactPMaps(Mapping):
+    """
+    Read-only mapping from event number to PMap built from the
+    contents of the compact format. `arrays` holds a contiguous
+    part of each sample array, starting at element `offsets[name]`
+    of the array in the file.
+    """
+    def __init__(self, peaks, arrays, offsets):
+        self._peaks   = peaks
+        self._arrays  = arrays
+        self._offsets = offsets
+
+        new_event     = np.ones(len(peaks), dtype=bool)
+        new_event[1:] = peaks["event"][1:] != peaks["event"][:-1]
+        starts        = np.flatnonzero(new_event)
+        stops         = np.append(starts[1:], len(peaks))
+        events        = peaks["event"][starts].tolist()
+        self._ranges  = dict(zip(events, zip(starts.tolist(), stops.tolist())))
+        if len(self._ranges) != len(events):
+            raise InvalidInputFileStructure("Rows of the same event are not contiguous")
+
+    def _block(self, name, start, size):
+        start = int(start) - self._offsets[name]
+        return self._arrays[name][start:start + size]
+
+    def _build_peak(self, row):
+        n_samples = int(row["n_samples"])
+        n_pmts    = int(row["n_pmts"   ])
+        n_sipms   = int(row["n_sipms"  ])
+
+        times   = self._block("Times"  , row["sample_start" ], n_samples)
+        widths  = self._block("Widths" , row["sample_start" ], n_samples)
+        pmt_ids = self._block("PmtIds" , row["pmt_start"    ], n_pmts   )
+        pmt_wfs = self._block("PmtWfs" , row["pmt_wf_start" ], n_pmts * n_samples)
+        pmt_r   = PMTResponses(pmt_ids, pmt_wfs.reshape(n_pmts, n_samples))
+
+        sipm_r  = SiPMResponses.build_empty_instance()
+        if n_sipms:
+            sipm_ids = self._block("SipmIds", row["sipm_start"   ], n_sipms)
+            sipm_wfs = self._block("SipmWfs", row["sipm_wf_start"], n_sipms * n_samples)
+            sipm_r   = SiPMResponses(sipm_ids, sipm_wfs.reshape(n_sipms, n_samples))
+
+        peak_type = S1 if row["signal_type"] == 1 else S2
+        return peak_type(times, widths, pmt_r, sipm_r)
+
+    def __getitem__(self, event_number):
+        start, stop = self._ranges[event_number]
+        s1s, s2s    = [], []
+        for row in self._peaks[start:stop]:
+            peak = self._build_peak(row)
+            (s1s if isinstance(peak, S1) else s2s).append(peak)
+        return PMap(s1s, s2s)
+
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def __len__(self):
+        return len(self._ranges)
+
+
 def build_pmt_responses(pmtdf, ipmtdf):
     times = pmtdf.time.values
     try:
         widths = pmtdf.bwidth.values
     except AttributeError:
-        ## Old file without bin widths saved
-        ## Calculate 'fake' widths from times
-        time_diff = np.diff(times)
-        if len(time_diff) == 0:
-            widths = np.full(1, 1000)
-        elif np.all(time_diff == time_diff[0]):
-            ## S1-like
-            widths = np.full(times.shape, time_diff[0])
-        else:
-            ## S2-like, round to closest mus
-            binw = time_diff.max().round(-3)
-            widths = np.full(times.shape, binw)
+        widths = _bin_widths_from_times(times)
     pmt_ids = pd.unique(ipmtdf.npmt.values)
     enes    =           ipmtdf.ene .values.reshape(pmt_ids.size,
                                                      times.size)
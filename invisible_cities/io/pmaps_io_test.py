@@ -4,6 +4,8 @@ from collections import defaultdict
 
 from pytest import mark
 from pytest import approx
+from pytest import raises
+from pytest import fixture
 
 import tables as tb
 import numpy  as np
@@ -12,8 +14,12 @@ import pandas as pd
 from ..core.testing_utils import assert_PMap_equality
 from ..core.testing_utils import assert_dataframes_equal
 from ..core.testing_utils import exactly
+from ..core.exceptions    import InvalidInputFileStructure
 from ..evm .pmaps         import S1
 from ..evm .pmaps         import S2
+from ..evm .pmaps         import PMap
+from ..evm .pmaps         import PMTResponses
+from ..evm .pmaps         import SiPMResponses
 from .                    import pmaps_io as pmpio
 
 
@@ -63,6 +69,22 @@ def test_make_tables(output_tmpdir):
             assert table.attrs.columns_to_index == ["event"]
 
 
+def test_make_compact_tables(output_tmpdir):
+    output_filename = os.path.join(output_tmpdir, "make_compact_tables.h5")
+
+    with tb.open_file(output_filename, "w") as h5f:
+        pmpio._make_compact_tables(h5f)
+
+        assert "PMAPS" in h5f.root
+        for nodename in ("Events", "Peaks", "Times", "Widths",
+                         "PmtIds", "PmtWfs", "SipmIds", "SipmWfs"):
+            assert nodename in h5f.root.PMAPS
+
+        table = h5f.root.PMAPS.Events
+        assert "columns_to_index" in table.attrs
+        assert table.attrs.columns_to_index == ["event"]
+
+
 def test_store_peak_s1(output_tmpdir, KrMC_pmaps_dict):
     output_filename = os.path.join(output_tmpdir, "store_peak_s1.h5")
     pmaps, _        = KrMC_pmaps_dict
@@ -270,3 +292,207 @@ def test_build_sipm_responses_unordered():
         sipm_r = pmpio.build_sipm_responses(peak)
         assert sipm_r.ids                     == exactly(expected_sipms)
         assert sipm_r.all_waveforms.flatten() == exactly(expected_enes)
+
+
+def test_load_pmaps_same_as_pandas_implementation(KrMC_pmaps_example):
+    filename, _ = KrMC_pmaps_example
+    read_pmaps  = pmpio.load_pmaps            (filename)
+    true_pmaps  = pmpio.load_pmaps_dfs_to_dict(filename)
+
+    assert read_pmaps.keys() == true_pmaps.keys()
+    for evt_number, true_pmap in true_pmaps.items():
+        assert_PMap_equality(read_pmaps[evt_number], true_pmap)
+
+
+def test_load_pmaps_without_ipmt(KrMC_pmaps_without_ipmt_filename):
+    read_pmaps = pmpio.load_pmaps            (KrMC_pmaps_without_ipmt_filename)
+    true_pmaps = pmpio.load_pmaps_dfs_to_dict(KrMC_pmaps_without_ipmt_filename)
+
+    assert read_pmaps.keys() == true_pmaps.keys()
+    for evt_number, true_pmap in true_pmaps.items():
+        read_pmap = read_pmaps[evt_number]
+        assert_PMap_equality(read_pmap, true_pmap)
+        for s1_read, s1_true in zip(read_pmap.s1s, true_pmap.s1s):
+            assert s1_read.bin_widths == approx(s1_true.bin_widths)
+
+
+def test_load_pmaps_missing_event_raises_KeyError(KrMC_pmaps_example):
+    filename, true_pmaps = KrMC_pmaps_example
+    read_pmaps = pmpio.load_pmaps(filename)
+    missing    = max(true_pmaps) + 1
+    assert missing not in read_pmaps
+    with raises(KeyError):
+        read_pmaps[missing]
+
+
+@mark.parametrize("compact", (False, True))
+def test_load_pmaps_events_without_s1s_or_sipms(output_tmpdir, compact):
+    filename = os.path.join(output_tmpdir, f"test_pmaps_without_s1s_{compact}.h5")
+    times    = np.arange(3, dtype=float)
+    widths   = np.ones (3)
+    pmt_r    =  PMTResponses(np.array([0, 2]), np.ones((2, 3)))
+    sipm_r   = SiPMResponses(np.array([5, 7]), np.ones((2, 3)))
+    no_sipms = SiPMResponses.build_empty_instance()
+    pmaps    = {1: PMap([], [S2(times, widths, pmt_r,   sipm_r),
+                             S2(times, widths, pmt_r, no_sipms)]),
+                4: PMap([S1(times, widths, pmt_r, no_sipms)], []),
+                2: PMap([], [S2(times, widths, pmt_r, no_sipms),
+                             S2(times, widths, pmt_r,   sipm_r)])}
+
+    with tb.open_file(filename, "w") as h5f:
+        write = pmpio.pmap_writer(h5f, compact=compact)
+        for evt_number, pmap in pmaps.items():
+            write(pmap, evt_number)
+
+    read_pmaps = pmpio.load_pmaps(filename)
+    assert read_pmaps.keys() == pmaps.keys()
+    for evt_number, pmap in pmaps.items():
+        assert_PMap_equality(read_pmaps[evt_number], pmap)
+
+
+@mark.parametrize("chunk_size", (1, 10, 100, pmpio.DEFAULT_CHUNK_SIZE))
+def test_pmaps_in_chunks_same_as_load_pmaps(KrMC_pmaps_example, chunk_size):
+    filename, true_pmaps = KrMC_pmaps_example
+    event_numbers        = list(true_pmaps)[::-1]
+    with tb.open_file(filename) as h5f:
+        read_pmaps = list(pmpio.pmaps_in_chunks(h5f, event_numbers, chunk_size))
+
+    assert len(read_pmaps) == len(event_numbers)
+    for evt_number, read_pmap in zip(event_numbers, read_pmaps):
+        assert_PMap_equality(read_pmap, true_pmaps[evt_number])
+
+
+def test_pmaps_in_chunks_reads_at_most_chunk_size_rows(KrMC_pmaps_example, monkeypatch):
+    filename, true_pmaps = KrMC_pmaps_example
+    chunk_size           = 50
+    chunk_sizes          = []
+    PMapTables           = pmpio.PMapTables
+    def spy(*tables):
+        chunk_sizes.append(max(len(table) for table in tables))
+        return PMapTables(*tables)
+
+    with tb.open_file(filename) as h5f:
+        # Events larger than the chunk size are read on their own
+        largest_event = max(len(table.get_where_list(f"event == {evt}"))
+                            for evt   in true_pmaps
+                            for table in h5f.root.PMAPS)
+        monkeypatch.setattr(pmpio, "PMapTables", spy)
+        read_pmaps = list(pmpio.pmaps_in_chunks(h5f, list(true_pmaps), chunk_size))
+
+    assert len(read_pmaps) == len(true_pmaps)
+    assert max(chunk_sizes) <= max(chunk_size, largest_event)
+
+
+def test_pmaps_in_chunks_bounds_the_span_of_the_rows_read():
+    # The rows of consecutive events are far apart in the table
+    event_numbers = np.array([0, 1, 2, 3])
+    starts        = np.array([[0], [90], [10], [80]])
+    stops         = np.array([[10], [100], [20], [90]])
+    chunk_size    = 30
+    spans         = []
+    def read_chunk(chunk_starts, chunk_stops):
+        spans.append(chunk_stops - chunk_starts)
+        return {evt: (start, stop) for evt, start, stop in zip(event_numbers, starts, stops)
+                if start >= chunk_starts and stop <= chunk_stops}
+
+    read = list(pmpio._pmaps_in_chunks(event_numbers, starts, stops, read_chunk, chunk_size))
+
+    assert read == list(zip(starts, stops))
+    assert np.max(spans) <= chunk_size
+
+
+def test_pmaps_in_chunks_raises_InvalidInputFileStructure_when_events_mismatch(KrMC_pmaps_example):
+    filename, true_pmaps = KrMC_pmaps_example
+    with tb.open_file(filename) as h5f:
+        with raises(InvalidInputFileStructure):
+            pmpio.pmaps_in_chunks(h5f, list(true_pmaps)[1:])
+
+
+@fixture
+def KrMC_compact_pmaps_example(output_tmpdir, KrMC_pmaps_example):
+    _, true_pmaps = KrMC_pmaps_example
+    filename      = os.path.join(output_tmpdir, "test_compact_pmap_file.h5")
+    with tb.open_file(filename, "w") as h5f:
+        write = pmpio.pmap_writer(h5f, compact=True)
+        for evt_number, pmap in true_pmaps.items():
+            write(pmap, evt_number)
+    return filename, true_pmaps
+
+
+def test_load_pmaps_compact(KrMC_compact_pmaps_example):
+    filename, true_pmaps = KrMC_compact_pmaps_example
+    read_pmaps = pmpio.load_pmaps(filename)
+
+    assert len(read_pmaps)       == len(true_pmaps)
+    assert     read_pmaps.keys() ==     true_pmaps.keys()
+    for evt_number, true_pmap in true_pmaps.items():
+        assert_PMap_equality(read_pmaps[evt_number], true_pmap)
+
+
+def test_store_pmap_compact_event_index(KrMC_compact_pmaps_example):
+    filename, true_pmaps = KrMC_compact_pmaps_example
+    with tb.open_file(filename) as h5f:
+        events = h5f.root.PMAPS.Events.read()
+        peaks  = h5f.root.PMAPS.Peaks .read()
+
+    n_peaks = [len(pmap.s1s) + len(pmap.s2s) for pmap in true_pmaps.values()]
+    assert events["event"     ] == exactly(list(true_pmaps))
+    assert events["n_peaks"   ] == exactly(n_peaks)
+    assert events["first_peak"] == exactly(np.cumsum(n_peaks) - n_peaks)
+    assert len(peaks) == sum(n_peaks)
+    for event, first, n in events:
+        assert np.all(peaks["event"][first:first + n] == event)
+
+
+def test_store_pmap_compact_negative_pmt_ids(output_tmpdir):
+    # Pmaps without individual pmts use -1 as pmt id
+    filename = os.path.join(output_tmpdir, "test_compact_pmap_negative_pmt_ids.h5")
+    times    = np.arange(3, dtype=float)
+    widths   = np.ones (3)
+    pmt_r    = PMTResponses(np.array([-1]), np.ones((1, 3)))
+    no_sipms = SiPMResponses.build_empty_instance()
+    pmaps    = {3: PMap([S1(times, widths, pmt_r, no_sipms)],
+                        [S2(times, widths, pmt_r, no_sipms)])}
+
+    with tb.open_file(filename, "w") as h5f:
+        write = pmpio.pmap_writer(h5f, compact=True)
+        for evt_number, pmap in pmaps.items():
+            write(pmap, evt_number)
+
+    read_pmaps = pmpio.load_pmaps(filename)
+    with tb.open_file(filename) as h5f:
+        chunked_pmaps = list(pmpio.pmaps_in_chunks(h5f, list(pmaps)))
+
+    for read_pmap in (read_pmaps[3], chunked_pmaps[0]):
+        assert_PMap_equality(read_pmap, pmaps[3])
+        assert read_pmap.s1s[0].pmts.ids == exactly([-1])
+
+
+@mark.parametrize("chunk_size", (1, 10, 100, pmpio.DEFAULT_CHUNK_SIZE))
+def test_pmaps_in_chunks_compact(KrMC_compact_pmaps_example, chunk_size):
+    filename, true_pmaps = KrMC_compact_pmaps_example
+    event_numbers        = list(true_pmaps)[::-1]
+    with tb.open_file(filename) as h5f:
+        read_pmaps = list(pmpio.pmaps_in_chunks(h5f, event_numbers, chunk_size))
+
+    assert len(read_pmaps) == len(event_numbers)
+    for evt_number, read_pmap in zip(event_numbers, read_pmaps):
+        assert_PMap_equality(read_pmap, true_pmaps[evt_number])
+
+
+def test_pmaps_in_chunks_compact_raises_InvalidInputFileStructure_when_events_mismatch(KrMC_compact_pmaps_example):
+    filename, true_pmaps = KrMC_compact_pmaps_example
+    with tb.open_file(filename) as h5f:
+        with raises(InvalidInputFileStructure):
+            pmpio.pmaps_in_chunks(h5f, list(true_pmaps)[1:])
+
+
+@mark.parametrize("compact", (False, True))
+def test_read_pmap(KrMC_pmaps_example, KrMC_compact_pmaps_example, compact):
+    filename, true_pmaps = KrMC_compact_pmaps_example if compact else KrMC_pmaps_example
+    with tb.open_file(filename) as h5f:
+        for evt_number, true_pmap in true_pmaps.items():
+            assert_PMap_equality(pmpio.read_pmap(h5f, evt_number), true_pmap)
+
+        with raises(KeyError):
+            pmpio.read_pmap(h5f, max(true_pmaps) + 1)
@@ -16,6 +16,7 @@ from .. database             import          load_db as DB
 from .. types.ic_types       import AutoNameEnumBase
 from .. evm.ic_containers    import     SensorParams
 from .. evm.ic_containers    import   PedestalParams
+from .                       import calib_functions_c as cf_c
 
 
 def bin_waveforms(waveforms, bins):
@@ -23,9 +24,55 @@ def bin_waveforms(waveforms, bins):
     A function to bin waveform data. Bins the current event
     data and adds it to the file level bin array.
     """
-    def bin_waveform(wf):
-        return np.histogram(wf, bins)[0]
-    return np.apply_along_axis(bin_waveform, 1, waveforms)
+    waveforms  = np.asarray(waveforms)
+    histograms = np.zeros((waveforms.shape[0], len(bins) - 1), dtype=np.int64)
+    return accumulate_histograms(histograms, waveforms, bins)
+
+
+def accumulate_histograms(histograms, waveforms, bins, baselines=None, adc_to_pes=None):
+    """
+    Add the histogram of each waveform to the histogram of its
+    sensor, in place. The histograms are the same as those
+    computed with np.histogram.
+
+    Parameters
+    ----------
+    histograms: np.ndarray with shape (n_sensors, len(bins) - 1)
+        int64 histograms of each sensor. Modified in place.
+    waveforms: np.ndarray with shape (n_sensors, m) or (n, n_sensors, m)
+        Waveforms of an event or of a batch of events.
+    bins: np.ndarray
+        Bin edges, in increasing order.
+    baselines: np.ndarray with the shape of `waveforms` but the last axis, optional
+        Baseline subtracted from each waveform before binning.
+    adc_to_pes: np.ndarray with shape (n_sensors,), optional
+        If given, the baseline-subtracted waveforms are calibrated
+        before binning, as with `calibrate_wfs`: those of sensors
+        with non-positive constants are zero.
+
+    Returns
+    -------
+    histograms: np.ndarray
+        The input histograms.
+    """
+    waveforms = np.asarray(waveforms)
+    bins      = np.asarray(bins, dtype=np.float64)
+    n_sensors = waveforms.shape[-2] if waveforms.ndim > 1 else 1
+    if histograms.shape != (n_sensors, len(bins) - 1) or histograms.dtype != np.int64:
+        raise ValueError(f"Histograms must be int64 with shape {(n_sensors, len(bins) - 1)}, "
+                         f"got {histograms.dtype} with shape {histograms.shape}")
+
+    if waveforms.dtype not in (np.int16, np.uint16, np.int32, np.int64, np.float32, np.float64):
+        waveforms = waveforms.astype(np.float64)
+    waveforms  = waveforms.reshape(-1, waveforms.shape[-1])
+    baselines  = np.zeros(len(waveforms)) if baselines  is None else baselines
+    calibrate  = adc_to_pes is not None
+    adc_to_pes = np.ones (n_sensors)      if adc_to_pes is None else adc_to_pes
+    cf_c.accumulate_histograms(histograms, waveforms, bins,
+                               np.asarray(baselines , dtype=np.float64).reshape(len(waveforms)),
+                               np.asarray(adc_to_pes, dtype=np.float64).reshape(n_sensors),
+                               calibrate)
+    return histograms
 
 
 def spaced_integrals(wfs, limits):
@@ -29,6 +29,73 @@ def test_bin_waveforms():
     assert_array_equal(actual, expected)
 
 
+@mark.parametrize("dtype", (np.int16, np.int64, np.float32, np.float64))
+@mark.parametrize("bins" , (np.arange(-5, 20, 0.3),
+                            np.arange(-5, 20),
+                            np.array([-3, -1, 0, 0.5, 2, 7, 15])))
+def test_bin_waveforms_equals_np_histogram(dtype, bins):
+    data = np.random.normal(5, 5, size=(10, 500)).astype(dtype)
+    data[0, :len(bins)] = bins.astype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        data[1, 0] = np.nan
+
+    expected = np.stack([np.histogram(wf, bins)[0] for wf in data])
+    actual   = cf.bin_waveforms(data, bins)
+    assert_array_equal(actual, expected)
+
+
+def test_accumulate_histograms_adds_in_place():
+    bins       = np.linspace(-5, 5, 21)
+    events     = np.random.normal(0, 2, size=(3, 4, 100))
+    histograms = np.zeros((4, len(bins) - 1), dtype=np.int64)
+
+    for event in events:
+        assert cf.accumulate_histograms(histograms, event, bins) is histograms
+
+    expected = sum(cf.bin_waveforms(event, bins) for event in events)
+    assert_array_equal(histograms, expected)
+
+
+def test_accumulate_histograms_batch_of_events():
+    bins       = np.linspace(-5, 5, 21)
+    events     = np.random.normal(0, 2, size=(3, 4, 100))
+    histograms = np.zeros((4, len(bins) - 1), dtype=np.int64)
+
+    expected = sum(cf.bin_waveforms(event, bins) for event in events)
+    actual   = cf.accumulate_histograms(histograms, events, bins)
+    assert_array_equal(actual, expected)
+
+
+@mark.parametrize("dtype", (np.int16, np.float64))
+def test_accumulate_histograms_subtracts_baseline_and_calibrates(dtype):
+    bins       = np.linspace(-2, 5, 71)
+    wfs        = np.random.poisson(50, size=(5, 200)).astype(dtype)
+    baselines  = np.random.uniform(45, 55, size=(5, 1))
+    adc_to_pes = np.random.uniform(10, 20, size=5)
+    adc_to_pes[3] = 0
+
+    cwfs       = np.zeros(wfs.shape)
+    cwfs[:]    = wfs - baselines
+    histograms = np.zeros((5, len(bins) - 1), dtype=np.int64)
+    cf.accumulate_histograms(histograms, wfs, bins, baselines)
+    assert_array_equal(histograms, cf.bin_waveforms(cwfs, bins))
+
+    cwfs       = np.divide(cwfs, adc_to_pes[:, np.newaxis], out=np.zeros_like(cwfs),
+                           where=adc_to_pes[:, np.newaxis] > 0)
+    histograms = np.zeros((5, len(bins) - 1), dtype=np.int64)
+    cf.accumulate_histograms(histograms, wfs, bins, baselines, adc_to_pes)
+    assert_array_equal(histograms, cf.bin_waveforms(cwfs, bins))
+
+
+def test_accumulate_histograms_raises_ValueError_with_wrong_histograms():
+    bins = np.linspace(-5, 5, 21)
+    wfs  = np.random.normal(0, 2, size=(4, 100))
+    with raises(ValueError):
+        cf.accumulate_histograms(np.zeros((4, len(bins)), dtype=np.int64), wfs, bins)
+    with raises(ValueError):
+        cf.accumulate_histograms(np.zeros((4, len(bins) - 1)), wfs, bins)
+
+
 def test_spaced_integrals():
     limits = np.array([2, 4, 6])
     data   = np.arange(20).reshape(2, 10)
@@ -7,6 +7,9 @@ import scipy.stats  as stats
 from functools import wraps
 
 from .. core.core_functions import to_col_vector
+from .. core                import core_functions_c as core_c
+from .. evm .sparse_wfs     import SparseWfs
+from .                      import calib_sensors_functions_c as csf_c
 
 
 class BlsMode(Enum):
@@ -29,16 +32,61 @@ def scipy_mode(x, axis=0):
     return m
 
 
+def _as_rows(wfs, axis):
+    """
+    Contiguous 2-dim view (or copy) of `wfs` with `axis` along the
+    rows, and the shape of `wfs` without `axis`.
+    """
+    wfs   = np.moveaxis(wfs, axis, -1)
+    shape = wfs.shape[:-1]
+    return np.ascontiguousarray(wfs.reshape(-1, wfs.shape[-1])), shape
+
+
+def _along_axis(fn, wfs, axis):
+    """
+    Apply `fn`, which reduces each row of a 2-dim array to a
+    single value, along `axis` of `wfs`.
+    """
+    rows, shape = _as_rows(wfs, axis)
+    return fn(rows).reshape(shape)
+
+
+def _compiled_dtype(dtype, floats=True):
+    """
+    Type in which the compiled baselines handle waveforms of type
+    `dtype` without changing the result, or None if they don't.
+    """
+    if dtype in (np.int8 , np.uint8 , np.int16): return np.int16
+    if dtype in (np.uint16,                   ): return np.uint16
+    if dtype in (np.int32,                    ): return np.int32
+    if dtype in (np.uint32, np.int64          ): return np.int64
+    if floats and dtype in (np.float32, np.float64): return dtype
+    return None
+
+
+def _wf_mode(wf):
+    positive = wf > 0
+    return np.bincount(wf[positive]).argmax() if np.count_nonzero(positive) else 0
+
+
+def _rows_mode(wfs, max_bins=2**20):
+    modes = csf_c.rows_mode(wfs, max_bins)
+    if modes is None:
+        return np.apply_along_axis(_wf_mode, 1, wfs).astype(float)
+    return modes
+
+
 def mode(wfs, axis=0):
     """
-    A fast calculation of the mode: it runs 10 times
+    A fast calculation of the mode: it runs much
     faster than the SciPy version but only applies to
     positive waveforms.
     """
-    def wf_mode(wf):
-        positive = wf > 0
-        return np.bincount(wf[positive]).argmax() if np.count_nonzero(positive) else 0
-    return np.apply_along_axis(wf_mode, axis, wfs).astype(float)
+    wfs   = np.asarray(wfs)
+    dtype = _compiled_dtype(wfs.dtype, floats=False)
+    if dtype is None:
+        return np.apply_along_axis(_wf_mode, axis, wfs).astype(float)
+    return _along_axis(_rows_mode, wfs.astype(dtype, copy=False), axis)
 
 
 def zero_masked(fn):
@@ -54,8 +102,50 @@ def zero_masked(fn):
     proxy.__doc__ = "Masked version to protect ZS mode \n\n" + proxy.__doc__
     return proxy
 
-median = zero_masked(np.ma.median)
-mean   = zero_masked(np.ma.mean)
+masked_median = zero_masked(np.ma.median)
+masked_mean   = zero_masked(np.ma.mean)
+
+
+def median(wfs, axis=0):
+    """
+    Compiled version of `masked_median`, with the same result.
+    """
+    wfs   = np.asarray(wfs)
+    dtype = _compiled_dtype(wfs.dtype)
+    if dtype is None:
+        return masked_median(wfs, axis=axis)
+    return _along_axis(csf_c.rows_median, wfs.astype(dtype, copy=False), axis)
+
+
+def mean(wfs, axis=0):
+    """
+    Faster version of `masked_mean`, with the same result.
+    """
+    wfs   = np.asarray(wfs)
+    dtype = _compiled_dtype(wfs.dtype)
+    if dtype is None:
+        return masked_mean(wfs, axis=axis)
+
+    if np.all(wfs):
+        # Nothing to mask: np.ma uses np.mean, which is as fast
+        return np.ma.masked_array(wfs).mean(axis=axis).filled(0)
+
+    if np.issubdtype(dtype, np.integer):
+        rows, shape  = _as_rows(wfs.astype(dtype, copy=False), axis)
+        sums, counts = csf_c.rows_nonzero_sum(rows)
+        sums, counts = sums.reshape(shape), counts.reshape(shape)
+    else:
+        # The result depends on the order of the sum for
+        # floats, so it is done in the same way as np.ma
+        sums   = np.sum          (wfs, axis=axis)
+        counts = np.count_nonzero(wfs, axis=axis)
+
+    # Same masking of the result as np.ma.mean
+    sums   = sums * 1.
+    means  = sums / np.where(counts > 0, counts, 1)
+    valid  = (counts > 0) & np.isfinite(means)
+    valid &= np.abs(sums) * np.finfo(float).tiny < counts
+    return np.where(valid, means, 0)
 
 
 def means  (wfs): return to_col_vector(mean  (wfs, axis=1))
@@ -63,6 +153,34 @@ def medians(wfs): return to_col_vector(median(wfs, axis=1))
 def modes  (wfs): return to_col_vector(mode  (wfs, axis=1))
 
 
+def modes_and_medians(wfs, max_bins=2**20):
+    """
+    Same as `modes(wfs), medians(wfs)`. For integer waveforms
+    both are computed from the same histogram of each waveform.
+    """
+    wfs   = np.asarray(wfs)
+    dtype = _compiled_dtype(wfs.dtype, floats=False)
+    if dtype is not None and wfs.ndim == 2:
+        rows   = np.ascontiguousarray(wfs.astype(dtype, copy=False))
+        result = csf_c.rows_mode_and_median(rows, max_bins)
+        if result is not None:
+            return tuple(map(to_col_vector, result))
+    return modes(wfs), medians(wfs)
+
+
+def baselines(wfs, *, bls_mode=BlsMode.mean):
+    """
+    Baseline of each waveform, as a column vector, computed
+    with the algorithm used by `subtract_baseline`.
+    """
+    if   bls_mode is BlsMode.mean     : return means     (wfs)
+    elif bls_mode is BlsMode.median   : return medians   (wfs)
+    elif bls_mode is BlsMode.mode     : return modes     (wfs)
+    elif bls_mode is BlsMode.scipymode: return scipy_mode(wfs, axis=1)
+    else:
+        raise TypeError(f"Unrecognized baseline subtraction option: {bls_mode}")
+
+
 def subtract_baseline(wfs, *, bls_mode=BlsMode.mean):
     """
     Subtract the baseline to all waveforms in the input
@@ -83,32 +201,117 @@ def subtract_baseline(wfs, *, bls_mode=BlsMode.mean):
     bls: np.ndarray with shape (n, m)
         Baseline-subtracted waveforms.
     """
-
-    if   bls_mode is BlsMode.mean     : return wfs - means     (wfs)
-    elif bls_mode is BlsMode.median   : return wfs - medians   (wfs)
-    elif bls_mode is BlsMode.mode     : return wfs - modes     (wfs)
-    elif bls_mode is BlsMode.scipymode: return wfs - scipy_mode(wfs, axis=1)
-    else:
-        raise TypeError(f"Unrecognized baseline subtraction option: {bls_mode}")
+    return wfs - baselines(wfs, bls_mode=bls_mode)
 
 
-def calibrate_wfs(wfs, adc_to_pes):
+def calibrate_wfs(wfs, adc_to_pes, dtype=np.float64, out=None):
     """
     Convert waveforms in adc to pes. Masked channels
-    are ignored.
+    are ignored (set to zero). The result is written into
+    `out` if given, which can be `wfs` itself.
     """
     adc_to_pes = to_col_vector(adc_to_pes)
     ok         = adc_to_pes > 0
-    out        = np.zeros(wfs.shape, dtype=float)
+    if out is None:
+        out = np.zeros(wfs.shape, dtype=dtype)
+    else:
+        out[~ok[:, 0]] = 0
     return np.divide(wfs, adc_to_pes, out=out, where=ok)
 
 
+def suppress_below(wfs, thr, block_size=2**14):
+    """
+    Set to zero, in place, the values of `wfs` that are not above
+    `thr`, a column vector with one threshold per row. Waveforms of
+    other types than single and double precision are processed in
+    blocks of about `block_size` samples, so that the mask used is
+    small.
+    """
+    if wfs.dtype in (np.float32, np.float64):
+        core_c.zero_below(wfs, np.asarray(thr, dtype=np.float64).reshape(-1))
+        return wfs
+
+    n_rows = max(1, block_size // max(1, wfs.shape[1]))
+    for start in range(0, wfs.shape[0], n_rows):
+        block = wfs[start:start + n_rows]
+        block[~(block > thr[start:start + n_rows])] = 0
+    return wfs
+
+
 def subtract_baseline_and_calibrate(sipm_wfs, adc_to_pes, *, bls_mode=BlsMode.mean):
     bls = subtract_baseline(sipm_wfs, bls_mode=bls_mode)
     return calibrate_wfs(bls, adc_to_pes)
 
 
-def calibrate_pmts(cwfs, adc_to_pes, n_MAU=100, thr_MAU=3):
+def pmt_calibration_buffers(n_pmts, n_samples, dtype=np.float64):
+    """
+    Allocate the output arrays of `calibrate_pmts` for waveforms
+    with shape (n_pmts, n_samples). They can be passed as `out` to
+    reuse them across events.
+    """
+    return (np.empty((n_pmts, n_samples), dtype=dtype),
+            np.empty((n_pmts, n_samples), dtype=dtype),
+            np.empty(         n_samples , dtype=dtype),
+            np.empty(         n_samples , dtype=dtype))
+
+
+def moving_average(wfs, n_MAU, out, cumsum):
+    """
+    Causal moving average of `n_MAU` samples along the last axis,
+    the same as filtering with `n_MAU` weights of 1 / `n_MAU`
+    (with zeros before the first sample), written into `out`.
+    It is computed from the cumulative sum of the waveforms, which
+    is stored in `cumsum` in double precision. If `cumsum` is a
+    single row, the waveforms are processed one by one.
+
+    The result is not bit-identical to `lfilter`: the difference of
+    cumulative sums carries their rounding error, which is bounded
+    by `moving_average_tolerance`. Samples closer than that to a
+    threshold on the MAU can fall on either side of it.
+    """
+    if cumsum.ndim == 1:
+        for wf, wf_out in zip(wfs, out):
+            moving_average(wf[np.newaxis], n_MAU, wf_out[np.newaxis], cumsum[np.newaxis])
+        return out
+
+    # Accumulated in place: numpy would convert a copy of the input
+    np.copyto(cumsum, wfs)
+    np.cumsum(cumsum, axis=1, out=cumsum)
+    n_head = min(n_MAU, wfs.shape[1])
+    out[:, :n_head] = cumsum[:, :n_head]
+    # Row by row, numpy would buffer the overlapping 2d slices
+    for cs, wf_out in zip(cumsum, out):
+        np.subtract(cs[n_head:], cs[:-n_head], out=wf_out[n_head:])
+    out /= n_MAU
+    return out
+
+
+def moving_average_tolerance(wfs, n_MAU):
+    """
+    Bound on the difference between `moving_average` and the MAU
+    computed with `lfilter`, for each waveform: the rounding error
+    of a cumulative sum of n samples is at most n * eps times the sum
+    of their absolute values, and the MAU is the difference of two
+    of them divided by `n_MAU`. For detector waveforms it is many
+    orders of magnitude below one adc count.
+    """
+    wfs = np.asarray(wfs, dtype=np.float64)
+    eps = np.finfo(np.float64).eps
+    return 3 * wfs.shape[-1] * eps * np.sum(np.abs(wfs), axis=-1) / n_MAU
+
+
+def sum_rows(wfs, out):
+    """
+    Sum of the rows of `wfs`, written into `out`.
+    """
+    out.fill(0)
+    for wf in wfs:
+        out += wf
+    return out
+
+
+def calibrate_pmts(cwfs, adc_to_pes, n_MAU=100, thr_MAU=3, *,
+                   out=None, dtype=np.float64, scratch=None):
     """
     This function is called for PMT waveforms that have
     already been baseline restored and pedestal subtracted.
@@ -119,16 +322,49 @@ def calibrate_pmts(cwfs, adc_to_pes, n_MAU=100, thr_MAU=3):
     are useful to suppress oscillatory noise and thus can
     be applied for S1 searches (the calibrated version
     without the MAU should be applied for S2 searches).
+
+    The results are written into `out`, a tuple
+    (ccwfs, ccwfs_mau, cwf_sum, cwf_sum_mau) as returned by
+    `pmt_calibration_buffers`, if given. Otherwise new arrays
+    of type `dtype` are allocated. The MAU is computed with the
+    cumulative sum of each waveform, in double precision, which is
+    stored in `scratch`, a double array of n_samples, allocated if
+    not given. No other arrays of the size of the waveforms are
+    allocated. The MAU is not bit-identical to the one computed
+    with `lfilter` (see `moving_average`).
     """
-    MAU         = np.full(n_MAU, 1 / n_MAU)
-    mau         = signal.lfilter(MAU, 1, cwfs, axis=1)
+    if out is None:
+        out = pmt_calibration_buffers(*cwfs.shape, dtype=dtype)
 
     # ccwfs stands for calibrated corrected waveforms
-    ccwfs       = calibrate_wfs(cwfs, adc_to_pes)
-    ccwfs_mau   = np.where(cwfs >= mau + thr_MAU, ccwfs, 0)
-
-    cwf_sum     = np.sum(ccwfs    , axis=0)
-    cwf_sum_mau = np.sum(ccwfs_mau, axis=0)
+    ccwfs, ccwfs_mau, cwf_sum, cwf_sum_mau = out
+
+    # The MAU is computed row by row from a cumulative sum, which
+    # needs double precision
+    if scratch is None:
+        scratch = np.empty(cwfs.shape[1])
+    elif scratch.shape != cwfs.shape[1:] or scratch.dtype != np.float64:
+        raise ValueError(f"The scratch buffer must be a double array of shape "
+                         f"{cwfs.shape[1:]}, got {scratch.dtype} {scratch.shape}")
+    mau  = moving_average(cwfs, n_MAU, out=ccwfs_mau, cumsum=scratch)
+    mau += thr_MAU
+
+    # 1 where above the MAU threshold and 0 elsewhere
+    np.greater_equal(cwfs, mau, out=ccwfs_mau)
+
+    # Calibration constants in the type of the output, which is
+    # not read through a casting buffer then
+    adc_to_pes = np.asarray(adc_to_pes).astype(ccwfs.dtype, copy=False)
+    for cwf, ccwf, a2p in zip(cwfs, ccwfs, adc_to_pes):
+        if a2p > 0: np.divide(cwf, a2p, out=ccwf)
+        else      : ccwf.fill(0)
+
+    ccwfs_mau *= ccwfs
+
+    # The sensor sums are accumulated row by row, in the same order
+    # as np.sum(axis=0), which would use a temporary buffer
+    sum_rows(ccwfs    , out=cwf_sum    )
+    sum_rows(ccwfs_mau, out=cwf_sum_mau)
     return ccwfs, ccwfs_mau, cwf_sum, cwf_sum_mau
 
 
@@ -142,15 +378,58 @@ def pmt_subtract_mau(cwfs, n_MAU=100):
     return cwfs - mau
 
 
-def calibrate_sipms(sipm_wfs, adc_to_pes, thr, *, bls_mode=BlsMode.mode):
+def calibrate_sipms(sipm_wfs, adc_to_pes, thr, *, bls_mode=BlsMode.mode, windows=None,
+                    sparse=False, dtype=np.float64, out=None):
     """
     Subtracts the baseline, calibrates waveforms to pes
     and suppresses values below `thr` (in pes).
+
+    If `windows`, a sequence of sample ranges (start, stop), is
+    given, only the samples within them are calibrated and the rest
+    are set to zero. The baseline is still computed with the full
+    waveforms, so the samples calibrated are the same as without
+    `windows`.
+
+    If `sparse`, the result is returned as a `SparseWfs` holding
+    only the samples above threshold, without building the full
+    matrix of calibrated waveforms.
+
+    Otherwise, the calibrated waveforms are of type `dtype`, as are
+    all intermediate waveforms. They are written into `out`, if
+    given, with no other allocation of the size of the waveforms.
     """
-    thr  = to_col_vector(np.full(sipm_wfs.shape[0], thr))
-    bls  = subtract_baseline(sipm_wfs, bls_mode=bls_mode)
-    cwfs = calibrate_wfs(bls, adc_to_pes)
-    return np.where(cwfs > thr, cwfs, 0)
+    thr = to_col_vector(np.full(sipm_wfs.shape[0], thr))
+    bls = baselines(sipm_wfs, bls_mode=bls_mode)
+    in_window = np.ones(sipm_wfs.shape[1], dtype=bool)
+    if windows is not None:
+        in_window[:] = False
+        for start, stop in windows:
+            in_window[start:stop] = True
+
+    if not sparse:
+        # Each contiguous range of samples is processed in place
+        if out is None:
+            out = np.empty(sipm_wfs.shape, dtype=dtype)
+        if windows is not None:
+            out.fill(0)
+        edges = np.diff(in_window.astype(np.int8), prepend=0, append=0)
+        for start, stop in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            cwfs = out[:, start:stop]
+            np.subtract(sipm_wfs[:, start:stop], bls, out=cwfs, dtype=cwfs.dtype)
+            calibrate_wfs (cwfs, adc_to_pes, out=cwfs)
+            suppress_below(cwfs, thr)
+        return out
+
+    if windows is None:
+        samples = None
+        bls     = np.subtract(sipm_wfs, bls, dtype=dtype)
+    else:
+        samples = np.flatnonzero(in_window)
+        bls     = np.subtract(sipm_wfs[:, samples], bls, dtype=dtype)
+
+    cwfs  = calibrate_wfs(bls, adc_to_pes, dtype=dtype)
+    above = cwfs > thr
+    return SparseWfs.from_mask(cwfs, above, sipm_wfs.shape[1], samples)
 
 
 def subtract_mean  (wfs): return subtract_baseline(wfs, bls_mode=BlsMode.mean  )
@@ -0,0 +1,223 @@
+# distutils: language = c++
+"""
+Compiled per-row baselines for `calib_sensors_functions`.
+They reproduce exactly the results of the numpy versions.
+"""
+cimport cython
+cimport numpy as np
+import  numpy as np
+
+from libc.math   cimport isnan
+from libcpp.vector cimport vector
+
+
+cdef extern from "<algorithm>" namespace "std" nogil:
+    void nth_element[Iter](Iter first, Iter nth, Iter last)
+
+
+ctypedef fused integer_t:
+    np.int16_t
+    np.uint16_t
+    np.int32_t
+    np.int64_t
+
+ctypedef fused sample_t:
+    np.int16_t
+    np.uint16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rows_mode(integer_t [:, ::1] wfs, np.int64_t max_bins):
+    """
+    Most frequent positive value of each row, the smallest one
+    in case of a tie, or 0 if there are no positive values.
+    The values are histogrammed, so None is returned if they
+    span more than `max_bins` values.
+    """
+    cdef np.ndarray[np.float64_t] modes = np.zeros(wfs.shape[0])
+    cdef np.int64_t           [:] counts
+    cdef Py_ssize_t i, j
+    cdef np.int64_t lowest, highest, n_bins, lo, hi, k, best, most
+    lowest  = 0
+    highest = 0
+    for i in range(wfs.shape[0]):
+        for j in range(wfs.shape[1]):
+            if wfs[i, j] > 0:
+                if lowest == 0 or wfs[i, j] < lowest : lowest  = wfs[i, j]
+                if                wfs[i, j] > highest: highest = wfs[i, j]
+    if highest == 0:
+        return modes
+
+    n_bins = highest - lowest + 1
+    if n_bins > max_bins:
+        return None
+
+    counts = np.zeros(n_bins, dtype=np.int64)
+    for i in range(wfs.shape[0]):
+        lo = n_bins
+        hi = -1
+        for j in range(wfs.shape[1]):
+            if wfs[i, j] > 0:
+                k          = wfs[i, j] - lowest
+                counts[k] += 1
+                if k < lo: lo = k
+                if k > hi: hi = k
+        if hi < 0: continue
+
+        best = lo
+        most = 0
+        for k in range(lo, hi + 1):
+            if counts[k] > most:
+                best = k
+                most = counts[k]
+            counts[k] = 0
+        modes[i] = best + lowest
+    return modes
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def rows_median(sample_t [:, ::1] wfs):
+    """
+    Median of the non-zero values of each row, as computed by
+    np.ma.median: the mean of the two central values for an even
+    number of values, nan if the row contains a nan and 0 if all
+    values are zero. The result is single precision for single
+    precision input and double precision otherwise.
+    """
+    cdef np.ndarray[np.float64_t] medians = np.zeros(wfs.shape[0])
+    cdef vector[sample_t] values
+    cdef Py_ssize_t i, j, n, h
+    cdef sample_t   low, high, s
+    cdef bint       has_nan
+    values.resize(wfs.shape[1])
+
+    for i in range(wfs.shape[0]):
+        n       = 0
+        has_nan = False
+        for j in range(wfs.shape[1]):
+            if wfs[i, j] != 0:
+                if sample_t is np.float32_t or sample_t is np.float64_t:
+                    has_nan |= isnan(wfs[i, j])
+                values[n] = wfs[i, j]
+                n        += 1
+        if has_nan:
+            medians[i] = np.nan
+            continue
+        if n == 0: continue
+
+        h = n // 2
+        nth_element(values.begin(), values.begin() + h, values.begin() + n)
+        high = values[h]
+        low  = high
+        if n % 2 == 0:
+            low = values[0]
+            for j in range(1, h):
+                if values[j] > low:
+                    low = values[j]
+
+        if sample_t is np.float32_t or sample_t is np.float64_t:
+            s          = low + high
+            medians[i] = s / 2
+        else:
+            medians[i] = (<double> low + <double> high) / 2
+
+    return medians.astype(np.float32 if sample_t is np.float32_t else np.float64, copy=False)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rows_nonzero_sum(integer_t [:, ::1] wfs):
+    """
+    Sum and number of the non-zero values of each row.
+    """
+    cdef np.ndarray[np.int64_t] sums   = np.empty(wfs.shape[0], dtype=np.int64)
+    cdef np.ndarray[np.int64_t] counts = np.empty(wfs.shape[0], dtype=np.int64)
+    cdef Py_ssize_t i, j
+    cdef np.int64_t s, n
+    for i in range(wfs.shape[0]):
+        s = 0
+        n = 0
+        for j in range(wfs.shape[1]):
+            s += wfs[i, j]
+            n += wfs[i, j] != 0
+        sums  [i] = s
+        counts[i] = n
+    return sums, counts
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def rows_mode_and_median(integer_t [:, ::1] wfs, np.int64_t max_bins):
+    """
+    Same results as `rows_mode` and `rows_median`, computed from
+    a single histogram of the non-zero values of each row. None is
+    returned if they span more than `max_bins` values.
+    """
+    cdef np.ndarray[np.float64_t] modes   = np.zeros(wfs.shape[0])
+    cdef np.ndarray[np.float64_t] medians = np.zeros(wfs.shape[0])
+    cdef np.int64_t           [:] counts
+    cdef Py_ssize_t i, j
+    cdef np.int64_t lowest, highest, n_bins, lo, hi, k, best, most, n, seen
+    cdef np.int64_t low = 0, high = 0
+    cdef bint       found, has_low, has_high
+    found   = False
+    lowest  = 0
+    highest = 0
+    for i in range(wfs.shape[0]):
+        for j in range(wfs.shape[1]):
+            if wfs[i, j] != 0:
+                if not found or wfs[i, j] < lowest : lowest  = wfs[i, j]
+                if not found or wfs[i, j] > highest: highest = wfs[i, j]
+                found = True
+    if not found:
+        return modes, medians
+
+    n_bins = highest - lowest + 1
+    if n_bins > max_bins:
+        return None
+
+    counts = np.zeros(n_bins, dtype=np.int64)
+    for i in range(wfs.shape[0]):
+        lo = n_bins
+        hi = -1
+        n  = 0
+        for j in range(wfs.shape[1]):
+            if wfs[i, j] != 0:
+                k          = wfs[i, j] - lowest
+                counts[k] += 1
+                n         += 1
+                if k < lo: lo = k
+                if k > hi: hi = k
+        if hi < 0: continue
+
+        # The mode only considers positive values
+        best     = 0
+        most     = 0
+        seen     = 0
+        has_low  = False
+        has_high = False
+        for k in range(lo, hi + 1):
+            if counts[k] > most and k + lowest > 0:
+                best = k + lowest
+                most = counts[k]
+
+            # Values at positions (n - 1) // 2 and n // 2 once sorted
+            if not has_low and seen + counts[k] > (n - 1) // 2:
+                low      = k + lowest
+                has_low  = True
+            if not has_high and seen + counts[k] > n // 2:
+                high     = k + lowest
+                has_high = True
+            seen     += counts[k]
+            counts[k] = 0
+        modes  [i] = best
+        medians[i] = (<double> low + <double> high) / 2
+    return modes, medians
@@ -1,4 +1,5 @@
 import numpy        as np
+import scipy.signal as signal
 
 from functools import reduce
 from operator  import add
@@ -7,9 +8,21 @@ from pytest import fixture
 from pytest import approx
 from pytest import mark
 from pytest import raises
+from numpy.testing import assert_array_equal
+from numpy.testing import assert_allclose
 from flaky  import flaky
 
+from hypothesis                import given
+from hypothesis.strategies     import integers
+from hypothesis.strategies     import floats
+from hypothesis.strategies     import one_of
+from hypothesis.strategies     import just
+from hypothesis.strategies     import sampled_from
+from hypothesis.extra.numpy    import arrays
+
 from .. core.testing_utils import all_elements_close
+from .. core.testing_utils import peak_allocated_memory
+from .. core.testing_utils import execution_time
 
 from .          import calib_sensors_functions as csf
 from .. core    import core_functions          as cf
@@ -237,6 +250,32 @@ def test_calibrate_sipms_individual_thresholds(toy_sipm_signal):
         assert actual == approx(expected)
 
 
+@mark.parametrize("windows", ([], [(0, 3)], [(2, 5), (7, 10)], [(2, 6), (4, 8)]))
+def test_calibrate_sipms_in_windows(toy_sipm_signal, windows):
+    signal_adc, adc_to_pes, _, _, thr, _ = toy_sipm_signal
+    expected = csf.calibrate_sipms(signal_adc, adc_to_pes, thr, bls_mode=csf.BlsMode.mode)
+    got      = csf.calibrate_sipms(signal_adc, adc_to_pes, thr, bls_mode=csf.BlsMode.mode,
+                                   windows = windows)
+
+    in_windows = np.zeros(signal_adc.shape[1], dtype=bool)
+    for start, stop in windows:
+        in_windows[start:stop] = True
+
+    assert np.all(got[:,  in_windows] == expected[:, in_windows])
+    assert np.all(got[:, ~in_windows] == 0)
+
+
+@mark.parametrize("windows", (None, [(2, 5), (7, 10)]))
+def test_calibrate_sipms_sparse_equals_dense(toy_sipm_signal, windows):
+    signal_adc, adc_to_pes, _, _, _, thr = toy_sipm_signal
+    dense  = csf.calibrate_sipms(signal_adc, adc_to_pes, thr, windows=windows)
+    sparse = csf.calibrate_sipms(signal_adc, adc_to_pes, thr, windows=windows,
+                                 sparse = True)
+
+    assert sparse.shape == dense.shape
+    assert sparse.nnz   == np.count_nonzero(dense)
+    assert_array_equal(sparse.to_dense(), dense.astype(np.float32))
+
 def test_wf_baseline_subtracted_is_close_to_zero(gaussian_sipm_signal):
     sipm_wfs, adc_to_pes = gaussian_sipm_signal
     bls_wf = csf.subtract_baseline_and_calibrate(sipm_wfs, adc_to_pes)
@@ -335,3 +374,200 @@ def test_mode_for_square_waveform_has_no_bias(square_pmt_and_sipm_waveforms):
     sipms_mode = csf.subtract_baseline(sipms_wfm, bls_mode=csf.BlsMode.mode)
     diffs      = sipms_noped - sipms_mode
     assert np.mean(diffs) == approx(0)
+
+
+@mark.parametrize("n_mau", (1, 7, 100, 2000))
+def test_calibrate_pmts_equals_lfilter_implementation(n_mau):
+    n_pmts, n_samples = 4, 1000
+    thr_mau           = 0.5
+    rng               = np.random.default_rng(1234)
+    wfs               = rng.normal(0, 1, size=(n_pmts, n_samples))
+    wfs[:, 400:500]  += 20
+    adc_to_pes        = np.array([10, 0, 15, 20.])
+
+    mau         = signal.lfilter(np.full(n_mau, 1 / n_mau), 1, wfs, axis=1)
+    ccwfs       = csf.calibrate_wfs(wfs, adc_to_pes)
+    ccwfs_mau   = np.where(wfs >= mau + thr_mau, ccwfs, 0)
+
+    out    = csf.pmt_calibration_buffers(n_pmts, n_samples)
+    result = csf.calibrate_pmts(wfs, adc_to_pes, n_mau, thr_mau, out=out)
+
+    assert all(got is buffer for got, buffer in zip(result, out))
+    assert np.all(result[0] == ccwfs)
+    assert np.all(result[1] == ccwfs_mau)
+    assert np.all(result[2] == np.sum(ccwfs    , axis=0))
+    assert np.all(result[3] == np.sum(ccwfs_mau, axis=0))
+
+
+def _calibrate_pmts_lfilter(cwfs, adc_to_pes, n_MAU, thr_MAU):
+    # Reference implementation, with the MAU computed by lfilter
+    mau       = signal.lfilter(np.full(n_MAU, 1 / n_MAU), 1, cwfs, axis=1)
+    ccwfs     = csf.calibrate_wfs(cwfs, adc_to_pes)
+    ccwfs_mau = np.where(cwfs >= mau + thr_MAU, ccwfs, 0)
+    return ccwfs, ccwfs_mau, np.sum(ccwfs, axis=0), np.sum(ccwfs_mau, axis=0)
+
+
+@mark.parametrize("n_mau", (7, 100))
+def test_calibrate_pmts_mau_selection_near_threshold(n_mau):
+    n_pmts, n_samples = 3, 2000
+    thr_mau           = 0.5
+    rng               = np.random.default_rng(4321)
+    wfs               = rng.normal(0, 1, size=(n_pmts, n_samples))
+    wfs[:, 800:900]  += 20
+    adc_to_pes        = np.array([10, 15, 20.])
+
+    # Put one sample in five at the MAU threshold, up to an offset
+    # that is a multiple of the tolerance, from below or above
+    tolerance = np.max(csf.moving_average_tolerance(rng.normal(0, 1, n_samples) + 20, n_mau))
+    offsets   = np.array([-10, -0.1, 0, 0.1, 10]) * tolerance
+    for k in range(n_mau, n_samples, 5):
+        previous   = wfs[:, k - n_mau + 1:k].sum(axis=1)
+        at_thr     = (previous / n_mau + thr_mau) / (1 - 1 / n_mau)
+        wfs[:, k]  = at_thr + offsets[k // 5 % len(offsets)]
+
+    mau      = signal.lfilter(np.full(n_mau, 1 / n_mau), 1, wfs, axis=1)
+    got      = csf.moving_average(wfs, n_mau, np.empty_like(wfs), np.empty(n_samples))
+    assert np.all(np.abs(got - mau) <= csf.moving_average_tolerance(wfs, n_mau)[:, np.newaxis])
+
+    expected = _calibrate_pmts_lfilter(wfs, adc_to_pes, n_mau, thr_mau)
+    result   = csf.calibrate_pmts     (wfs, adc_to_pes, n_mau, thr_mau)
+    assert np.all(result[0] == expected[0])
+
+    # Only the samples within the tolerance of the threshold can be
+    # selected differently
+    near_thr = np.abs(wfs - mau - thr_mau) <= csf.moving_average_tolerance(wfs, n_mau)[:, np.newaxis]
+    assert np.any(near_thr)
+    assert np.all(result[1][~near_thr] == expected[1][~near_thr])
+
+
+@mark.benchmark
+def test_calibrate_pmts_faster_than_lfilter_implementation():
+    n_pmts, n_samples = 12, 52000
+    rng               = np.random.default_rng(1)
+    wfs               = rng.normal(0, 2, size=(n_pmts, n_samples))
+    adc_to_pes        = rng.uniform(20, 25, size=n_pmts)
+    out               = csf.pmt_calibration_buffers(n_pmts, n_samples)
+    scratch           = np.empty(n_samples)
+
+    reference = execution_time(_calibrate_pmts_lfilter, wfs, adc_to_pes, 100, 3)
+    fused     = execution_time(csf.calibrate_pmts     , wfs, adc_to_pes, 100, 3,
+                               out=out, scratch=scratch)
+    print(f"calibrate_pmts: {fused * 1e3:.1f} ms, with lfilter: {reference * 1e3:.1f} ms")
+    assert fused < reference
+
+
+@mark.parametrize("n_mau", (1, 100, 2000))
+def test_calibrate_pmts_single_precision_close_to_double(n_mau):
+    n_pmts, n_samples = 4, 10000
+    thr_mau           = 3
+    rng               = np.random.default_rng(5678)
+    wfs               = rng.normal(0, 2, size=(n_pmts, n_samples))
+    wfs[:, 4000:5000] += rng.uniform(10, 500, size=(n_pmts, 1))
+    adc_to_pes        = np.array([23.5, 0, 24.1, 25.7])
+
+    double = csf.calibrate_pmts(wfs                   , adc_to_pes, n_mau, thr_mau)
+    single = csf.calibrate_pmts(wfs.astype(np.float32), adc_to_pes, n_mau, thr_mau,
+                                dtype = np.float32)
+
+    assert all(wf.dtype == np.float32 for wf in single)
+    assert_allclose(single[0], double[0], rtol=1e-6, atol=1e-6)
+    assert_allclose(single[2], double[2], rtol=1e-5, atol=1e-5)
+
+    # Samples at the MAU threshold can be selected in one precision
+    # and not in the other. They are a tiny fraction.
+    same = (single[1] != 0) == (double[1] != 0)
+    assert np.count_nonzero(~same) <= 1e-4 * same.size
+    assert_allclose(single[1][same], double[1][same], rtol=1e-6, atol=1e-6)
+
+
+@mark.parametrize("dtype", (np.float32, np.float64))
+def test_calibrate_pmts_into_out_does_not_allocate_waveforms(dtype):
+    n_pmts, n_samples = 12, 48000
+    wfs               = np.random.normal(0, 2, size=(n_pmts, n_samples)).astype(dtype)
+    adc_to_pes        = np.random.uniform(20, 25, size=n_pmts)
+    out               = csf.pmt_calibration_buffers(n_pmts, n_samples, dtype=dtype)
+    scratch           = np.empty(n_samples)
+    calibrate         = lambda: csf.calibrate_pmts(wfs, adc_to_pes, out=out, scratch=scratch)
+
+    expected = csf.calibrate_pmts(wfs, adc_to_pes, dtype=dtype)
+    assert all(got is buffer for got, buffer in zip(calibrate(), out))
+    assert all(np.all(got == e) for got, e in zip(out, expected))
+    assert peak_allocated_memory(calibrate) < wfs.nbytes / 20
+
+
+@mark.parametrize("dtype"  , (np.float32, np.float64))
+@mark.parametrize("windows", (None, [(100, 150)]))
+def test_calibrate_sipms_into_out_does_not_allocate_waveforms(dtype, windows):
+    n_sipms, n_samples = 1792, 800
+    wfs                = np.random.poisson(50, size=(n_sipms, n_samples)).astype(np.int16)
+    adc_to_pes         = np.random.uniform(15, 17, size=n_sipms)
+    out                = np.empty(wfs.shape, dtype=dtype)
+    calibrate          = lambda: csf.calibrate_sipms(wfs, adc_to_pes, 1, windows=windows,
+                                                     dtype=dtype, out=out)
+
+    expected = csf.calibrate_sipms(wfs, adc_to_pes, 1, windows=windows, dtype=dtype)
+    assert calibrate() is out
+    assert np.all(out == expected)
+    assert peak_allocated_memory(calibrate) < out.nbytes / 20
+
+
+@mark.parametrize("sparse", (False, True))
+def test_calibrate_sipms_single_precision_close_to_double(toy_sipm_signal, sparse):
+    signal_adc, adc_to_pes, _, _, thr, _ = toy_sipm_signal
+    double = csf.calibrate_sipms(signal_adc, adc_to_pes, thr, sparse=sparse)
+    single = csf.calibrate_sipms(signal_adc, adc_to_pes, thr, sparse=sparse, dtype=np.float32)
+    if sparse:
+        double = double.to_dense()
+        single = single.to_dense()
+
+    assert single.dtype == np.float32
+    assert_allclose(single, double, rtol=1e-6)
+
+
+def zero_suppressed_wfs(dtype, elements):
+    shapes = integers(1, 10).flatmap(lambda n: integers(1, 50).map(lambda m: (n, m)))
+    return arrays(dtype, shapes, elements=one_of(just(0), elements))
+
+
+int_wfs   = one_of(*(zero_suppressed_wfs(dtype, integers(np.iinfo(dtype).min // 2**10, 20))
+                     for dtype in (np.uint8, np.int16, np.uint16, np.int32, np.int64)))
+float_wfs = one_of(*(zero_suppressed_wfs(dtype, floats(-1e3, 1e3, width=width))
+                     for dtype, width in ((np.float32, 32), (np.float64, 64))))
+
+
+@given(int_wfs, integers(0, 1))
+def test_mode_same_as_rowwise_bincount(wfs, axis):
+    expected = np.apply_along_axis(csf._wf_mode, axis, wfs).astype(float)
+    assert np.array_equal(csf.mode(wfs, axis=axis), expected)
+
+
+@given(one_of(int_wfs, float_wfs), integers(0, 1))
+def test_median_same_as_masked_median(wfs, axis):
+    got      = csf.median       (wfs, axis=axis)
+    expected = csf.masked_median(wfs, axis=axis)
+    assert got.dtype == expected.dtype
+    assert np.array_equal(got, expected)
+
+
+@given(int_wfs, sampled_from((2**20, 1)))
+def test_modes_and_medians_same_as_modes_and_medians(wfs, max_bins):
+    modes, medians = csf.modes_and_medians(wfs, max_bins=max_bins)
+    assert np.array_equal(modes  , csf.modes  (wfs))
+    assert np.array_equal(medians, csf.medians(wfs))
+
+
+@given(one_of(int_wfs, float_wfs), integers(0, 1))
+def test_mean_same_as_masked_mean(wfs, axis):
+    got      = csf.mean       (wfs, axis=axis)
+    expected = csf.masked_mean(wfs, axis=axis)
+    assert got.dtype == expected.dtype
+    assert np.array_equal(got, expected)
+
+
+def test_median_is_nan_for_waveforms_with_nan():
+    wfs       = np.array([[1, 0, 2, np.nan],
+                          [1, 0, 2, 3     ],
+                          [0, 0, 0, 0     ]])
+    expected  = np.array([np.nan, 2, 0])
+    assert np.allclose(csf.median(wfs, axis=1), expected, equal_nan=True)
+    assert np.allclose(csf.median(wfs, axis=1), csf.masked_median(wfs, axis=1), equal_nan=True)
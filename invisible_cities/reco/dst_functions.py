@@ -1,4 +1,16 @@
 import numpy  as np
+import tables as tb
+
+from typing import Callable
+from typing import Sequence
+
+from .. core            import system_of_units as units
+from .. core.exceptions import XYRecoFail
+from .. evm .nh5        import KrTable
+from .. evm .pmaps      import _Peak
+from .. evm .pmaps      import PMap
+from .. types.ic_types  import NN
+
 
 def dst_event_id_selection(data, event_ids):
     """Filter a DST by a list of event IDs.
@@ -19,3 +31,199 @@ def dst_event_id_selection(data, event_ids):
     else:
         print(r'DST does not have an "event" field. Data returned is unfiltered.')
         return data
+
+
+def peak_features(peaks : Sequence[_Peak]):
+    """
+    Computes the width, height, energy, time at maximum and rms
+    of a sequence of peaks at once. They match the corresponding
+    properties of each peak.
+
+    Returns
+    -------
+    width, height, energy, time, rms : np.ndarray
+        One entry per peak.
+    """
+    if not len(peaks):
+        return tuple(np.empty(0) for _ in range(5))
+
+    sizes    = np.array([peak.times.size for peak in peaks])
+    starts   = np.cumsum(sizes) - sizes
+    peak     = np.repeat(np.arange(len(peaks)), sizes)
+    times    = np.concatenate([peak.times                 for peak in peaks])
+    widths   = np.concatenate([peak.bin_widths            for peak in peaks])
+    energies = np.concatenate([peak.pmts.sum_over_sensors for peak in peaks])
+
+    above    = energies > 0
+    weights  = np.where(above, energies, 0)
+    width    = np.add    .reduceat(np.where(above, widths, 0), starts)
+    energy   = np.add    .reduceat(weights                   , starts)
+    height   = np.maximum.reduceat(energies                  , starts)
+
+    # First sample at the maximum of each peak
+    at_max   = np.flatnonzero(energies == height[peak])
+    at_max   = at_max[np.unique(peak[at_max], return_index=True)[1]]
+    time     = times[at_max]
+
+    n_above  = np.add.reduceat(above.astype(int), starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.add.reduceat(weights *  times                , starts) / energy
+        var  = np.add.reduceat(weights * (times - mean[peak])**2, starts) / energy
+    rms      = np.where((n_above >= 2) & (energy != 0), np.sqrt(var), 0)
+    return width, height, energy, time, rms
+
+
+def barycenters(peaks    : Sequence[_Peak],
+                sipm_xys : np.ndarray,
+                Qthr     : float = 0):
+    """
+    Computes the barycenter of the sipm charge of each peak at
+    once, as done by `corona` with a negative `lm_radius`. Only
+    sipms with a charge of at least `Qthr` are used.
+
+    Returns
+    -------
+    ok : np.ndarray
+        Whether the position could be reconstructed. The other
+        outputs are meaningless where it could not.
+    nsipm, Q, X, Y, Xrms, Yrms : np.ndarray
+        One entry per peak.
+    """
+    n_peaks  = len(peaks)
+    n_sipms  = np.array([peak.sipms.ids.size for peak in peaks], dtype=int)
+    peak     = np.repeat(np.arange(n_peaks), n_sipms)
+    ids      = np.concatenate([peak.sipms.ids            for peak in peaks] + [np.empty(0, int)])
+    qs       = np.concatenate([peak.sipms.sum_over_times for peak in peaks] + [np.empty(0   )])
+    q_total  = np.bincount(peak, weights=qs, minlength=n_peaks)
+
+    above    = qs >= Qthr
+    peak     = peak[above]
+    qs       = qs  [above]
+    xs, ys   = sipm_xys[ids[above]].T
+
+    nsipm    = np.bincount(peak,             minlength=n_peaks)
+    Q        = np.bincount(peak, weights=qs, minlength=n_peaks)
+    ok       = (n_sipms > 0) & (q_total != 0) & (nsipm > 0) & (Q != 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        X    = np.bincount(peak, weights=qs * xs                , minlength=n_peaks) / Q
+        Y    = np.bincount(peak, weights=qs * ys                , minlength=n_peaks) / Q
+        Xvar = np.bincount(peak, weights=qs * (xs - X[peak])**2, minlength=n_peaks) / Q
+        Yvar = np.bincount(peak, weights=qs * (ys - Y[peak])**2, minlength=n_peaks) / Q
+    return ok, nsipm, Q, X, Y, np.sqrt(Xvar), np.sqrt(Yvar)
+
+
+def clusters_from_reco(peaks    : Sequence[_Peak],
+                       sipm_xys : np.ndarray,
+                       reco     : Callable):
+    """
+    Same as `barycenters`, but calling `reco` on each peak and
+    keeping its first cluster. Used for algorithms other than
+    the barycenter.
+    """
+    output = np.zeros((7, len(peaks)))
+    for i, peak in enumerate(peaks):
+        try:
+            c = reco(sipm_xys[peak.sipms.ids], peak.sipms.sum_over_times)[0]
+        except XYRecoFail:
+            continue
+        output[:, i] = True, c.nsipm, c.Q, c.X, c.Y, c.Xrms, c.Yrms
+    ok, *clusters = output
+    return (ok.astype(bool), *clusters)
+
+
+def build_kr_dst(event_numbers    : Sequence[int],
+                 timestamps       : Sequence[float],
+                 pmaps            : Sequence[PMap],
+                 selector_outputs : Sequence,
+                 drift_v          : float,
+                 xy_reco          : Callable) -> np.ndarray:
+    """
+    Computes the Kr DST rows of a batch of events at once. The
+    output matches `KrEvent.store` for each event: one row per
+    combination of selected S1 and S2.
+
+    Parameters
+    ----------
+    event_numbers, timestamps, pmaps, selector_outputs : Sequence
+        One entry per event.
+    drift_v : float
+        Drift velocity.
+    xy_reco : Callable
+        Function taking a sequence of S2s and returning their
+        clusters as `barycenters` does.
+
+    Returns
+    -------
+    rows : np.ndarray
+        Structured array with the KrTable layout.
+    """
+    def selected(peaks, passed):
+        return [peak for ok, peak in zip(passed, peaks) if ok]
+
+    s1s = [selected(pmap.s1s, output.s1_peaks) for pmap, output in zip(pmaps, selector_outputs)]
+    s2s = [selected(pmap.s2s, output.s2_peaks) for pmap, output in zip(pmaps, selector_outputs)]
+    nS1 = np.array(list(map(len, s1s)), dtype=int)
+    nS2 = np.array(list(map(len, s2s)), dtype=int)
+    s1s = [peak for peaks in s1s for peak in peaks]
+    s2s = [peak for peaks in s2s for peak in peaks]
+
+    # Each event has one row per (S1, S2) pair, S2 running fastest,
+    # or a single one with defaults if it has no S1s or no S2s.
+    n1     = np.maximum(nS1, 1)
+    n2     = np.maximum(nS2, 1)
+    n_rows = n1 * n2
+    evt    = np.repeat(np.arange(n_rows.size), n_rows)
+    k      = np.arange(evt.size) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    i      = k // n2[evt]
+    j      = k %  n2[evt]
+    has_s1 = nS1[evt] > 0
+    has_s2 = nS2[evt] > 0
+
+    # Missing peaks point to the padding at the end of the arrays
+    s1 = np.where(has_s1, (np.cumsum(nS1) - nS1)[evt] + i, len(s1s))
+    s2 = np.where(has_s2, (np.cumsum(nS2) - nS2)[evt] + j, len(s2s))
+
+    def column(values, index, default=np.nan):
+        return np.append(values, default)[index]
+
+    S1w, S1h, S1e, S1t, _    = peak_features(s1s)
+    S2w, S2h, S2e, S2t, S2rz = peak_features(s2s)
+    ok, nsipm, Q, X, Y, Xrms, Yrms = xy_reco(s2s)
+
+    def reco(values):
+        return np.where(ok, values, NN)
+
+    rows = np.zeros(evt.size, dtype=tb.description.dtype_from_descr(KrTable))
+    rows["event"  ] = np.asarray(event_numbers)[evt]
+    rows["time"   ] = np.asarray(timestamps   )[evt] * 1e-3
+    rows["s1_peak"] = np.where(has_s1, i, -1)
+    rows["s2_peak"] = np.where(has_s2, j, -1)
+    rows["nS1"    ] = nS1[evt]
+    rows["nS2"    ] = nS2[evt]
+
+    rows["S1w"    ] = column(S1w, s1)
+    rows["S1h"    ] = column(S1h, s1)
+    rows["S1e"    ] = column(S1e, s1)
+    rows["S1t"    ] = column(S1t, s1)
+
+    rows["S2w"    ] = column(S2w / units.mus, s2)
+    rows["S2h"    ] = column(S2h, s2)
+    rows["S2e"    ] = column(S2e, s2)
+    rows["S2q"    ] = column(reco(Q), s2)
+    rows["S2t"    ] = column(S2t, s2)
+
+    rows["Nsipm"  ] = column(reco(nsipm), s2, 0)
+    rows["Zrms"   ] = column(reco(S2rz / units.mus), s2)
+    rows["X"      ] = column(reco(X)   , s2)
+    rows["Y"      ] = column(reco(Y)   , s2)
+    rows["R"      ] = column(reco(np.sqrt(X**2 + Y**2)), s2)
+    rows["Phi"    ] = column(reco(np.arctan2(Y, X))    , s2)
+    rows["Xrms"   ] = column(reco(Xrms), s2)
+    rows["Yrms"   ] = column(reco(Yrms), s2)
+
+    dt              = column(S2t, s2) - column(S1t, s1)
+    reco_ok         = column(ok, s2, False)
+    both            = has_s1 & has_s2
+    rows["DT"     ] = np.where(both, np.where(reco_ok, dt * units.ns / units.mus, NN), np.nan)
+    rows["Z"      ] = np.where(both, np.where(reco_ok, dt * drift_v            , NN), np.nan)
+    return rows
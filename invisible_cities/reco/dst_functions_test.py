@@ -1,12 +1,38 @@
+import os
+
+from functools import partial
+
 import numpy  as np
 import pandas as pd
+import tables as tb
 
+from pytest                  import approx
 from hypothesis              import given
+from hypothesis              import settings
 from hypothesis.strategies   import integers
+from hypothesis.strategies   import floats
 from hypothesis.strategies   import lists
+from hypothesis.strategies   import booleans
+from hypothesis.strategies   import composite
 from hypothesis.extra.pandas import columns, data_frames
 
-from .  dst_functions import dst_event_id_selection
+from .. core                 import system_of_units as units
+from .. core.exceptions      import XYRecoFail
+from .. evm .nh5             import KrTable
+from .. evm .event_model     import KrEvent
+from .. evm .pmaps           import  PMTResponses
+from .. evm .pmaps           import SiPMResponses
+from .. evm .pmaps           import S1
+from .. evm .pmaps           import S2
+from .. evm .pmaps           import PMap
+from .. evm .pmaps_test      import pmaps as pmap_strategy
+from .. filters.s1s2_filter  import S12SelectorOutput
+from .. types.ic_types       import NN
+from .. types.ic_types       import NNN
+from .  xy_algorithms        import corona
+from .  dst_functions        import dst_event_id_selection
+from .  dst_functions        import barycenters
+from .  dst_functions        import build_kr_dst
 
 
 @given(data_frames(columns=columns(['event'], elements=integers(min_value=-1e5, max_value=1e5))),
@@ -25,3 +51,108 @@ def test_dst_event_id_selection_2():
     df_real_filt = dst_event_id_selection(df_data, [1, 2, 6, 10])
 
     assert np.all(df_real_filt.reset_index(drop=True) == df_filt_data.reset_index(drop=True))
+
+
+@composite
+def kr_batches(draw):
+    pmaps            = [pmap for _, pmap in draw(lists(pmap_strategy(), min_size=1, max_size=4))]
+    selector_outputs = [S12SelectorOutput(True,
+                                          draw(lists(booleans(), min_size=len(pmap.s1s), max_size=len(pmap.s1s))),
+                                          draw(lists(booleans(), min_size=len(pmap.s2s), max_size=len(pmap.s2s))))
+                        for pmap in pmaps]
+    return pmaps, selector_outputs
+
+
+def kr_event_rows(filename, pmaps, selector_outputs, sipm_xys, drift_v, Qthr):
+    # Reference implementation: the KrEvent-based builder of dorothea
+    with tb.open_file(filename, "w") as h5f:
+        table = h5f.create_table(h5f.root, "Events", KrTable)
+        for event_number, (pmap, output) in enumerate(zip(pmaps, selector_outputs)):
+            evt     = KrEvent(event_number, event_number * 10 * 1e-3)
+            evt.nS1 = 0
+            for passed, peak in zip(output.s1_peaks, pmap.s1s):
+                if not passed: continue
+                evt.nS1 += 1
+                evt.S1w.append(peak.width)
+                evt.S1h.append(peak.height)
+                evt.S1e.append(peak.total_energy)
+                evt.S1t.append(peak.time_at_max_energy)
+
+            evt.nS2 = 0
+            for passed, peak in zip(output.s2_peaks, pmap.s2s):
+                if not passed: continue
+                evt.nS2 += 1
+                evt.S2w.append(peak.width / units.mus)
+                evt.S2h.append(peak.height)
+                evt.S2e.append(peak.total_energy)
+                evt.S2t.append(peak.time_at_max_energy)
+                try:
+                    c = corona(sipm_xys[peak.sipms.ids], peak.sipms.sum_over_times, None,
+                               Qthr=Qthr, lm_radius=-1)[0]
+                except XYRecoFail:
+                    c    = NNN()
+                    Z    = DT = tuple(NN for _ in range(evt.nS1))
+                    Zrms = NN
+                else:
+                    DT   = evt.S2t[-1] - np.array(evt.S1t)
+                    Z    = DT * drift_v
+                    DT   = DT * units.ns / units.mus
+                    Zrms = peak.rms / units.mus
+
+                for attr in "Nsipm S2q X Y Xrms Yrms R Phi DT Z Zrms".split():
+                    value = dict(Nsipm=c.nsipm, S2q=c.Q, DT=DT, Z=Z, Zrms=Zrms).get(attr)
+                    getattr(evt, attr).append(getattr(c, attr) if value is None else value)
+
+            if evt.nS2: evt.store(table)
+        table.flush()
+        return table.read()
+
+
+@settings(max_examples=50)
+@given(kr_batches(), floats(0, 20))
+def test_build_kr_dst_same_as_KrEvent(output_tmpdir, batch, Qthr):
+    pmaps, selector_outputs = batch
+    drift_v  = 1 * units.mm / units.mus
+    sipm_xys = np.random.uniform(-200, 200, size=(1001, 2))
+
+    # KrEvent.store cannot deal with events without S2s
+    with_s2s         = [i for i, output in enumerate(selector_outputs) if any(output.s2_peaks)]
+    pmaps            = [pmaps           [i] for i in with_s2s]
+    selector_outputs = [selector_outputs[i] for i in with_s2s]
+
+    filename = os.path.join(output_tmpdir, "test_build_kr_dst.h5")
+    expected = kr_event_rows(filename, pmaps, selector_outputs, sipm_xys, drift_v, Qthr)
+    xy_reco  = partial(barycenters, sipm_xys=sipm_xys, Qthr=Qthr)
+    got      = build_kr_dst(np.arange(len(pmaps)), np.arange(len(pmaps)) * 10.,
+                            pmaps, selector_outputs, drift_v, xy_reco)
+
+    assert got.dtype == expected.dtype
+    assert len(got)  == len(expected)
+    for name in got.dtype.names:
+        assert np.allclose(got[name], expected[name], equal_nan=True), name
+
+
+def test_build_kr_dst_events_without_s1s_or_s2s():
+    times    = np.arange(3.)
+    widths   = np.ones(3)
+    pmt_r    =  PMTResponses([0], np.ones((1, 3)))
+    sipm_r   = SiPMResponses([0, 1], np.ones((2, 3)))
+    s1       = S1(times, widths, pmt_r, SiPMResponses.build_empty_instance())
+    s2       = S2(times, widths, pmt_r, sipm_r)
+    pmaps    = [PMap([s1], []), PMap([], [s2, s2]), PMap([s1, s1], [s2])]
+    outputs  = [S12SelectorOutput(True, [True], []),
+                S12SelectorOutput(True, [], [True, True]),
+                S12SelectorOutput(True, [True, False], [True])]
+    sipm_xys = np.array([[0., 0.], [10., 0.]])
+    xy_reco  = partial(barycenters, sipm_xys=sipm_xys)
+    rows     = build_kr_dst([1, 2, 3], [0, 0, 0], pmaps, outputs, 1, xy_reco)
+
+    assert rows["event"  ] == approx([1, 2, 2, 3])
+    assert rows["nS1"    ] == approx([1, 0, 0, 1])
+    assert rows["nS2"    ] == approx([0, 2, 2, 1])
+    assert rows["s1_peak"] == approx([0, 65535, 65535, 0])
+    assert rows["s2_peak"] == approx([65535, 0, 1, 0])
+    assert rows["Nsipm"  ] == approx([0, 2, 2, 2])
+    assert rows["X"      ] == approx([np.nan, 5, 5, 5], nan_ok=True)
+    assert np.isnan(rows["Z"][:3]).all()
+    assert rows["Z"][3] == approx(0)
@@ -11,12 +11,29 @@ last revised: @abotas & @gonzaponte. Dec 1st 2017
 import numpy        as np
 
 from .. core               import system_of_units as units
+from .. core               import core_functions_c as core_c
 from .. evm .ic_containers import ZsWf
 from .. evm .pmaps         import S1
 from .. evm .pmaps         import S2
 from .. evm .pmaps         import PMap
 from .. evm .pmaps         import PMTResponses
 from .. evm .pmaps         import SiPMResponses
+from .. evm .sparse_wfs    import SparseWfs
+
+
+def float_type(dtype):
+    """
+    Floating point type used to process waveforms of type `dtype`:
+    single precision for single precision, double otherwise.
+    """
+    return np.float32 if dtype == np.float32 else np.float64
+
+
+def _compiled_rebin(waveforms):
+    # The compiled kernels take the types of `core_c.sample_t` and
+    # cannot take read-only waveforms
+    return (waveforms.dtype in (np.int16, np.int32, np.int64, np.float32, np.float64) and
+            waveforms.flags.writeable)
 
 
 def indices_and_wf_above_threshold(wf, thr):
@@ -56,7 +73,8 @@ def pick_slice_and_rebin(indices, times, widths,
         n_wfs  = wfs.shape[0]
         times_  = np.concatenate([np.zeros(        n_miss) ,  times_])
         widths_ = np.concatenate([np.zeros(        n_miss) , widths_])
-        wfs_    = np.concatenate([np.zeros((n_wfs, n_miss)),    wfs_], axis=1)
+        zeros_  = np.zeros((n_wfs, n_miss), dtype=float_type(wfs.dtype))
+        wfs_    = np.concatenate([zeros_, wfs_], axis=1)
     (times ,
      widths,
      wfs   ) = rebin_times_and_waveforms(times_, widths_, wfs_, rebin_stride)
@@ -77,6 +95,10 @@ def build_pmt_responses(indices, times, widths, ccwf,
 
 def build_sipm_responses(indices, times, widths,
                          sipm_wfs, rebin_stride, thr_sipm_s2):
+    if isinstance(sipm_wfs, SparseWfs):
+        return build_sparse_sipm_responses(indices, sipm_wfs,
+                                           rebin_stride, thr_sipm_s2)
+
     _, _, sipm_wfs_ = pick_slice_and_rebin(indices , times, widths,
                                            sipm_wfs, rebin_stride,
                                            pad_zeros = False)
@@ -86,6 +108,19 @@ def build_sipm_responses(indices, times, widths,
     return SiPMResponses(sipm_ids, sipm_wfs)
 
 
+def build_sparse_sipm_responses(indices, sipm_wfs, rebin_stride, thr_sipm_s2):
+    """
+    Same as `build_sipm_responses` for SiPM waveforms in a
+    `SparseWfs`. Only the sensors with some sample in the peak are
+    rebinned, unless the threshold lets through empty sensors.
+    """
+    (sipm_ids,
+     sipm_wfs) = sipm_wfs.rebinned_window(indices[0], indices[-1] + 1, rebin_stride,
+                                          all_sensors = thr_sipm_s2 <= 0)
+    selected   = np.sum(sipm_wfs, axis=1) >= thr_sipm_s2
+    return SiPMResponses(sipm_ids[selected], sipm_wfs[selected])
+
+
 def build_peak(indices, times,
                widths, ccwf, pmt_ids,
                rebin_stride,
@@ -141,6 +176,21 @@ def find_peaks(ccwfs, index,
     return peaks
 
 
+def sipm_windows(index, time, length, stride,
+                 pmt_samp_wid  = 25 * units.ns,
+                 sipm_samp_wid =  1 * units.mus):
+    """
+    SiPM sample ranges [start, stop) read by `find_peaks` to build
+    the SiPM responses of the peaks found in `index` with the same
+    parameters.
+    """
+    sipm_pmt_bin_ratio = int(sipm_samp_wid/pmt_samp_wid)
+    indices_split      = split_in_peaks(index, stride)
+    selected_splits    = select_peaks  (indices_split, time, length, pmt_samp_wid)
+    return [(indices[ 0] // sipm_pmt_bin_ratio,
+             indices[-1] // sipm_pmt_bin_ratio + 1) for indices in selected_splits]
+
+
 def get_pmap(ccwf, s1_indx, s2_indx, sipm_zs_wf,
              s1_params, s2_params, thr_sipm_s2, pmt_ids,
              pmt_samp_wid, sipm_samp_wid):
@@ -157,27 +207,83 @@ def get_pmap(ccwf, s1_indx, s2_indx, sipm_zs_wf,
 
 def rebin_times_and_waveforms(times, widths, waveforms,
                               rebin_stride=2, slices=None):
-    if rebin_stride < 2: return times, widths, waveforms
+    # The output never shares memory with the input, which may be
+    # a buffer that is overwritten for the next event
+    if rebin_stride < 2: return np.array(times), np.array(widths), np.array(waveforms)
 
     if slices is None:
-        n_bins = int(np.ceil(len(times) / rebin_stride))
-        reb    = rebin_stride
-        slices = [slice(reb * i, reb * (i + 1)) for i in range(n_bins)]
-    n_sensors = waveforms.shape[0]
-
-    rebinned_times  = np.zeros(            len(slices) )
-    rebinned_widths = np.zeros(            len(slices) )
-    rebinned_wfs    = np.zeros((n_sensors, len(slices)))
-
-    for i, sl in enumerate(slices):
-        t = times    [   sl]
-        e = waveforms[:, sl]
-        ## Weight with the charge sum per slice
-        ## if positive and unweighted if all
-        ## negative.
-        s = np.sum(e, axis=0).clip(0)
-        w = s if np.any(s) else None
-        rebinned_times [   i] = np.average(t, weights=w)
-        rebinned_widths[   i] = np.sum    (  widths[sl])
-        rebinned_wfs   [:, i] = np.sum    (e,    axis=1)
+        starts = np.arange(0, len(times), rebin_stride)
+        stop   = len(times)
+    else:
+        starts, stop = slice_starts(slices, len(times))
+
+    return rebin_at(times[:stop], widths[:stop], waveforms[:, :stop], starts)
+
+
+def slice_starts(slices, n_samples):
+    """
+    First sample of each slice and last+1 sample covered by
+    `slices`, which must be contiguous and start at 0.
+    """
+    starts = np.array([sl.start for sl in slices], dtype=int)
+    stops  = np.array([sl.stop  for sl in slices], dtype=int)
+    if np.any(starts[1:] != stops[:-1]) or np.any(starts[:1] != 0):
+        raise ValueError("Slices must be contiguous and start at 0")
+
+    stop = min(stops[-1], n_samples) if len(slices) else 0
+    return starts, stop
+
+
+def rebin_waveforms(waveforms, starts):
+    """
+    Sum the samples in [starts[i], starts[i+1]) of all waveforms
+    into bin i. Single precision waveforms are kept in single
+    precision, anything else is summed in double precision.
+    """
+    waveforms = np.asarray(waveforms)
+    dtype     = float_type(waveforms.dtype)
+    if not len(starts):
+        return np.zeros((waveforms.shape[0], 0), dtype=dtype)
+    if not _compiled_rebin(waveforms):
+        return np.add.reduceat(waveforms, starts, axis=1, dtype=dtype)
+
+    out = np.empty((waveforms.shape[0], len(starts)), dtype=dtype)
+    return core_c.window_sums(waveforms, np.asarray(starts, dtype=np.int64), out)
+
+
+def rebin_at(times, widths, waveforms, starts):
+    """
+    Rebin times, widths and waveforms merging the samples in
+    [starts[i], starts[i+1]) into bin i. The times are weighted
+    with the clipped-at-zero sum over sensors of each sample, or
+    unweighted in bins where that sum is all zero. All bins and
+    sensors are processed at once.
+    """
+    waveforms = np.asarray(waveforms)
+    if len(starts) and _compiled_rebin(waveforms):
+        rebinned_wfs = np.empty((waveforms.shape[0], len(starts)), dtype=float_type(waveforms.dtype))
+        rebinned_times, rebinned_widths = core_c.weighted_rebin(np.asarray(times , dtype=np.float64),
+                                                                np.asarray(widths, dtype=np.float64),
+                                                                waveforms,
+                                                                np.asarray(starts, dtype=np.int64),
+                                                                rebinned_wfs)
+        return rebinned_times, rebinned_widths, rebinned_wfs
+
+    rebinned_wfs = rebin_waveforms(waveforms, starts)
+    if not len(starts):
+        return np.zeros(0), np.zeros(0), rebinned_wfs
+
+    times   = np.asarray(times, dtype=np.float64)
+    weights = np.sum(waveforms, axis=0, dtype=np.float64).clip(0)
+    n_in    = np.diff(np.append(starts, len(times)))
+
+    sum_w  = np.add.reduceat(weights        , starts)
+    sum_tw = np.add.reduceat(weights * times, starts)
+    mean_t = np.add.reduceat(          times, starts) / n_in
+
+    ## Weight with the charge sum per slice
+    ## if positive and unweighted if all
+    ## negative.
+    rebinned_times  = np.divide(sum_tw, sum_w, out=mean_t, where=sum_w > 0)
+    rebinned_widths = np.add.reduceat(widths, starts, dtype=np.float64)
     return rebinned_times, rebinned_widths, rebinned_wfs
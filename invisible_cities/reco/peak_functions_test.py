@@ -5,6 +5,7 @@ import numpy as np
 from pytest import approx
 from pytest import mark
 from pytest import fixture
+from pytest import raises
 
 from hypothesis               import given
 from hypothesis               import assume
@@ -17,6 +18,7 @@ from ..core.testing_utils   import exactly
 from ..core.testing_utils   import previous_float
 from ..core.testing_utils   import assert_Peak_equality
 from ..core.testing_utils   import assert_PMap_equality
+from ..core.testing_utils   import execution_time
 from ..core                 import system_of_units as units
 from ..core.fit_functions   import gauss
 from ..evm .pmaps           import PMTResponses
@@ -24,6 +26,9 @@ from ..evm .pmaps           import SiPMResponses
 from ..evm .pmaps           import S1
 from ..evm .pmaps           import S2
 from ..evm .pmaps           import PMap
+from ..evm .sparse_wfs      import SparseWfs
+from ..evm .pmaps_test      import EagerS1
+from ..evm .pmaps_test      import EagerS2
 from ..io  .pmaps_io        import load_pmaps
 from ..types.ic_types       import minmax
 from .                      import peak_functions as pf
@@ -333,6 +338,19 @@ def test_pick_slice_and_rebin(wfs_slice_data):
     assert sliced_wfs    == approx(   wfs_slice)
 
 
+@mark.parametrize("rebin_stride", (1, 2))
+def test_pick_slice_and_rebin_does_not_share_memory_with_input(rebin_stride):
+    # The waveforms may be a buffer that is overwritten for the next event
+    times   = np.arange(10.)
+    widths  = np.ones  (10)
+    wfs     = np.ones  ((2, 10))
+    indices = np.arange(2, 8)
+    picked  = pf.pick_slice_and_rebin(indices, times, widths, wfs, rebin_stride)
+
+    for output, input_ in zip(picked, (times, widths, wfs)):
+        assert not np.shares_memory(output, input_)
+
+
 def test_build_pmt_responses(wf_with_indices):
     times, widths, wfs, indices = wf_with_indices
     ids = np.arange(wfs.shape[0])
@@ -527,6 +545,72 @@ def test_get_pmap(s1_and_s2_with_indices):
     assert_PMap_equality(pmap, expected_pmap)
 
 
+def test_get_pmap_only_uses_sipms_in_sipm_windows(s1_and_s2_with_indices):
+    (times, widths, pmt_wfs, sipm_wfs,
+     s1_indx, s2_indx, sipm_indices,
+     s1_params, s2_params) = s1_and_s2_with_indices
+    pmt_ids = np.arange(pmt_wfs.shape[0])
+
+    windows = pf.sipm_windows(s2_indx, s2_params["time"], s2_params["length"], s2_params["stride"])
+    assert windows == [(sipm_indices[0], sipm_indices[-1] + 1)]
+
+    sipm_wfs_in_windows = np.zeros_like(sipm_wfs)
+    for start, stop in windows:
+        sipm_wfs_in_windows[:, start:stop] = sipm_wfs[:, start:stop]
+
+    pmaps = [pf.get_pmap(pmt_wfs, s1_indx, s2_indx, wfs,
+                         s1_params, s2_params,
+                         thr_sipm_s2   = -1,
+                         pmt_ids       = pmt_ids,
+                         pmt_samp_wid  = 25 * units.ns,
+                         sipm_samp_wid =  1 * units.mus)
+             for wfs in (sipm_wfs, sipm_wfs_in_windows)]
+    assert_PMap_equality(*pmaps)
+
+
+@mark.parametrize("thr_sipm_s2", (-1, 0, 10))
+def test_get_pmap_with_sparse_sipm_wfs(s1_and_s2_with_indices, thr_sipm_s2):
+    (times, widths, pmt_wfs, sipm_wfs,
+     s1_indx, s2_indx, sipm_indices,
+     s1_params, s2_params) = s1_and_s2_with_indices
+    pmt_ids  = np.arange(pmt_wfs.shape[0])
+    sipm_wfs = sipm_wfs.astype(np.float32)
+
+    pmaps = [pf.get_pmap(pmt_wfs, s1_indx, s2_indx, wfs,
+                         s1_params, s2_params,
+                         thr_sipm_s2   = thr_sipm_s2,
+                         pmt_ids       = pmt_ids,
+                         pmt_samp_wid  = 25 * units.ns,
+                         sipm_samp_wid =  1 * units.mus)
+             for wfs in (sipm_wfs, SparseWfs.from_dense(sipm_wfs))]
+    assert_PMap_equality(*pmaps)
+
+
+def test_get_pmap_single_precision_close_to_double(s1_and_s2_with_indices):
+    (times, widths, pmt_wfs, sipm_wfs,
+     s1_indx, s2_indx, sipm_indices,
+     s1_params, s2_params) = s1_and_s2_with_indices
+    pmt_ids = np.arange(pmt_wfs.shape[0])
+
+    double, single = [pf.get_pmap(pmt_wfs.astype(dtype), s1_indx, s2_indx, sipm_wfs.astype(dtype),
+                                  s1_params, s2_params,
+                                  thr_sipm_s2   = -1,
+                                  pmt_ids       = pmt_ids,
+                                  pmt_samp_wid  = 25 * units.ns,
+                                  sipm_samp_wid =  1 * units.mus)
+                      for dtype in (np.float64, np.float32)]
+
+    for peaks_double, peaks_single in ((double.s1s, single.s1s), (double.s2s, single.s2s)):
+        assert len(peaks_single) == len(peaks_double)
+        for peak_double, peak_single in zip(peaks_double, peaks_single):
+            assert peak_single.pmts .all_waveforms.dtype == np.float32
+            assert np.allclose(peak_single.times                , peak_double.times                , rtol=1e-6)
+            assert np.allclose(peak_single.pmts .all_waveforms  , peak_double.pmts .all_waveforms  , rtol=1e-6)
+            assert np.allclose(peak_single.sipms.all_waveforms  , peak_double.sipms.all_waveforms  , rtol=1e-6)
+            assert np.all     (peak_single.sipms.ids           == peak_double.sipms.ids)
+
+    assert single.s2s[0].sipms.all_waveforms.dtype == np.float32
+
 @given(times_and_waveforms(), integers(2, 10))
 def test_rebin_times_and_waveforms_sum_axis_1_does_not_change(t_and_wf, stride):
     times, wfs    = t_and_wf
@@ -559,6 +643,61 @@ def test_rebin_times_and_waveforms_number_of_wfs_does_not_change(t_and_wf, strid
     assert len(wfs) == len(rb_wfs)
 
 
+def _rebin_times_and_waveforms_loop(times, widths, waveforms, slices):
+    # Reference implementation, one slice at a time
+    rebinned_times  = np.zeros(                    len(slices) )
+    rebinned_widths = np.zeros(                    len(slices) )
+    rebinned_wfs    = np.zeros((waveforms.shape[0], len(slices)))
+    for i, sl in enumerate(slices):
+        e = waveforms[:, sl]
+        s = np.sum(e, axis=0).clip(0)
+        rebinned_times [   i] = np.average(times[sl], weights=s if np.any(s) else None)
+        rebinned_widths[   i] = np.sum    (widths[sl])
+        rebinned_wfs   [:, i] = np.sum    (e, axis=1)
+    return rebinned_times, rebinned_widths, rebinned_wfs
+
+
+@given(times_and_waveforms(), integers(2, 10), floats(-wf_max, 0))
+def test_rebin_times_and_waveforms_same_as_slice_by_slice(t_and_wf, stride, offset):
+    times, wfs = t_and_wf
+    # Shift some waveforms below zero to exercise the unweighted case
+    wfs        = wfs + offset
+    widths     = np.ones_like(times)
+    n_bins     = int(np.ceil(len(times) / stride))
+    slices     = [slice(stride * i, stride * (i + 1)) for i in range(n_bins)]
+
+    expected = _rebin_times_and_waveforms_loop(times, widths, wfs, slices)
+    rebinned = pf.rebin_times_and_waveforms   (times, widths, wfs, stride)
+    for got, expected in zip(rebinned, expected):
+        assert got == approx(expected)
+
+
+@mark.parametrize("dtype", (np.int16, np.float32, np.float64))
+def test_rebin_at_compiled_same_as_numpy(dtype):
+    rng       = np.random.default_rng(321)
+    wfs       = rng.uniform(-10, 100, size=(5, 1000)).astype(dtype)
+    times     = np.cumsum(rng.uniform(20, 30, size=1000))
+    widths    = rng.uniform(20, 30, size=1000)
+    starts    = np.array([0, 7, 8, 200, 333, 990])
+    # Read-only waveforms are rebinned with numpy
+    read_only = wfs.copy()
+    read_only.flags.writeable = False
+
+    compiled = pf.rebin_at(times, widths, wfs      , starts)
+    numpy    = pf.rebin_at(times, widths, read_only, starts)
+    for got, expected in zip(compiled, numpy):
+        assert got.dtype == expected.dtype
+        assert np.all(got == expected)
+
+
+def test_rebin_times_and_waveforms_raises_ValueError_with_non_contiguous_slices():
+    times  = np.arange(10.)
+    wfs    = np.ones((2, 10))
+    slices = [slice(0, 3), slice(4, 10)]
+    with raises(ValueError):
+        pf.rebin_times_and_waveforms(times, times, wfs, slices=slices)
+
+
 @given(times_and_waveforms(), integers(2, 10))
 def test_rebin_times_and_waveforms_number_of_bins_is_correct(t_and_wf, stride):
     times, wfs       = t_and_wf
@@ -614,3 +753,53 @@ def test_rebin_times_and_waveforms_negative_bins(ICDATADIR):
     pf.rebin_times_and_waveforms(s2.times             ,
                                  s2.bin_widths        ,
                                  s2.pmts.all_waveforms)
+
+
+def irene_like_event(rng):
+    # 12 PMTs and 1792 SiPMs, with many S1 candidates and two S2s
+    n_pmt, n_sipm, n_samples = 12, 1792, 52000
+    pmt_wfs = rng.normal(0, 0.5, size=(n_pmt, n_samples))
+    for start in rng.choice(np.arange(1000, 20000, 100), size=30, replace=False):
+        pmt_wfs[:, start : start + rng.integers(2, 15)] += rng.uniform(1, 5)
+    for start in (24000, 32000):
+        pmt_wfs[:, start : start + 800] += 20
+
+    sipm_wfs = np.zeros((n_sipm, n_samples // 40))
+    sipms    = rng.choice(n_sipm, size=40, replace=False)
+    sipm_wfs[sipms[:, np.newaxis], np.r_[600:620, 800:820]] = rng.uniform(1, 10, size=(40, 40))
+
+    summed  = np.sum(pmt_wfs, axis=0)
+    s1_indx = np.flatnonzero(summed[:22000] > 10)
+    s2_indx = np.flatnonzero(summed[22000:] > 50) + 22000
+    return pmt_wfs, sipm_wfs, s1_indx, s2_indx
+
+
+@mark.benchmark
+def test_get_pmap_faster_than_with_eager_peaks(monkeypatch):
+    rng       = np.random.default_rng(28)
+    events    = [irene_like_event(rng) for _ in range(3)]
+    s1_params = dict(time         = minmax(  0 * units.mus,  600 * units.mus),
+                     length       = minmax(  4               ,   20           ),
+                     stride       =  4,
+                     rebin_stride =  1)
+    s2_params = dict(time         = minmax(500 * units.mus, 1300 * units.mus),
+                     length       = minmax( 80               , 1e5            ),
+                     stride       = 40,
+                     rebin_stride = 40)
+
+    def build_pmaps(events):
+        return [pf.get_pmap(pmt_wfs, s1_indx, s2_indx, sipm_wfs, s1_params, s2_params,
+                            thr_sipm_s2   = 1,
+                            pmt_ids       = np.arange(12),
+                            pmt_samp_wid  = 25 * units.ns,
+                            sipm_samp_wid =  1 * units.mus)
+                for pmt_wfs, sipm_wfs, s1_indx, s2_indx in events]
+
+    # The test is meaningful only with many peaks
+    assert sum(len(pmap.s1s) for pmap in build_pmaps(events)) > 50
+    lazy = execution_time(build_pmaps, events)
+    monkeypatch.setattr(pf, "S1", EagerS1)
+    monkeypatch.setattr(pf, "S2", EagerS2)
+    eager = execution_time(build_pmaps, events)
+    print(f"get_pmap: {lazy * 1e3:.1f} ms, with eager peaks: {eager * 1e3:.1f} ms")
+    assert lazy < eager
@@ -2,12 +2,14 @@ from enum import Enum
 
 import numpy as np
 
-from typing import List, Union
+from typing import List, Sequence, Union
 
 from ..evm.pmaps           import                     _Peak
 from ..evm.pmaps           import              PMTResponses
 from ..evm.pmaps           import             SiPMResponses
-from . peak_functions      import rebin_times_and_waveforms
+from . peak_functions      import                  rebin_at
+from . peak_functions      import           rebin_waveforms
+from . peak_functions      import              slice_starts
 from ..core.core_functions import        dict_filter_by_key
 
 
@@ -21,29 +23,115 @@ def get_even_slices(bins : int, stride : int) -> List[slice]:
     return [slice(stride * i, stride * (i + 1)) for i in range(new_bins)]
 
 
-def get_threshold_slices(pmt_sum   : np.array,
-                         threshold :    float) -> List[slice]:
-    slices     = []
-    last_index = 0
-    last_sum   = 0
+def _first_reaching(sums : np.ndarray, threshold : float) -> np.ndarray:
+    """
+    For each element of the sorted array `sums`, the index of the
+    first of the following elements that exceeds it by at least
+    `threshold`, or `len(sums)` if there is none. A search with
+    the threshold widened by the rounding error brackets each
+    index, and a bisection within the brackets, done for all
+    elements at once, compares the differences of the sums as
+    the sample-by-sample definition does.
+    """
+    n         = len(sums)
+    tolerance = 4 * np.finfo(float).eps * (np.abs(sums).max() + abs(threshold))
+    lo        = np.searchsorted(sums, sums + threshold - tolerance, side="left" )
+    hi        = np.searchsorted(sums, sums + threshold + tolerance, side="right")
+    lo        = np.maximum(lo, np.arange(1, n + 1))
+    hi        = np.clip   (hi, lo, n)
+    active    = lo < hi
+    while np.any(active):
+        mid     = (lo + hi) // 2
+        reached = sums[np.minimum(mid, n - 1)] - sums >= threshold
+        hi      = np.where(active &  reached, mid    , hi)
+        lo      = np.where(active & ~reached, mid + 1, lo)
+        active  = lo < hi
+    return lo
+
+
+def _path_from_first(following : np.ndarray) -> np.ndarray:
+    """
+    Indices visited by following `following` from the first
+    element until it points past the end, with all the jumps
+    resolved at once by doubling them.
+    """
+    n       = len(following)
+    jumps   = [np.append(following, n)]
+    while jumps[-1][0] < n:
+        jumps.append(jumps[-1][jumps[-1]])
+
+    node, n_steps = 0, 0
+    for power in reversed(range(len(jumps))):
+        if jumps[power][node] < n:
+            node     = jumps[power][node]
+            n_steps += 1 << power
 
-    def slice_condition(indx, charge, prev_charge):
-        if i == len(pmt_sum) - 1 or charge - prev_charge >= threshold:
-            return True
-        return False
+    steps = np.arange(n_steps + 1)
+    path  = np.zeros_like(steps)
+    for power, jump in enumerate(jumps):
+        path = np.where(steps >> power & 1, jump[path], path)
+    return path
 
-    for i, sum_val in enumerate(np.cumsum(pmt_sum)):
-        if slice_condition(i, sum_val, last_sum):
-            slices.append(slice(last_index, i + 1))
 
-            last_index = i + 1
-            last_sum   = sum_val
+def get_threshold_slices(pmt_sum   : np.array,
+                         threshold :    float) -> List[slice]:
+    """
+    Split a waveform in consecutive slices each of which holds
+    at least `threshold` charge. The last slice is merged with
+    the previous one if it does not reach the threshold. Only
+    the samples where the cumulative sum reaches a new maximum
+    can close a slice. The boundary that follows each of them and
+    the chain of boundaries starting at the first sample are found
+    with array operations, without looping over slices.
+    """
+    cumsum    = np.cumsum(pmt_sum)
+    n_samples = len(pmt_sum)
+    maximum   = np.maximum.accumulate(np.append(0., cumsum))[:-1]
+    stops     = np.append(0, np.flatnonzero(cumsum >= maximum) + 1)
+    sums      = np.append(0., cumsum[stops[1:] - 1])
+    bounds    = stops[_path_from_first(_first_reaching(sums, threshold))]
+    if bounds[-1] < n_samples:
+        bounds = np.append(bounds, n_samples)
 
+    slices = list(map(slice, bounds[:-1].tolist(), bounds[1:].tolist()))
     if len(slices) > 1 and pmt_sum[slices[-1]].sum() < threshold:
         slices[-2:] = [slice(slices[-2].start, slices[-1].stop)]
     return slices
 
 
+def get_slices_above_threshold(peaks     : Sequence[_Peak],
+                               threshold :           float) -> List[np.ndarray]:
+    """
+    Boolean mask of the slices of each peak whose SiPM charge,
+    summed over sensors, is above `threshold`. The comparison is
+    done for all the slices of all the peaks at once. Peaks
+    without SiPMs have no slice above threshold.
+    """
+    def sipm_sum(peak):
+        if peak.sipms.ids.size: return peak.sipms.sum_over_sensors
+        return np.zeros(peak.times.size)
+
+    if not len(peaks): return []
+
+    above_thr = np.concatenate(list(map(sipm_sum, peaks))) > threshold
+    bin_edges = np.cumsum([peak.times.size for peak in peaks])[:-1]
+    return np.split(above_thr, bin_edges)
+
+
+def select_slices(peak : _Peak, selection : np.ndarray):
+    """
+    Times, bin widths, PMT and SiPM waveforms of the slices of
+    `peak` given by `selection` (boolean mask or indices),
+    without building a new peak.
+    """
+    times    = peak.times     [selection]
+    widths   = peak.bin_widths[selection]
+    pmt_wfs  = peak.pmts.all_waveforms[:, selection]
+    sipm_wfs = (peak.sipms.all_waveforms[:, selection] if peak.sipms.ids.size else
+                np.zeros((0, times.size)))
+    return times, widths, pmt_wfs, sipm_wfs
+
+
 def rebin_peak(peak : _Peak, rebin_factor : Union[int, float],
                model=RebinMethod.stride) -> _Peak:
     """
@@ -66,34 +154,90 @@ def rebin_peak(peak : _Peak, rebin_factor : Union[int, float],
     -------
     The rebinned version of the peak
     """
-    if model == RebinMethod.threshold:
-        slices = get_threshold_slices(peak.pmts.sum_over_sensors,
-                                      rebin_factor)
-    else:
-        if rebin_factor <= 1: return peak
-        slices = get_even_slices(peak.times.shape[0], rebin_factor)
+    if model == RebinMethod.stride and rebin_factor <= 1: return peak
 
-    return rebin_peak_to_slices(peak, slices)
+    return rebin_peak_to_slices(peak, get_rebin_slices(peak, rebin_factor, model))
+
+
+def rebin_peaks(peaks : Sequence[_Peak], rebin_factor : Union[int, float],
+                model=RebinMethod.stride) -> List[_Peak]:
+    """
+    Rebin several peaks with the same parameters. Equivalent
+    to applying `rebin_peak` to each of them, but the PMT
+    responses of all peaks are rebinned in a single call when
+    they share the same PMT ids.
+
+    Parameters
+    ----------
+    peaks : sequence of _Peak objects
+        The Peaks to be rebinned
+    rebin_factor : int or float
+        See `rebin_peak`
+    model : Enum
+        See `rebin_peak`
+
+    Returns
+    -------
+    The rebinned version of each peak
+    """
+    peaks = list(peaks)
+    if not peaks                                        : return peaks
+    if model == RebinMethod.stride and rebin_factor <= 1: return peaks
+
+    pmt_ids = peaks[0].pmts.ids
+    if not all(np.array_equal(peak.pmts.ids, pmt_ids) for peak in peaks):
+        return [rebin_peak(peak, rebin_factor, model) for peak in peaks]
+
+    slices        = [get_rebin_slices(peak, rebin_factor, model) for peak in peaks]
+    starts, stops = zip(*map(slice_starts, slices, (peak.times.size for peak in peaks)))
+    offsets       = np.cumsum((0,) + stops)[:-1]
+
+    (times ,
+     widths,
+     pmt_wfs) = rebin_at(np.concatenate([peak.times                [   :stop] for peak, stop in zip(peaks, stops)]),
+                         np.concatenate([peak.bin_widths           [   :stop] for peak, stop in zip(peaks, stops)]),
+                         np.concatenate([peak.pmts.all_waveforms   [:, :stop] for peak, stop in zip(peaks, stops)], axis=1),
+                         np.concatenate([peak_starts + offset for peak_starts, offset in zip(starts, offsets)]))
+
+    bin_edges = np.cumsum(list(map(len, starts)))[:-1]
+    times     = np.split(times  , bin_edges)
+    widths    = np.split(widths , bin_edges)
+    pmt_wfs   = np.split(pmt_wfs, bin_edges, axis=1)
+
+    rebinned  = []
+    for i, peak in enumerate(peaks):
+        pmt_r  = PMTResponses(peak.pmts.ids, pmt_wfs[i])
+        sipm_r = SiPMResponses.build_empty_instance()
+        if peak.sipms.ids.size:
+            sipms  = rebin_waveforms(peak.sipms.all_waveforms[:, :stops[i]], starts[i])
+            sipm_r = SiPMResponses(peak.sipms.ids, sipms)
+
+        rebinned.append(type(peak)(times[i], widths[i], pmt_r, sipm_r))
+    return rebinned
+
+
+def get_rebin_slices(peak : _Peak, rebin_factor : Union[int, float],
+                     model=RebinMethod.stride) -> List[slice]:
+    if model == RebinMethod.threshold:
+        return get_threshold_slices(peak.pmts.sum_over_sensors, rebin_factor)
+    return get_even_slices(peak.times.shape[0], rebin_factor)
 
 
 def rebin_peak_to_slices(peak : _Peak, slices : List[slice]) -> _Peak:
+    starts, stop = slice_starts(slices, peak.times.size)
 
     (times,
      widths,
-     pmt_wfs) = rebin_times_and_waveforms(peak.times,
-                                          peak.bin_widths,
-                                          peak.pmts.all_waveforms,
-                                          slices = slices)
+     pmt_wfs) = rebin_at(peak.times             [   :stop],
+                         peak.bin_widths        [   :stop],
+                         peak.pmts.all_waveforms[:, :stop],
+                         starts)
 
     pmt_r  = PMTResponses(peak.pmts.ids, pmt_wfs)
 
     sipm_r = SiPMResponses.build_empty_instance()
     if peak.sipms.ids.size:
-        *_, sipms = rebin_times_and_waveforms(peak.times,
-                                              peak.bin_widths,
-                                              peak.sipms.all_waveforms,
-                                              slices = slices)
-
+        sipms  = rebin_waveforms(peak.sipms.all_waveforms[:, :stop], starts)
         sipm_r = SiPMResponses(peak.sipms.ids, sipms)
 
     return type(peak)(times, widths, pmt_r, sipm_r)
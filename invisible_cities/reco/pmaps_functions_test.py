@@ -10,6 +10,7 @@ from hypothesis.strategies import integers
 from hypothesis.strategies import floats
 from hypothesis.strategies import dictionaries
 from hypothesis.strategies import lists
+from hypothesis.extra.numpy import arrays
 
 from .. evm .pmaps_test     import peaks
 from .. evm .pmaps_test     import pmaps
@@ -109,6 +110,107 @@ def test_rebin_peak_threshold(threshold, pk):
         assert np.all(rebinned_pk.pmts.sum_over_sensors >= threshold)
 
 
+def _get_threshold_slices_loop(pmt_sum, threshold):
+    # Reference implementation, one sample at a time
+    slices     = []
+    last_index = 0
+    last_sum   = 0
+    for i, sum_val in enumerate(np.cumsum(pmt_sum)):
+        if i == len(pmt_sum) - 1 or sum_val - last_sum >= threshold:
+            slices.append(slice(last_index, i + 1))
+            last_index = i + 1
+            last_sum   = sum_val
+
+    if len(slices) > 1 and pmt_sum[slices[-1]].sum() < threshold:
+        slices[-2:] = [slice(slices[-2].start, slices[-1].stop)]
+    return slices
+
+
+@given(arrays(float, integers(0, 100), elements=floats(-10, 100)),
+       floats(0, 500))
+def test_get_threshold_slices_same_as_sample_by_sample(pmt_sum, threshold):
+    expected = _get_threshold_slices_loop(pmt_sum, threshold)
+    got      = pmf.get_threshold_slices (pmt_sum, threshold)
+    assert got == expected
+
+
+@mark.parametrize("pmt_sum threshold".split(),
+                  ((np.zeros(10)          , 1  ),
+                   (np.full (10, 0.1)     , 0.3),
+                   (np.array([5, -5, 5.]) , 5  ),
+                   (np.full (1000, 1.)    , 0  )))
+def test_get_threshold_slices_flat_and_zero_threshold(pmt_sum, threshold):
+    expected = _get_threshold_slices_loop(pmt_sum, threshold)
+    got      = pmf.get_threshold_slices (pmt_sum, threshold)
+    assert got == expected
+
+
+@given(pmaps(), floats(0, 200))
+def test_get_slices_above_threshold(pmap, threshold):
+    _, pmap = pmap
+    peaks   = pmap.s1s + pmap.s2s
+    masks   = pmf.get_slices_above_threshold(peaks, threshold)
+
+    assert len(masks) == len(peaks)
+    for mask, peak in zip(masks, peaks):
+        assert mask.shape == peak.times.shape
+        if not peak.sipms.ids.size:
+            assert not np.any(mask)
+            continue
+
+        for i, above_thr in enumerate(mask):
+            assert above_thr == (peak.sipms.time_slice(i).sum() > threshold)
+
+
+@given(peaks(), floats(0, 200))
+def test_select_slices(pk, threshold):
+    _, pk  = pk
+    mask,  = pmf.get_slices_above_threshold([pk], threshold)
+    (times ,
+     widths,
+     pmt_wfs,
+     sipm_wfs) = pmf.select_slices(pk, mask)
+
+    indices = np.where(mask)[0]
+    assert times   == approx(pk.times     [indices])
+    assert widths  == approx(pk.bin_widths[indices])
+    assert pmt_wfs.shape  == (pk. pmts.ids.size, indices.size)
+    assert sipm_wfs.shape == (pk.sipms.ids.size, indices.size)
+    for i, index in enumerate(indices):
+        assert pmt_wfs [:, i] == approx(pk. pmts.time_slice(index))
+        assert sipm_wfs[:, i] == approx(pk.sipms.time_slice(index))
+
+
+@mark.parametrize("model rebin_factor".split(),
+                  ((pmf.RebinMethod.stride   ,    1),
+                   (pmf.RebinMethod.stride   ,    3),
+                   (pmf.RebinMethod.threshold, 4000)))
+@given(pmaps(pmt_ids=np.arange(3)))
+def test_rebin_peaks_same_as_rebin_peak(model, rebin_factor, pmap):
+    _, pmap  = pmap
+    peaks    = pmap.s1s + pmap.s2s
+    rebinned = pmf.rebin_peaks(peaks, rebin_factor, model)
+
+    assert len(rebinned) == len(peaks)
+    for got, peak in zip(rebinned, peaks):
+        expected = pmf.rebin_peak(peak, rebin_factor, model)
+        assert type(got) is type(expected)
+        assert got.bin_widths == approx(expected.bin_widths)
+        assert_Peak_equality(got, expected)
+
+
+def test_rebin_peaks_with_different_pmt_ids():
+    times  = np.arange(4.)
+    widths = np.ones  (4)
+    sipm_r = SiPMResponses.build_empty_instance()
+    peaks  = [S2(times, widths, PMTResponses([0, 1], np.ones((2, 4))), sipm_r),
+              S2(times, widths, PMTResponses([2   ], np.ones((1, 4))), sipm_r)]
+
+    rebinned = pmf.rebin_peaks(peaks, 2)
+    for got, peak in zip(rebinned, peaks):
+        assert_Peak_equality(got, pmf.rebin_peak(peak, 2))
+
+
 @given(dictionaries(keys     = integers(min_value=-1e5, max_value=1e5),
                     values   = pmaps(),
                     max_size = 5),
@@ -4,18 +4,31 @@ JJGC January 2017
 import numpy  as np
 import pandas as pd
 
-from ..sierpe             import fee as FE
-from ..sierpe             import low_frequency_noise as lfn
-from .                    import wfm_functions as wfm
+from functools import partial
+from scipy     import signal
+
+from ..sierpe               import fee as FE
+from ..sierpe               import low_frequency_noise as lfn
+from ..core.random_sampling import random_generator
+from .                      import wfm_functions as wfm
+
+
+def random_state(rng=None):
+    """
+    The random generator `rng` or, if None, numpy's global random
+    state, which provides the same methods.
+    """
+    return np.random if rng is None else rng
 
 
 def convert_channel_id_to_IC_id(data_frame, channel_ids):
     return pd.Index(data_frame.ChannelID).get_indexer(channel_ids)
 
 
-def charge_fluctuation(signal, single_pe_rms):
+def charge_fluctuation(signal, single_pe_rms, rng=None):
     """Simulate the fluctuation of the pe before noise addition
-    produced by each photoelectron
+    produced by each photoelectron, with the random generator `rng`
+    (numpy's global random state if None)
     """
     if single_pe_rms == 0:
         ## Protection for some versions of numpy etc
@@ -25,12 +38,137 @@ def charge_fluctuation(signal, single_pe_rms):
     sig_fl   = signal.astype(float)
     non_zero = sig_fl > 0
     sigma    = np.sqrt(sig_fl[non_zero]) * single_pe_rms
-    sig_fl[non_zero] = np.random.normal(sig_fl[non_zero], sigma)
+    sig_fl[non_zero] = random_state(rng).normal(sig_fl[non_zero], sigma)
     ## This fluctuation can't give negative signal
     sig_fl[sig_fl < 0] = 0
     return sig_fl
 
 
+def group_filters(filters):
+    """
+    The distinct filters among the (b, a) coefficients `filters`
+    and, for each filter, the index of its coefficients among them.
+    """
+    distinct, ids = [], []
+    for b, a in filters:
+        for i, (b_, a_) in enumerate(distinct):
+            if np.array_equal(b, b_) and np.array_equal(a, a_):
+                break
+        else:
+            i = len(distinct)
+            distinct.append((b, a))
+        ids.append(i)
+    return distinct, np.array(ids, dtype=int)
+
+
+def lfilter_rows(filters, filter_ids, x):
+    """
+    Filter each row i of `x` with the coefficients
+    `filters[filter_ids[i]]`. The rows that share a filter are
+    filtered at once.
+    """
+    filtered = np.empty(np.shape(x))
+    for i, (b, a) in enumerate(filters):
+        rows = np.flatnonzero(filter_ids == i)
+        if len(rows):
+            filtered[rows] = signal.lfilter(b, a, x[rows], axis=1)
+    return filtered
+
+
+def pmt_noise_sampler(detector_db='new', run_number = 0):
+    """
+    Reads the low frequency noise tables of the run once and returns
+    a function that draws the random part of the response of the
+    energy plane to one event, given the shape (n_pmts, n_samples)
+    of its photon counts at 1 ns: the seeds of the generators of
+    each PMT and the low frequency noise of all of them. The random
+    numbers are drawn from the generator passed to the returned
+    function (see `random_generator`).
+    """
+    low_frequency_noise = lfn.low_frequency_noise_sampler(detector_db, run_number)
+
+    def sample_pmt_noise(shape, rng=None):
+        rng              = random_generator(rng)
+        n_pmt, n_samples = shape
+        buffer_length    = int(FE.f_sample * n_samples / FE.f_mc)
+        pmt_seeds        = rng.integers(0, 2**63, size=n_pmt, dtype=np.int64)
+        return pmt_seeds, low_frequency_noise(buffer_length, rng)
+
+    return sample_pmt_noise
+
+
+def pmt_response_simulator(adc_to_pes, pe_resolution, detector_db='new', run_number = 0):
+    """
+    Builds the front end electronics model (FEE), its filters and the
+    low frequency noise tables of the run once and returns a function
+    that simulates the response of the energy plane to the photon
+    counts of one event, with shape (n_pmts, n_samples), at 1 ns.
+    The returned function gives the raw waveforms (RWF) and the BLR
+    waveforms (only decimation) of the PMTs given by `pmts` (all of
+    them by default), one row per PMT in the same order.
+    The random numbers are drawn from the generator passed to the
+    returned function (see `random_generator`). Each PMT gets its own
+    generator, seeded from it along with the low frequency noise, so
+    a subset of the PMTs gives the same waveforms as the whole event.
+    The output of `pmt_noise_sampler` for the event can be passed as
+    `noise` instead, so that the low frequency noise is computed only
+    once when the event is simulated in parts.
+    """
+    # Single Photoelectron class, convolved and decimated in one go
+    spe           = FE.SPE()
+    spe_decimator = FE.pulse_decimator(spe.spe, FE.f_mc, FE.f_sample)
+    # FEE, with noise PMT
+    fee  = FE.FEE(detector_db, run_number,
+                  noise_FEEPMB_rms=FE.NOISE_I, noise_DAQ_rms=FE.NOISE_DAQ)
+    # The filter of each PMT depends on its own constants in the
+    # database, so the coefficients may differ from PMT to PMT. The
+    # PMTs with the same coefficients are filtered together.
+    fee_filters, fee_filter_ids = group_filters(FE.filter_fee(fee, pmt)
+                                                for pmt in range(len(adc_to_pes)))
+    b_lpf, a_lpf = FE.filter_sfee_lpf(fee)
+    noise_daq    = fee.DAQnoise_rms * FE.v_to_adc()
+    # Seeds of each PMT and low frequency noise
+    sample_pmt_noise = pmt_noise_sampler(detector_db, run_number)
+
+    # normalize calibration constants from DB to MC value
+    cc    = np.asarray(adc_to_pes) / FE.ADC_TO_PES
+    scale = int(FE.f_mc / FE.f_sample)
+
+    def simulate_pmt_response(pmtrd, rng=None, pmts=None, noise=None):
+        n_pmt, n_samples   = pmtrd.shape
+        pmts               = np.arange(n_pmt) if pmts is None else np.asarray(pmts, dtype=int)
+        pmt_seeds, lowFreq = sample_pmt_noise(pmtrd.shape, rng) if noise is None else noise
+        n_decimated        = -(-n_samples // scale)
+
+        # fluctuating charge according to 1pe sigma from calibration,
+        # and noise of the FEE + PMT BASE and of the DAQ
+        signal_fl = np.empty((len(pmts), n_samples))
+        noise_fee = np.zeros((len(pmts), n_decimated))
+        noise_adc = np.empty((len(pmts), n_decimated))
+        for i, pmt in enumerate(pmts):
+            pmt_rng      = np.random.default_rng(pmt_seeds[pmt])
+            signal_fl[i] = charge_fluctuation(pmtrd[pmt], pe_resolution[pmt], pmt_rng)
+            if fee.noise_FEEPMB_rms != 0:
+                noise_fee[i] = pmt_rng.normal(0, fee.noise_FEEPMB_rms, n_decimated)
+            noise_adc[i] = pmt_rng.normal(0, noise_daq, n_decimated)
+
+        # signal_i in current units, decimated (DAQ decimation)
+        signal_d  = spe_decimator(signal_fl[:, :-len(spe.spe) + 1])
+        signal_d *= cc[pmts, np.newaxis]
+        # Effect of FEE (each PMT has its own filter) and transform to adc counts
+        signal_fee  = lfilter_rows(fee_filters, fee_filter_ids[pmts], signal_d + noise_fee)
+        signal_fee *= FE.v_to_adc()
+        # add noise daq including the low frequency noise
+        signal_daq = signal_fee + noise_adc - lowFreq[pmts]
+        # signal blr is just pure MC decimated by adc in adc counts
+        signal_blr = signal.lfilter(b_lpf, a_lpf, signal_d, axis=1) * FE.v_to_adc()
+        # raw waveform stored with negative sign and offset
+        # blr waveform stored with positive sign and no offset
+        return FE.OFFSET - signal_daq, signal_blr
+
+    return simulate_pmt_response
+
+
 def simulate_pmt_response(event, pmtrd, adc_to_pes, pe_resolution, detector_db='new', run_number = 0):
     """ Full simulation of the energy plane response
     Input:
@@ -41,48 +179,19 @@ def simulate_pmt_response(event, pmtrd, adc_to_pes, pe_resolution, detector_db='
     front end electronics (LPF, HPF filters)
     array of BLR waveforms (only decimation)
     """
-    # Single Photoelectron class
-    spe = FE.SPE()
-    # FEE, with noise PMT
-    fee  = FE.FEE(detector_db, run_number,
-                  noise_FEEPMB_rms=FE.NOISE_I, noise_DAQ_rms=FE.NOISE_DAQ)
-    # Low frequency noise
-    buffer_length = int(FE.f_sample * pmtrd.shape[2] / FE.f_mc)
-    lowFreq = lfn.low_frequency_noise(detector_db, run_number, buffer_length)
-
-    NPMT = pmtrd.shape[1]
-    RWF  = []
-    BLRX = []
-    for pmt in range(NPMT):
-        # normalize calibration constants from DB to MC value
-        cc = adc_to_pes[pmt] / FE.ADC_TO_PES
-        # signal_i in current units
-        # fluctuating charge according to 1pe sigma from calibration.
-        pe_rms = pe_resolution[pmt]
-        signal_i = FE.spe_pulse_from_vector(spe,
-                                            charge_fluctuation(pmtrd[event, pmt], pe_rms),
-                                            norm=cc)
-        # Decimate (DAQ decimation)
-        signal_d = FE.daq_decimator(FE.f_mc, FE.f_sample, signal_i)
-        # Effect of FEE and transform to adc counts
-        signal_fee = FE.signal_v_fee(fee, signal_d, pmt) * FE.v_to_adc()
-        # add noise daq including the low frequency noise
-        signal_daq = FE.noise_adc(fee, signal_fee) - lowFreq(pmt)
-        # signal blr is just pure MC decimated by adc in adc counts
-        signal_blr = FE.signal_v_lpf(fee, signal_d) * FE.v_to_adc()
-        # raw waveform stored with negative sign and offset
-        RWF.append(FE.OFFSET - signal_daq)
-        # blr waveform stored with positive sign and no offset
-        BLRX.append(signal_blr)
-    return np.array(RWF), np.array(BLRX)
+    simulate = pmt_response_simulator(adc_to_pes, pe_resolution, detector_db, run_number)
+    return simulate(np.asarray(pmtrd[event]))
 
 
-def simulate_sipm_response(sipmrd, sipms_noise_sampler, sipm_adc_to_pes, pe_resolution):
+def simulate_sipm_response(sipmrd, sipms_noise_sampler, sipm_adc_to_pes, pe_resolution,
+                           rng=None):
     """Add noise to the sipms with the NoiseSampler class and return
-    the noisy waveform (in adc)."""
+    the noisy waveform (in adc). The random numbers are drawn from
+    `rng` if given."""
 
     ## Fluctuate according to charge resolution
-    sipm_fl = np.array(tuple(map(charge_fluctuation, sipmrd, pe_resolution)))
+    fluctuate = partial(charge_fluctuation, rng=rng)
+    sipm_fl   = np.array(tuple(map(fluctuate, sipmrd, pe_resolution)))
 
     # return total signal in adc counts + noise sampled from pdf spectra
-    return wfm.to_adc(sipm_fl, sipm_adc_to_pes) + sipms_noise_sampler.sample()
+    return wfm.to_adc(sipm_fl, sipm_adc_to_pes) + sipms_noise_sampler.sample(rng)
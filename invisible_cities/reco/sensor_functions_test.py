@@ -3,6 +3,7 @@ import numpy  as np
 import pandas as pd
 
 from pytest import mark
+from scipy  import signal
 
 from .. core.random_sampling import NoiseSampler as SiPMsNoiseSampler
 from .. sierpe               import blr
@@ -10,7 +11,12 @@ from .. database             import load_db
 
 from .                   import wfm_functions as wfm
 from .  sensor_functions import convert_channel_id_to_IC_id
+from .  sensor_functions import charge_fluctuation
 from .  sensor_functions import simulate_pmt_response
+from .  sensor_functions import pmt_response_simulator
+from .  sensor_functions import pmt_noise_sampler
+from .  sensor_functions import group_filters
+from .  sensor_functions import lfilter_rows
 
 
 def test_cwf_blr(dbnew, electron_MCRD_file):
@@ -43,6 +49,88 @@ def test_cwf_blr(dbnew, electron_MCRD_file):
                                    window_size = 500)
         assert diff[0] < 1
 
+def test_pmt_response_simulator_is_reproducible(dbnew, electron_MCRD_file):
+    run_number    = 0
+    DataPMT       = load_db.DataPMT(dbnew, run_number)
+    adc_to_pes    = abs(DataPMT.adc_to_pes.values)
+    single_pe_rms = abs(DataPMT.Sigma.values)
+    simulate      = pmt_response_simulator(adc_to_pes, single_pe_rms, dbnew, run_number)
+
+    with tb.open_file(electron_MCRD_file, 'r') as h5in:
+        pmtrd = h5in.root.pmtrd[0]
+
+    np.random.seed(123)
+    rwf, blr = simulate(pmtrd)
+    # The cached model must not depend on the previous events
+    simulate(pmtrd)
+    np.random.seed(123)
+    rwf_again, blr_again = simulate(pmtrd)
+    np.random.seed(123)
+    rwf_single, blr_single = simulate_pmt_response(0, pmtrd[np.newaxis],
+                                                   adc_to_pes, single_pe_rms,
+                                                   dbnew, run_number)
+
+    assert rwf.shape == blr.shape == (pmtrd.shape[0], pmtrd.shape[1] // 25)
+    assert np.all(rwf == rwf_again )
+    assert np.all(blr == blr_again )
+    assert np.all(rwf == rwf_single)
+    assert np.all(blr == blr_single)
+
+    rwf_rng      , blr_rng       = simulate(pmtrd, np.random.default_rng(1))
+    rwf_rng_again, blr_rng_again = simulate(pmtrd, np.random.default_rng(1))
+    assert np.all(rwf_rng == rwf_rng_again)
+    assert np.all(blr_rng == blr_rng_again)
+
+    # A subset of the PMTs is simulated as in the whole event
+    rwf_subset, blr_subset = simulate(pmtrd, np.random.default_rng(1), [3, 1])
+    assert np.all(rwf_subset == rwf_rng[[3, 1]])
+    assert np.all(blr_subset == blr_rng[[3, 1]])
+
+    # The noise of the event can be sampled beforehand
+    noise = pmt_noise_sampler(dbnew, run_number)(pmtrd.shape, np.random.default_rng(1))
+    rwf_noise, blr_noise = simulate(pmtrd, pmts=[3, 1], noise=noise)
+    assert np.all(rwf_noise == rwf_subset)
+    assert np.all(blr_noise == blr_subset)
+
+
+def test_charge_fluctuation_with_generator():
+    signal = np.array([0, 1, 5, 0, 20, 100], dtype=np.int16)
+
+    # The global random state is not used
+    np.random.seed(1)
+    expected_draw = np.random.random()
+    np.random.seed(1)
+    first  = charge_fluctuation(signal, 0.5, np.random.default_rng(2))
+    second = charge_fluctuation(signal, 0.5, np.random.default_rng(2))
+
+    assert np.all(first == second)
+    assert np.all(first[signal == 0] == 0)
+    assert np.random.random() == expected_draw
+
+
+def test_group_filters():
+    first   = signal.butter(1, 0.1, "high")
+    second  = signal.butter(4, 0.2)
+    filters = [first, second, tuple(map(np.copy, first)), second, first]
+
+    distinct, ids = group_filters(filters)
+    assert len(distinct) == 2
+    assert np.all(ids == [0, 1, 0, 1, 0])
+    for (b, a), i in zip(filters, ids):
+        assert np.all(distinct[i][0] == b)
+        assert np.all(distinct[i][1] == a)
+
+
+def test_lfilter_rows_same_as_row_by_row():
+    filters    = [signal.butter(1, 0.1, "high"), signal.butter(4, 0.2)]
+    filter_ids = np.array([1, 0, 1, 1, 0])
+    x          = np.random.default_rng(3).normal(size=(5, 1000))
+
+    filtered = lfilter_rows(filters, filter_ids, x)
+    for row, i, got in zip(x, filter_ids, filtered):
+        assert np.all(got == signal.lfilter(*filters[i], row))
+
+
 @mark.slow
 def test_sipm_noise_sampler(dbnew, electron_MCRD_file):
     """This test checks that the number of SiPMs surviving a hard energy
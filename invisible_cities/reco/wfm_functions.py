@@ -5,6 +5,7 @@ authors: J.J. Gomez-Cadenas, G. Martinez
 import numpy as np
 
 from .. core.core_functions import define_window
+from .. core                import core_functions_c as core_c
 from .. sierpe              import blr
 
 def to_adc(wfs, adc_to_pes):
@@ -60,6 +61,10 @@ def suppress_wf(waveform, threshold, padding = 0):
     wf : 1-dim np.ndarray
         A copy of the input waveform with values below threshold set to zero.
     """
+    waveform = np.asarray(waveform)
+    if waveform.dtype in (np.float32, np.float64) and waveform.flags.writeable:
+        return noise_suppression(waveform[np.newaxis], threshold, padding)[0]
+
     wf = np.copy(waveform)
     below_thr = wf <= threshold
     if padding > 0:
@@ -73,7 +78,7 @@ def suppress_wf(waveform, threshold, padding = 0):
     return wf
 
 
-def noise_suppression(waveforms, thresholds, padding = 0):
+def noise_suppression(waveforms, thresholds, padding = 0, out = None, n_threads = 1):
     """Put zeros where the waveform is below some threshold.
 
     Parameters
@@ -83,29 +88,51 @@ def noise_suppression(waveforms, thresholds, padding = 0):
     thresholds : int or float or sequence of ints or floats
         Cut value for each waveform (sequence) or for all (single number).
     padding : Number of samples before and after signal to keep
+    out : 2-dim np.ndarray, optional
+        Array where the result is written, with the shape of `waveforms`.
+    n_threads : Number of threads used for single and double precision
+        waveforms, which are processed by a compiled kernel.
 
     Returns
     -------
     suppressed_wfs : 2-dim np.ndarray
         A copy of the input waveform with values below threshold set to zero.
     """
+    waveforms = np.asarray(waveforms)
     if not hasattr(thresholds, "__iter__"):
         thresholds = np.ones(waveforms.shape[0]) * thresholds
     if not hasattr(padding, "__iter__"):
         padding = np.zeros(waveforms.shape[0], dtype = np.int) + padding
-    suppressed_wfs = list(map(suppress_wf, waveforms, thresholds, padding))
-    return np.array(suppressed_wfs)
-
-
-def cwf_from_rwf(pmtrwf, event_list, calib_vectors, deconv_params):
-    """Compute CWF from RWF for a given list of events."""
-
-    CWF=[]
-    for event in event_list:
-        CWF.append(blr.deconv_pmt(pmtrwf[event], calib_vectors.coeff_c,
-                             calib_vectors.coeff_blr,
-                             n_baseline=deconv_params.n_baseline,
-                             thr_trigger=deconv_params.thr_trigger))
+    if out is None:
+        out = np.empty_like(waveforms)
+    if (waveforms.dtype in (np.float32, np.float64) and
+        waveforms.flags.writeable and out.dtype == waveforms.dtype):
+        # The thresholds are compared in the type of the waveforms,
+        # as numpy does with scalar thresholds
+        core_c.suppress_wfs(waveforms,
+                            np.asarray(thresholds, dtype=waveforms.dtype),
+                            np.asarray(padding   , dtype=np.int64),
+                            out, n_threads)
+        return out
+    for wf, thr, pad, suppressed_wf in zip(waveforms, thresholds, padding, out):
+        suppressed_wf[:] = suppress_wf(wf, thr, pad)
+    return out
+
+
+def cwf_from_rwf(pmtrwf, event_list, calib_vectors, deconv_params, block_size=100):
+    """Compute CWF from RWF for a given list of events. The events
+    are read and deconvolved in blocks of at most `block_size`."""
+
+    event_list    = list(event_list)
+    filter_coeffs = blr.filter_coefficients(calib_vectors.coeff_c)
+    CWF = []
+    for start in range(0, len(event_list), block_size):
+        block = event_list[start:start + block_size]
+        CWF.extend(blr.deconv_pmt(pmtrwf[block], calib_vectors.coeff_c,
+                                  calib_vectors.coeff_blr,
+                                  n_baseline=deconv_params.n_baseline,
+                                  thr_trigger=deconv_params.thr_trigger,
+                                  filter_coeffs=filter_coeffs))
     return CWF
 
 
@@ -12,6 +12,8 @@ from .        import tbl_functions    as tbl
 from .        import wfm_functions    as wfm
 from .. evm.ic_containers import CalibVectors
 from .. evm.ic_containers import DeconvParams
+from .. sierpe            import blr
+from .. core.testing_utils import peak_allocated_memory
 
 
 @mark.slow
@@ -51,3 +53,47 @@ def test_compare_cwf_blr(dbnew):
                                event_list=range(NEVT), window_size=300)
 
     assert max(diff) < 0.15
+
+
+def test_cwf_from_rwf_reads_events_in_blocks():
+    n_evt, n_pmt, n_samples = 7, 3, 2000
+    rwfs   = np.random.normal(2500, 2, size=(n_evt, n_pmt, n_samples)).astype(np.int16)
+    calib  = CalibVectors(channel_id      = np.arange(n_pmt),
+                          coeff_blr       = np.random.uniform(1e-3, 2e-3, n_pmt),
+                          coeff_c         = np.random.uniform(2e-6, 3e-6, n_pmt),
+                          adc_to_pes      = np.ones(n_pmt),
+                          adc_to_pes_sipm = None,
+                          pmt_active      = list(range(n_pmt)))
+    deconv = DeconvParams(n_baseline  = 1000,
+                          thr_trigger =    5)
+
+    class BlockReader:
+        def __init__(self):
+            self.block_sizes = []
+
+        def __getitem__(self, events):
+            self.block_sizes.append(len(events))
+            return rwfs[events]
+
+    reader = BlockReader()
+    CWF    = wfm.cwf_from_rwf(reader, range(n_evt), calib, deconv, block_size=3)
+
+    assert reader.block_sizes == [3, 3, 1]
+    assert len(CWF) == n_evt
+    for rwf, cwf in zip(rwfs, CWF):
+        assert np.all(cwf == blr.deconv_pmt(rwf, calib.coeff_c, calib.coeff_blr,
+                                            n_baseline  = deconv.n_baseline,
+                                            thr_trigger = deconv.thr_trigger))
+
+
+@mark.parametrize("padding", (0, 3))
+def test_noise_suppression_into_out_does_not_allocate_waveforms(padding):
+    wfs        = np.random.normal(0, 1, size=(1792, 800))
+    thresholds = np.random.uniform(2, 3, size=len(wfs))
+    out        = np.empty_like(wfs)
+    suppress   = lambda: wfm.noise_suppression(wfs, thresholds, padding, out=out)
+
+    expected = np.array([wfm.suppress_wf(wf, thr, padding) for wf, thr in zip(wfs, thresholds)])
+    assert suppress() is out
+    assert np.all(out == expected)
+    assert peak_allocated_memory(suppress) < out.nbytes / 20
@@ -1,6 +1,9 @@
 import sys
 import numpy as np
 
+from functools     import lru_cache
+from scipy.spatial import cKDTree
+
 from .. core.core_functions  import weighted_mean_and_var
 from .. core                 import system_of_units as units
 from .. core.exceptions      import SipmEmptyList
@@ -53,9 +56,80 @@ def get_nearby_sipm_inds(cs, d, pos):
 def count_masked(cs, d, datasipm, is_masked):
     if is_masked is None: return 0
 
-    pos = np.stack([datasipm.X.values, datasipm.Y.values], axis=1)
-    indices = get_nearby_sipm_inds(cs, d, pos)
-    return np.count_nonzero(~is_masked.astype(bool)[indices])
+    geometry = sipm_geometry(datasipm.X.values, datasipm.Y.values, is_masked)
+    return geometry.count_masked(cs, d)
+
+
+class SiPMGeometry:
+    """
+    Static description of the tracking plane used by corona: the
+    SiPM at each position and, for each distance requested, the SiPMs
+    within that distance of each SiPM (in CSR format, found with a
+    KD-tree) and the number of masked ones among them. The distances
+    are always computed as in `get_nearby_sipm_inds`, so the result
+    is the same as scanning all SiPMs.
+    """
+    def __init__(self, xs, ys, active):
+        self.pos         = np.stack([xs, ys], axis=1)
+        self.active      = np.asarray(active).astype(bool)
+        self.masked_pos  = self.pos[~self.active]
+        self._ids        = {xy: i for i, xy in enumerate(map(tuple, self.pos))}
+        self._neighbours = {}
+
+    def sensor_id(self, cs):
+        """Index of the SiPM at position cs, -1 if there is none."""
+        return self._ids.get(tuple(np.ravel(cs)), -1)
+
+    def sensor_ids(self, pos):
+        return np.array([self._ids.get(xy, -1) for xy in map(tuple, pos)], dtype=int)
+
+    def neighbours(self, d):
+        """
+        (indptr, indices, n_masked): the SiPMs within d of SiPM i are
+        indices[indptr[i]:indptr[i+1]] (in increasing order), and
+        n_masked[i] of them are masked.
+        """
+        if d not in self._neighbours:
+            # The tree only preselects the candidates
+            tree       = cKDTree(self.pos)
+            candidates = tree.query_ball_point(self.pos, max(d, 0) * (1 + 1e-9) + 1e-9)
+            rows       = np.repeat(np.arange(len(self.pos)), list(map(len, candidates)))
+            indices    = np.concatenate([np.zeros(0, dtype=int)] + list(map(np.asarray, candidates)))
+            distances  = np.linalg.norm(self.pos[indices] - self.pos[rows], axis=1)
+            near       = distances <= d
+            rows       = rows   [near]
+            indices    = indices[near]
+            order      = np.lexsort((indices, rows))
+            rows       = rows   [order]
+            indices    = indices[order]
+
+            indptr     = np.zeros(len(self.pos) + 1, dtype=int)
+            np.cumsum(np.bincount(rows, minlength=len(self.pos)), out=indptr[1:])
+            n_masked   = np.bincount(rows, weights=~self.active[indices], minlength=len(self.pos))
+            self._neighbours[d] = indptr, indices, n_masked.astype(int)
+        return self._neighbours[d]
+
+    def count_masked(self, cs, d):
+        """Number of masked SiPMs within d of cs."""
+        sensor = self.sensor_id(cs)
+        if sensor >= 0:
+            return self.neighbours(d)[2][sensor]
+        return np.count_nonzero(np.linalg.norm(self.masked_pos - cs, axis=1) <= d)
+
+
+def sipm_geometry(xs, ys, active):
+    """
+    `SiPMGeometry` of the given positions and active flags, built
+    only once for each detector geometry.
+    """
+    key = tuple(np.ascontiguousarray(values, dtype=np.double).tobytes()
+                for values in (xs, ys, active))
+    return _sipm_geometry(*key)
+
+
+@lru_cache(maxsize=10)
+def _sipm_geometry(xs, ys, active):
+    return SiPMGeometry(*(np.frombuffer(values) for values in (xs, ys, active)))
 
 
 def corona(pos, qs, all_sipms,
@@ -141,8 +215,6 @@ def corona(pos, qs, all_sipms,
     if not len(pos)   : raise SipmEmptyList
     if np.sum(qs) == 0: raise SipmZeroCharge
 
-    masked = all_sipms.Active.values.astype(bool) if consider_masked else None
-
     above_threshold = np.where(qs >= Qthr)[0]            # Find SiPMs with qs at least Qthr
     pos, qs = pos[above_threshold], qs[above_threshold]  # Discard SiPMs with qs less than Qthr
 
@@ -153,28 +225,51 @@ def corona(pos, qs, all_sipms,
     if lm_radius < 0 or new_lm_radius < 0:
         return barycenter(pos, qs)
 
+    # The SiPMs contributing to a cluster are switched off in `alive`.
+    # If the SiPMs are those of the geometry, the ones near a SiPM are
+    # taken from its precomputed neighbours; otherwise (or if the
+    # center is not a SiPM) the distances are computed.
+    alive = np.ones(len(qs), dtype=bool)
+    if all_sipms is not None:
+        geometry = sipm_geometry(all_sipms.X.values, all_sipms.Y.values, all_sipms.Active.values)
+        ids      = geometry.sensor_ids(pos)
+        use_ids  = np.all(ids >= 0) and len(np.unique(ids)) == len(ids)
+        slot     = np.full(len(geometry.pos), -1)
+        slot[ids[ids >= 0]] = np.flatnonzero(ids >= 0)
+    else:
+        use_ids  = False
+
+    def nearby_alive_sipms(cs, d):
+        sensor = geometry.sensor_id(cs) if use_ids else -1
+        if sensor < 0:
+            return np.flatnonzero(alive & (np.linalg.norm(pos - cs, axis=1) <= d))
+        indptr, indices, _ = geometry.neighbours(d)
+        slots = slot[indices[indptr[sensor]:indptr[sensor + 1]]]
+        slots = slots[slots >= 0]
+        return np.sort(slots[alive[slots]])
+
     c  = []
     # While there are more local maxima
-    while len(qs) > 0:
+    while alive.any():
 
-        hottest_sipm = np.argmax(qs)       # SiPM with largest Q
-        if qs[hottest_sipm] < Qlm: break   # largest Q remaining is negligible
+        hottest_sipm = np.argmax(np.where(alive, qs, -np.inf)) # SiPM with largest Q
+        if qs[hottest_sipm] < Qlm: break                       # largest Q remaining is negligible
 
         # find new local maximum of charge considering all SiPMs within lm_radius of hottest_sipm
-        within_lm_radius  = get_nearby_sipm_inds(pos[hottest_sipm], lm_radius, pos)
+        within_lm_radius  = nearby_alive_sipms(pos[hottest_sipm], lm_radius)
         new_local_maximum = barycenter(pos[within_lm_radius], qs[within_lm_radius])[0].posxy
 
         # find the SiPMs within new_lm_radius of the new local maximum of charge
-        within_new_lm_radius = get_nearby_sipm_inds(new_local_maximum, new_lm_radius, pos      )
-        n_masked_neighbours  = count_masked        (new_local_maximum, new_lm_radius, all_sipms, masked)
+        within_new_lm_radius = nearby_alive_sipms(new_local_maximum, new_lm_radius)
+        n_masked_neighbours  = geometry.count_masked(new_local_maximum, new_lm_radius) if consider_masked else 0
 
         # if there are at least msipms within_new_lm_radius, taking
         # into account any masked channel, get the barycenter
         if len(within_new_lm_radius) >= msipm - n_masked_neighbours:
             c.extend(barycenter(pos[within_new_lm_radius], qs[within_new_lm_radius]))
 
-        # delete the SiPMs contributing to this cluster
-        pos, qs = discard_sipms(within_new_lm_radius, pos, qs)
+        # switch off the SiPMs contributing to this cluster
+        alive[within_new_lm_radius] = False
 
     if not len(c): raise ClusterEmptyList
 
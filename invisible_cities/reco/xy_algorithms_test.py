@@ -29,6 +29,7 @@ from .       xy_algorithms   import barycenter
 from .       xy_algorithms   import discard_sipms
 from .       xy_algorithms   import get_nearby_sipm_inds
 from .       xy_algorithms   import count_masked
+from .       xy_algorithms   import sipm_geometry
 
 
 @composite
@@ -406,3 +407,49 @@ def test_corona_finds_masked_sipms_correctly(datasipm5x5):
 
     assert len(c)     ==  1
     assert c[0].nsipm == 17
+
+
+@mark.parametrize("d", (0, 1, 1.5, 2, 10, np.inf))
+def test_sipm_geometry_neighbours_same_as_scan(datasipm5x5, d):
+    xs, ys, active = datasipm5x5.X.values, datasipm5x5.Y.values, datasipm5x5.Active.values
+    pos      = np.stack([xs, ys], axis=1)
+    geometry = sipm_geometry(xs, ys, active)
+
+    indptr, indices, n_masked = geometry.neighbours(d)
+    for i, xy in enumerate(pos):
+        expected = get_nearby_sipm_inds(xy, d, pos)
+        assert np.all(indices[indptr[i]:indptr[i+1]] == expected)
+        assert n_masked[i] == np.count_nonzero(~active.astype(bool)[expected])
+
+    # Same structure for the same geometry
+    assert sipm_geometry(xs, ys, active) is geometry
+
+
+def test_count_masked_away_from_sipms(datasipm5x5):
+    xs, ys, active = datasipm5x5.X.values, datasipm5x5.Y.values, datasipm5x5.Active.values
+    pos            = np.stack([xs, ys], axis=1)
+    for xy in ((2.3, 1.9), (0.5, 0.5), (2, 2), (-1, 7)):
+        expected = np.count_nonzero(~active.astype(bool)[get_nearby_sipm_inds(xy, 1.5, pos)])
+        assert count_masked(np.array(xy), 1.5, datasipm5x5, active) == expected
+
+
+@mark.parametrize("lm_radius new_lm_radius".split(), ((0, 15), (15, 25), (10, 10)))
+def test_corona_same_with_precomputed_neighbours(lm_radius, new_lm_radius):
+    # corona uses the precomputed neighbours of the SiPMs of the
+    # geometry, and computes the distances if there is no geometry
+    x, y     = np.meshgrid(np.arange(12) * 10., np.arange(12) * 10.)
+    active   = np.ones(x.size, dtype=bool)
+    datasipm = _create_fake_datasipm(x.flatten(), y.flatten(), active)
+
+    rng = np.random.RandomState(123)
+    ids = rng.permutation(x.size)[:90]
+    pos = np.stack([x.flatten()[ids], y.flatten()[ids]], axis=1)
+    qs  = rng.exponential(5, size=len(ids))
+
+    params   = dict(Qthr = 1, Qlm = 5, lm_radius = lm_radius, new_lm_radius = new_lm_radius, msipm = 2)
+    clusters = corona(pos, qs, datasipm, **params)
+    expected = corona(pos, qs, None    , **params)
+
+    assert len(clusters) == len(expected)
+    for cluster, expected_cluster in zip(clusters, expected):
+        assert_cluster_equality(cluster, expected_cluster)
@@ -19,26 +19,38 @@ acum_discharge_length: length to dicharge the accumulator in the absence
 
 deconv_pmt performs the deconvolution for the PMTs of the energy plane
 input:
-pmtrwf:    the raw waveform for all the PMTs (shorts)
+pmtrwf:    the raw waveform for all the PMTs (shorts, floats or doubles),
+           for one event or for a batch of events
 coeff_c:   a vector of deconvolution coefficients (cleaning)
 coeff_blr: a vector of deconvolution coefficients (blr)
 n_baseline, thr_trigger as described above
+dtype:     the type of the output waveforms (float32 or doubles)
+
+filter_coefficients computes the coefficients of the cleaning filter
+of each PMT, which only depend on the calibration.
 
 """
 import numpy as np
 cimport numpy as np
 
-cpdef deconvolve_signal(double [:] signal_daq,
-                        int        n_baseline      = *,
-                        double     coeff_clean     = *,
-                        double     coeff_blr       = *,
-                        double     thr_trigger     = *,
-                        int accum_discharge_length = *)
-
-cpdef deconv_pmt(np.ndarray[np.int16_t, ndim=2] pmtrwf,
-                 double [:]                     coeff_c,
-                 double [:]                     coeff_blr,
-                 list                           pmt_active             = *,
-                 int                            n_baseline             = *,
-                 double                         thr_trigger            = *,
-                 int                            accum_discharge_length = *)
+cpdef np.ndarray filter_coefficients(const double [:] coeff_clean)
+
+cpdef deconvolve_signal(signal_daq,
+                        int    n_baseline             = *,
+                        double coeff_clean            = *,
+                        double coeff_blr              = *,
+                        double thr_trigger            = *,
+                        int    accum_discharge_length = *,
+                        dtype                         = *)
+
+cpdef deconv_pmt(pmtrwf,
+                 const double [:] coeff_c,
+                 const double [:] coeff_blr,
+                 pmt_active             = *,
+                 int    n_baseline      = *,
+                 double thr_trigger     = *,
+                 int accum_discharge_length = *,
+                 filter_coeffs          = *,
+                 int    n_threads       = *,
+                 dtype                  = *,
+                 out                    = *)
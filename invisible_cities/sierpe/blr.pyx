@@ -1,131 +1,323 @@
+# distutils: extra_compile_args = -fopenmp
+# distutils: extra_link_args    = -fopenmp
 import  numpy as np
 cimport numpy as np
+cimport cython
+from cython.parallel cimport prange
+from libc.math       cimport sqrt
 from scipy import signal as SGN
 
-cpdef deconvolve_signal(double [:] signal_daq,
-                        int    n_baseline             = 28000,
-                        double coeff_clean            = 2.905447E-06,
-                        double coeff_blr              = 1.632411E-03,
-                        double thr_trigger            =     5,
-                        int    accum_discharge_length =  5000):
 
-    """
-    The accumulator approach by Master VHB
-    decorated and cythonized  by JJGC
-    Current version using memory views
+ctypedef fused raw_t:
+    np.int16_t
+    np.float32_t
+    np.float64_t
 
-    In this version the recovered signal and the accumulator are
-    always being charged. At the same time, the accumulator is being
-    discharged when there is no signal. This avoids runoffs
-    The baseline is computed using a window of 700 mus (by default)
-    which should be good for Na and Kr
-    """
+ctypedef fused blr_t:
+    np.float32_t
+    np.float64_t
 
-    cdef double coef = coeff_blr
-    cdef int nm = n_baseline
-    cdef double thr_acum = thr_trigger / coef
-    cdef int len_signal_daq = len(signal_daq)
+# Number of samples used to compute the noise of the baseline
+DEF NOISE_WINDOW = 400
 
-    cdef double [:] signal_r = np.zeros(len_signal_daq, dtype=np.double)
-    cdef double [:] acum     = np.zeros(len_signal_daq, dtype=np.double)
 
-    cdef int j
-    cdef double baseline = 0
+cpdef np.ndarray filter_coefficients(const double [:] coeff_clean):
+    """
+    Coefficients (b0, b1, a1) of the first order high-pass
+    butterworth filter used to clean the signal of each PMT, one
+    row per PMT. They only depend on the calibration, so they can
+    be computed once and passed to `deconv_pmt`.
+    """
+    cdef np.ndarray coeffs = np.empty((len(coeff_clean), 3), dtype=np.double)
+    cdef int i
+    for i in range(len(coeff_clean)):
+        b_cf, a_cf = SGN.butter(1, coeff_clean[i], 'high', analog=False)
+        coeffs[i, 0] = b_cf[0] / a_cf[0]
+        coeffs[i, 1] = b_cf[1] / a_cf[0]
+        coeffs[i, 2] = a_cf[1] / a_cf[0]
+    return coeffs
 
-    for j in range(0,nm):
-        baseline += signal_daq[j]
-    baseline /= nm
 
-    # reverse sign of signal and subtract baseline
-    for j in range(0,len_signal_daq):
-        signal_daq[j] = baseline - signal_daq[j]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _deconvolve(raw_t  *   signal_daq,
+                      Py_ssize_t step,
+                      blr_t  [:] signal_r,
+                      int        n_baseline,
+                      double     b0,
+                      double     b1,
+                      double     a1,
+                      double     coef,
+                      double     thr_trigger) nogil:
+    # Same algorithm as the original python-level version, fused in
+    # a single pass over the waveform that reads the raw samples as
+    # they are. The high-pass filter (lfilter) is applied on the fly
+    # in transposed direct form, so the result is the same.
+    # The computation is always done in double precision, only
+    # the output is stored as `blr_t`.
+    # The raw samples are at `step` elements from each other and
+    # are never written (see `_deconvolve_rows_into`).
+    cdef int    len_signal_daq = signal_r.shape[0]
+    cdef int    nn             = NOISE_WINDOW # fixed at 10 mus
+    cdef double thr_acum       = thr_trigger / coef
+    cdef double baseline       = 0
+    cdef double noise          = 0
+    cdef double x, clean, z, acum, acum_prev, trigger_line
+    cdef int    k
 
-    # compute noise
-    cdef double noise =  0
-    cdef int nn = 400 # fixed at 10 mus
+    for k in range(n_baseline):
+        baseline += signal_daq[k * step]
+    baseline /= n_baseline
 
-    for j in range(nn):
-        noise += signal_daq[j] * signal_daq[j]
+    # noise of the baseline-subtracted, inverted signal
+    for k in range(nn):
+        x      = baseline - signal_daq[k * step]
+        noise += x * x
     noise /= nn
-    cdef double noise_rms = np.sqrt(noise)
-
-    # trigger line
-    cdef double trigger_line = thr_trigger * noise_rms
-
-    # cleaning signal
-    cdef double [:]  b_cf
-    cdef double [:]  a_cf
-
-    b_cf, a_cf = SGN.butter(1, coeff_clean, 'high', analog=False);
-    signal_daq = SGN.lfilter(b_cf, a_cf, signal_daq)
+    trigger_line = thr_trigger * sqrt(noise)
 
-    cdef int k
-    j = 0
-    signal_r[0] = signal_daq[0]
+    x           = baseline - signal_daq[0       ]
+    clean       = x * b0
+    z           = x * b1 - clean * a1
+    signal_r[0] = clean
+    acum        = 0
     for k in range(1, len_signal_daq):
+        x     = baseline - signal_daq[k * step]
+        clean = x * b0 + z
+        z     = x * b1 - clean * a1
 
         # always update signal and accumulator
-        signal_r[k] = (signal_daq[k] + signal_daq[k]*(coef / 2) +
-                       coef * acum[k-1])
+        acum_prev   = acum
+        signal_r[k] = (clean + clean * (coef / 2) +
+                       coef * acum_prev)
 
-        acum[k] = acum[k-1] + signal_daq[k]
+        acum = acum_prev + clean
 
-        if (signal_daq[k] < trigger_line) and (acum[k-1] < thr_acum):
+        if (clean < trigger_line) and (acum_prev < thr_acum):
             # discharge accumulator
-
-            if acum[k-1] > 1:
-                acum[k] = acum[k-1] * (1 - coef)
-                if j < accum_discharge_length - 1:
-                    j = j + 1
-                else:
-                    j = accum_discharge_length - 1
+            if acum_prev > 1:
+                acum = acum_prev * (1 - coef)
             else:
-                acum[k] = 0
-                j = 0
-    # return recovered signal
-    return np.asarray(signal_r)
-
-
-cpdef deconv_pmt(np.ndarray[np.int16_t, ndim=2] pmtrwf,
-                 double [:]                     coeff_c,
-                 double [:]                     coeff_blr,
-                 list                           pmt_active             =    [],
-                 int                            n_baseline             = 28000,
-                 double                         thr_trigger            =     5,
-                 int                            accum_discharge_length =  5000):
+                acum = 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _deconvolve_all(raw_t        *    signals_daq,
+                          Py_ssize_t        row_step,
+                          Py_ssize_t        step,
+                          blr_t        [:, :] signals_r,
+                          const long   [:]    rows,
+                          const long   [:]    channels,
+                          const double [:, :] filter_coeffs,
+                          const double [:]    coeff_blr,
+                          int                 n_baseline,
+                          double              thr_trigger,
+                          int                 n_threads) nogil:
+    cdef Py_ssize_t i
+    cdef long       ch
+    for i in prange(rows.shape[0], num_threads=n_threads, schedule="dynamic"):
+        ch = channels[i]
+        _deconvolve(signals_daq + rows[i] * row_step, step, signals_r[i], n_baseline,
+                    filter_coeffs[ch, 0], filter_coeffs[ch, 1], filter_coeffs[ch, 2],
+                    coeff_blr[ch], thr_trigger)
+
+
+def _check_deconvolution_input(n_rows, n_samples, rows, channels,
+                               filter_coeffs, coeff_blr, n_baseline):
+    # The kernel runs without bounds checking, so everything it reads
+    # must be within the arrays
+    if not 0 < n_baseline <= n_samples:
+        raise ValueError(f"n_baseline must be between 1 and the number of "
+                         f"samples ({n_samples}), got {n_baseline}")
+    if n_samples < NOISE_WINDOW:
+        raise ValueError(f"The waveforms must have at least {NOISE_WINDOW} "
+                         f"samples, got {n_samples}")
+    if rows.min() < 0 or rows.max() >= n_rows:
+        raise ValueError(f"Waveform index out of range [0, {n_rows})")
+    if filter_coeffs.shape[1] != 3:
+        raise ValueError(f"The filter coefficients must have 3 columns, "
+                         f"got {filter_coeffs.shape[1]}")
+    n_channels = min(filter_coeffs.shape[0], coeff_blr.shape[0])
+    if channels.min() < 0 or channels.max() >= n_channels:
+        raise ValueError(f"PMT index out of range [0, {n_channels}) of the "
+                         f"deconvolution coefficients")
+
+
+def _deconvolve_rows(signals_daq, rows, channels,
+                     const double [:, :] filter_coeffs,
+                     const double [:]    coeff_blr,
+                     int                 n_baseline,
+                     double              thr_trigger,
+                     int                 n_threads,
+                     dtype               = np.double,
+                     out                 = None):
+    # Dispatch on the raw waveform type. Other types, and
+    # unaligned arrays, are converted.
+    if signals_daq.dtype not in (np.int16, np.float32, np.float64):
+        signals_daq = signals_daq.astype(np.double)
+    elif not signals_daq.flags.aligned:
+        signals_daq = np.ascontiguousarray(signals_daq)
+
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"Invalid output type for the deconvolved waveforms: {dtype}")
+
+    rows     = np.asarray(rows    , dtype=np.int_)
+    channels = np.asarray(channels, dtype=np.int_)
+    if len(rows) and signals_daq.shape[1]:
+        _check_deconvolution_input(*signals_daq.shape, rows, channels,
+                                   filter_coeffs, coeff_blr, n_baseline)
+
+    shape = len(rows), signals_daq.shape[1]
+    if out is None:
+        signals_r = np.empty(shape, dtype=dtype)
+    elif out.shape != shape or out.dtype != dtype:
+        raise ValueError(f"Output array must have shape {shape} and type {dtype}, "
+                         f"got {out.shape} and {out.dtype}")
+    else:
+        signals_r = out
+    if dtype == np.float32:
+        _deconvolve_rows_into[np.float32_t](signals_daq, signals_r, rows, channels, filter_coeffs,
+                                            coeff_blr, n_baseline, thr_trigger, n_threads)
+    else:
+        _deconvolve_rows_into[np.float64_t](signals_daq, signals_r, rows, channels, filter_coeffs,
+                                            coeff_blr, n_baseline, thr_trigger, n_threads)
+    return signals_r
+
+
+cdef _deconvolve_rows_into(signals_daq,
+                           blr_t        [:, :] signals_r,
+                           rows, channels,
+                           const double [:, :] filter_coeffs,
+                           const double [:]    coeff_blr,
+                           int                 n_baseline,
+                           double              thr_trigger,
+                           int                 n_threads):
+    # The raw waveforms are taken as const memoryviews, so read-only
+    # arrays are accepted. Cython does not support const fused
+    # memoryviews (nor pointers), so the kernel gets a plain pointer
+    # to the first sample, with the const cast away, and the strides
+    # in elements. The kernel never writes through it.
+    cdef const np.int16_t  [:, :] wfs_int16
+    cdef const np.float32_t[:, :] wfs_float32
+    cdef const np.float64_t[:, :] wfs_float64
+    cdef const long        [:]    rows_     = rows
+    cdef const long        [:]    channels_ = channels
+    cdef Py_ssize_t row_step = signals_daq.strides[0] // signals_daq.itemsize
+    cdef Py_ssize_t step     = signals_daq.strides[1] // signals_daq.itemsize
+    if not signals_daq.size or not rows_.shape[0]:
+        return
+
+    if signals_daq.dtype == np.int16:
+        wfs_int16   = signals_daq
+        _deconvolve_all(<np.int16_t   *> &wfs_int16  [0, 0], row_step, step, signals_r,
+                        rows_, channels_, filter_coeffs, coeff_blr,
+                        n_baseline, thr_trigger, n_threads)
+    elif signals_daq.dtype == np.float32:
+        wfs_float32 = signals_daq
+        _deconvolve_all(<np.float32_t *> &wfs_float32[0, 0], row_step, step, signals_r,
+                        rows_, channels_, filter_coeffs, coeff_blr,
+                        n_baseline, thr_trigger, n_threads)
+    else:
+        wfs_float64 = signals_daq
+        _deconvolve_all(<np.float64_t *> &wfs_float64[0, 0], row_step, step, signals_r,
+                        rows_, channels_, filter_coeffs, coeff_blr,
+                        n_baseline, thr_trigger, n_threads)
+
+
+cpdef deconvolve_signal(signal_daq,
+                        int    n_baseline             = 28000,
+                        double coeff_clean            = 2.905447E-06,
+                        double coeff_blr              = 1.632411E-03,
+                        double thr_trigger            =     5,
+                        int    accum_discharge_length =  5000,
+                        dtype                         = np.double):
+
+    """
+    The accumulator approach by Master VHB
+    decorated and cythonized  by JJGC
+    Current version using memory views
+
+    In this version the recovered signal and the accumulator are
+    always being charged. At the same time, the accumulator is being
+    discharged when there is no signal. This avoids runoffs
+    The baseline is computed using a window of 700 mus (by default)
+    which should be good for Na and Kr
+
+    The input waveform (int16, float32 or double) is not modified.
+    The output is computed in double precision and stored with
+    type `dtype` (float32 or double).
+    `accum_discharge_length` has no effect on the output and is
+    kept for backwards compatibility.
+    """
+    signal_daq    = np.asarray(signal_daq)
+    filter_coeffs = filter_coefficients(np.array([coeff_clean], dtype=np.double))
+    signal_r      = _deconvolve_rows(signal_daq[np.newaxis], [0], [0],
+                                     filter_coeffs, np.array([coeff_blr], dtype=np.double),
+                                     n_baseline, thr_trigger, 1, dtype)
+    return signal_r[0]
+
+
+cpdef deconv_pmt(pmtrwf,
+                 const double [:] coeff_c,
+                 const double [:] coeff_blr,
+                 pmt_active             =    [],
+                 int    n_baseline      = 28000,
+                 double thr_trigger     =     5,
+                 int accum_discharge_length = 5000,
+                 filter_coeffs          = None,
+                 int    n_threads       =     1,
+                 dtype                  = np.double,
+                 out                    = None):
     """
     Deconvolve all the PMTs in the event.
-    :param pmtrwf: array of PMTs holding the raw waveform
+    :param pmtrwf: array of PMTs holding the raw waveform, with shape
+                   (n_pmts, n_samples), or a batch of events with shape
+                   (n_events, n_pmts, n_samples). The samples can be
+                   int16, float32 or double and are read without a copy.
     :param coeff_c:     cleaning coefficient
     :param coeff_blr:   deconvolution coefficient
     :param pmt_active:  list of active PMTs (by id number). An empt list
                         implies that all PMTs are active
     :param n_baseline:  number of samples taken to compute baseline
     :param thr_trigger: threshold to start the BLR process
-    
+    :param filter_coeffs: output of `filter_coefficients(coeff_c)`.
+                          Computed if not given.
+    :param n_threads:   number of threads used to deconvolve the PMTs.
+
+    Raises ValueError if the input is not consistent: active PMTs or
+    coefficients missing for them, or waveforms shorter than the
+    baseline or than the window used to compute the noise.
+    :param dtype:       type of the output, float32 or double. The
+                        computation is done in double precision anyway.
+    :param out:         array where the output is written, of type
+                        `dtype` and with the shape of the output.
+
     :returns: an array with deconvoluted PMTs. If PMT is not active
               wvfs are removed.
     """
+    pmtrwf = np.asarray(pmtrwf)
+    if filter_coeffs is None:
+        filter_coeffs = filter_coefficients(coeff_c)
 
-    cdef int NPMT = pmtrwf.shape[0]
-    cdef int NWF  = pmtrwf.shape[1]
-    cdef double [:, :] signal_i = pmtrwf.astype(np.double)
-    cdef double [:]    signal_r = np.zeros(NWF, dtype=np.double)
-    CWF = []
-
-    cdef list PMT = list(range(NPMT))
-    if len(pmt_active) > 0:
-        PMT = pmt_active
-
-    cdef int pmt
-    for pmt in PMT:
-        signal_r = deconvolve_signal(signal_i[pmt],
-                                     n_baseline             = n_baseline,
-                                     coeff_clean            = coeff_c[pmt],
-                                     coeff_blr              = coeff_blr[pmt],
-                                     thr_trigger            = thr_trigger,
-                                     accum_discharge_length = accum_discharge_length)
+    n_pmt      = pmtrwf.shape[-2]
+    n_samples  = pmtrwf.shape[-1]
+    batch      = pmtrwf.shape[:-2]
+    n_events   = int(np.prod(batch))
+    pmt_active = np.asarray(pmt_active if len(pmt_active) else np.arange(n_pmt), dtype=np.int_)
+    if len(pmt_active) and (pmt_active.min() < 0 or pmt_active.max() >= n_pmt):
+        raise ValueError(f"Active PMTs out of range [0, {n_pmt}): {pmt_active}")
 
-        CWF.append(signal_r)
+    channels   = np.tile(pmt_active, n_events)
+    rows       = channels + np.repeat(np.arange(n_events) * n_pmt, len(pmt_active))
+    shape      = batch + (len(pmt_active), n_samples)
+    if out is not None and (out.shape != shape or not out.flags.c_contiguous):
+        raise ValueError(f"Output array must be contiguous with shape {shape}")
 
-    return np.array(CWF)
+    signals_r  = _deconvolve_rows(pmtrwf.reshape(n_events * n_pmt, n_samples),
+                                  rows, channels, filter_coeffs, np.asarray(coeff_blr),
+                                  n_baseline, thr_trigger, n_threads, dtype,
+                                  None if out is None else out.reshape(-1, n_samples))
+    return signals_r.reshape(shape)
@@ -5,9 +5,12 @@ import tables as tb
 
 from pytest import fixture
 from pytest import mark
+from pytest import raises
 from flaky  import flaky
+from scipy  import signal as SGN
 
-from . import blr
+from .                  import blr
+from .. core.testing_utils import peak_allocated_memory
 
 
 deconv_params = namedtuple("deconv_params",
@@ -40,6 +43,43 @@ def sin_wf(sin_wf_params):
     return wf
 
 
+def deconvolve_signal_reference(signal_daq, n_baseline, coeff_clean, coeff_blr,
+                                thr_trigger, accum_discharge_length):
+    # Python transcription of the original implementation, based on
+    # scipy's lfilter
+    coef     = coeff_blr
+    thr_acum = thr_trigger / coef
+    baseline = np.sum(signal_daq[:n_baseline]) / n_baseline
+    signal   = baseline - signal_daq.astype(np.double)
+
+    trigger_line = thr_trigger * np.sqrt(np.sum(signal[:400]**2) / 400)
+    b_cf, a_cf   = SGN.butter(1, coeff_clean, 'high', analog=False)
+    signal       = SGN.lfilter(b_cf, a_cf, signal)
+
+    signal_r    = np.zeros_like(signal)
+    signal_r[0] = signal[0]
+    acum        = 0
+    for k in range(1, len(signal)):
+        acum_prev   = acum
+        signal_r[k] = signal[k] + signal[k] * (coef / 2) + coef * acum_prev
+        acum        = acum_prev + signal[k]
+        if signal[k] < trigger_line and acum_prev < thr_acum:
+            acum = acum_prev * (1 - coef) if acum_prev > 1 else 0
+    return signal_r
+
+
+@fixture
+def pmt_rwfs(sin_wf_params):
+    n_pmts  = 4
+    n       = 2000
+    wfs     = np.random.normal(2500, 2, size=(n_pmts, n))
+    wfs[:, n // 2: n // 2 + 50] -= np.random.uniform(50, 500, size=(n_pmts, 1))
+    params  = sin_wf_params._replace(coeff_clean = np.random.uniform(2e-6, 3e-6, n_pmts),
+                                     coeff_blr   = np.random.uniform(1e-3, 2e-3, n_pmts),
+                                     thr_trigger = 5)
+    return wfs.astype(np.int16), params
+
+
 @fixture(scope="session")
 def ad_hoc_blr_signals(example_blr_wfs_filename):
     with tb.open_file(example_blr_wfs_filename) as file:
@@ -141,3 +181,127 @@ def test_deconv_pmt_ad_hoc_signals_dead_sensors(ad_hoc_blr_signals):
                              params.accum_discharge_length)
 
     np.allclose(blr_wfs, evt_true_blr_wfs[pmt_active])
+
+
+@mark.parametrize("dtype", (np.int16, np.float32, np.double))
+def test_deconv_pmt_same_as_reference(pmt_rwfs, dtype):
+    rwfs, params = pmt_rwfs
+    rwfs         = rwfs.astype(dtype)
+    original     = rwfs.copy()
+    blr_wfs      = blr.deconv_pmt(rwfs,
+                                  params.coeff_clean,
+                                  params.coeff_blr  ,
+                                  [],
+                                  params.n_baseline ,
+                                  params.thr_trigger,
+                                  params.accum_discharge_length)
+
+    for pmt, blr_wf in enumerate(blr_wfs):
+        expected = deconvolve_signal_reference(rwfs[pmt],
+                                               params.n_baseline,
+                                               params.coeff_clean[pmt],
+                                               params.coeff_blr  [pmt],
+                                               params.thr_trigger,
+                                               params.accum_discharge_length)
+        assert np.allclose(blr_wf, expected, rtol=1e-12, atol=1e-9)
+
+    # The input is not modified
+    assert np.all(rwfs == original)
+
+
+@mark.parametrize("n_threads", (1, 4))
+def test_deconv_pmt_batch_same_as_event_by_event(pmt_rwfs, n_threads):
+    rwfs, params  = pmt_rwfs
+    batch         = np.stack([rwfs, rwfs[::-1], rwfs[:, ::-1]])
+    pmt_active    = [0, 2, 3]
+    filter_coeffs = blr.filter_coefficients(params.coeff_clean)
+    deconv        = lambda rwf, **kwargs: blr.deconv_pmt(rwf,
+                                                         params.coeff_clean,
+                                                         params.coeff_blr  ,
+                                                         pmt_active,
+                                                         params.n_baseline ,
+                                                         params.thr_trigger,
+                                                         **kwargs)
+
+    blr_wfs = deconv(batch, filter_coeffs=filter_coeffs, n_threads=n_threads)
+    assert blr_wfs.shape == (len(batch), len(pmt_active), rwfs.shape[1])
+    for evt_rwfs, evt_blr_wfs in zip(batch, blr_wfs):
+        assert np.all(evt_blr_wfs == deconv(evt_rwfs))
+
+
+@mark.parametrize("dtype", (np.int16, np.float32, np.double))
+def test_deconv_pmt_accepts_read_only_input(pmt_rwfs, dtype):
+    rwfs, params = pmt_rwfs
+    rwfs         = rwfs.astype(dtype)
+    expected     = blr.deconv_pmt(rwfs, params.coeff_clean, params.coeff_blr, [],
+                                  params.n_baseline, params.thr_trigger)
+
+    for array in (rwfs, params.coeff_clean, params.coeff_blr):
+        array.flags.writeable = False
+    blr_wfs = blr.deconv_pmt(rwfs, params.coeff_clean, params.coeff_blr, [],
+                             params.n_baseline, params.thr_trigger)
+    assert np.all(blr_wfs == expected)
+
+
+def test_deconv_pmt_single_precision_is_rounded_double_precision(pmt_rwfs):
+    rwfs, params = pmt_rwfs
+    blr_wfs      = [blr.deconv_pmt(rwfs,
+                                   params.coeff_clean,
+                                   params.coeff_blr  ,
+                                   [],
+                                   params.n_baseline ,
+                                   params.thr_trigger,
+                                   dtype = dtype)
+                    for dtype in (np.float32, np.float64)]
+
+    assert blr_wfs[0].dtype == np.float32
+    assert blr_wfs[1].dtype == np.float64
+    assert np.all(blr_wfs[0] == blr_wfs[1].astype(np.float32))
+
+
+@mark.parametrize("dtype", (np.float32, np.float64))
+def test_deconv_pmt_into_out_does_not_allocate_waveforms(pmt_rwfs, dtype):
+    rwfs, params  = pmt_rwfs
+    rwfs          = np.tile(rwfs, 10)
+    filter_coeffs = blr.filter_coefficients(params.coeff_clean)
+    out           = np.empty(rwfs.shape, dtype=dtype)
+    deconv        = lambda: blr.deconv_pmt(rwfs,
+                                           params.coeff_clean,
+                                           params.coeff_blr  ,
+                                           [],
+                                           params.n_baseline ,
+                                           params.thr_trigger,
+                                           filter_coeffs = filter_coeffs,
+                                           dtype         = dtype,
+                                           out           = out)
+
+    assert np.shares_memory(deconv(), out)
+    assert np.all(out == blr.deconv_pmt(rwfs, params.coeff_clean, params.coeff_blr, [],
+                                        params.n_baseline, params.thr_trigger, dtype=dtype))
+    assert peak_allocated_memory(deconv) < out.nbytes / 20
+
+
+@mark.parametrize("kwargs",
+                  (dict(n_baseline = 28000),
+                   dict(n_baseline =     0),
+                   dict(pmt_active = [  5]),
+                   dict(pmt_active = [ -1]),
+                   dict(n_coeffs   =     1),
+                   dict(n_samples  =   100)))
+def test_deconv_pmt_raises_ValueError_on_inconsistent_input(pmt_rwfs, kwargs):
+    rwfs, params = pmt_rwfs
+    n_samples    = kwargs.pop("n_samples", rwfs.shape[1])
+    n_coeffs     = kwargs.pop("n_coeffs" , rwfs.shape[0])
+    kwargs       = dict(dict(pmt_active = [], n_baseline = min(n_samples, params.n_baseline)),
+                        **kwargs)
+
+    with raises(ValueError):
+        blr.deconv_pmt(rwfs[:, :n_samples],
+                       params.coeff_clean[:n_coeffs],
+                       params.coeff_blr  [:n_coeffs],
+                       **kwargs)
+
+
+def test_deconvolve_signal_raises_ValueError_on_short_waveform(sin_wf_params):
+    with raises(ValueError):
+        blr.deconvolve_signal(np.zeros(100), n_baseline=100)
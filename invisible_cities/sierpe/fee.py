@@ -7,8 +7,9 @@ VH, JJGC, November, 2016
 import numpy as np
 from scipy import signal
 
-from .. core     import system_of_units as units
-from .. database import load_db         as DB
+from .. core     import system_of_units  as units
+from .. core     import core_functions_c as core_c
+from .. database import load_db          as DB
 
 # globals describing FEE
 PMT_GAIN = 1.7e6
@@ -393,9 +394,9 @@ def signal_clean(feep, signal_fee, ipmt):
 
 
 def daq_decimator(f_sample1, f_sample2, signal_in):
-    """Downscale the signal vector according to the
-    scale defined by f_sample1 (1 GHZ) and
-    f_sample2 (40 Mhz).
+    """Downscale the signal vector (or the signals, along the
+    last axis) according to the scale defined by f_sample1 (1 GHZ)
+    and f_sample2 (40 Mhz).
     Includes anti-aliasing filter
     """
 
@@ -409,3 +410,91 @@ def daq_decimator(f_sample1, f_sample2, signal_in):
     ## but for an order 35 increase in processing time.
     scale = int(f_sample1 / f_sample2)
     return signal.decimate(signal_in, scale, ftype='fir', zero_phase=True)
+
+
+def daq_decimation_filter(f_sample1, f_sample2):
+    """Anti-aliasing FIR filter used by `daq_decimator`."""
+    scale = int(f_sample1 / f_sample2)
+    return signal.firwin(20 * scale + 1, 1. / scale, window='hamming')
+
+
+def pulse_decimator(pulse, f_sample1, f_sample2, method="auto", n_threads=1):
+    """
+    Returns a function that convolves signals (one per row) with
+    `pulse` and downscales the result as `daq_decimator`, in a
+    single polyphase filter that only computes the samples kept.
+    The result is the same, within floating point precision, as
+    daq_decimator(f_sample1, f_sample2, signal.convolve(signal_in, pulse)).
+
+    method : "direct" skips the zero samples of the input, which
+             makes it very fast for sparse signals such as photon
+             counts. "fft" convolves all the phases of the filter at
+             once with FFTs, which is faster for dense signals and
+             long pulses. "auto" picks the one with the lowest
+             estimated cost for each call.
+    """
+    if method not in ("auto", "direct", "fft"):
+        raise ValueError(f"Invalid decimation method: {method}")
+
+    scale    = int(f_sample1 / f_sample2)
+    fir      = daq_decimation_filter(f_sample1, f_sample2)
+    combined = np.convolve(fir, pulse)
+    offset   = (len(fir) - 1) // 2
+
+    # Polyphase decomposition of the combined filter: output m gets
+    # phases[j, p] * x[scale * (m - delays[j]) + p]
+    delays   = np.arange(-(offset // scale) - 1, (len(combined) + offset) // scale + 2)
+    taps     = scale * delays[:, np.newaxis] + offset - np.arange(scale)
+    in_range = (taps >= 0) & (taps < len(combined))
+    phases   = np.where(in_range, combined[np.clip(taps, 0, len(combined) - 1)], 0)
+    used     = in_range.any(axis=1)
+    phases   = phases[used]
+    delays   = delays[used]
+
+    def decimate_direct(signals, out):
+        return core_c.fir_decimate(signals, combined, scale, offset, out, n_threads)
+
+    def decimate_fft(signals, out):
+        n_rows, n_in = signals.shape
+        n_blocks     = -(-n_in // scale)
+        n_fft        = int(2 ** np.ceil(np.log2(n_blocks + delays[-1] - delays[0] + 1)))
+        blocks       = np.zeros((n_rows, n_blocks * scale))
+        blocks[:, :n_in] = signals
+        blocks       = blocks.reshape(n_rows, n_blocks, scale)
+
+        filters = np.zeros((n_fft, scale))
+        filters[delays - delays[0]] = phases
+        spectra = np.einsum("rfp,fp->rf",
+                            np.fft.rfft(blocks , n=n_fft, axis=1),
+                            np.fft.rfft(filters,          axis=0))
+        decimated = np.fft.irfft(spectra, n=n_fft, axis=1)
+
+        # output m is decimated[m - delays[0]]
+        out[:] = 0
+        start  = max(delays[0], 0)
+        stop   = min(out.shape[1], n_fft + delays[0])
+        out[:, start:stop] = decimated[:, start - delays[0]:stop - delays[0]]
+        return out
+
+    def decimate(signals):
+        signals = np.asarray(signals, dtype=np.double)
+        squeeze = signals.ndim == 1
+        signals = np.atleast_2d(signals)
+        n_out   = -(-(signals.shape[1] + len(pulse) - 1) // scale)
+        out     = np.empty((signals.shape[0], n_out))
+
+        use_fft = method == "fft"
+        if method == "auto":
+            # Operations per non-zero input sample for the direct
+            # method (estimated from one sample out of 256, which is
+            # cheap next to both methods), against the FFTs of the
+            # whole input. Both cost about the same time per operation.
+            n_nonzero   = 256 * np.count_nonzero(signals[:, ::256])
+            cost_direct = n_nonzero * len(combined) / scale
+            cost_fft    = signals.size * np.log2(max(signals.shape[1] // scale, 2))
+            use_fft     = cost_fft < cost_direct
+
+        out = decimate_fft(signals, out) if use_fft else decimate_direct(signals, out)
+        return out[0] if squeeze else out
+
+    return decimate
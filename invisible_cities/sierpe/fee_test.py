@@ -5,9 +5,10 @@ import pytest
 from scipy import signal
 from flaky import flaky
 
-from .. core     import system_of_units as units
-from .. database import load_db
-from .           import fee             as FE
+from .. core               import system_of_units as units
+from .. core.testing_utils import execution_time
+from .. database           import load_db
+from .                     import fee             as FE
 
 def signal_i_th():
     """Generates a "theoretical" current signal (signal_i)"""
@@ -141,3 +142,75 @@ def test_FEE():
     energy_mea2 = np.sum(signal_r2[1000:11000])
     energy_in2  = np.sum(signal_i*FE.i_to_adc())
     assert np.isclose(energy_in2, energy_mea2, rtol=5e-5)
+
+
+@pytest.mark.parametrize("method"   , ("auto", "direct", "fft"))
+@pytest.mark.parametrize("pulse_len", (11, 1001))
+@pytest.mark.parametrize("density"  , (0.01, 1))
+def test_pulse_decimator_same_as_convolve_and_decimate(method, pulse_len, density):
+    rng      = np.random.RandomState(pulse_len)
+    signals  = rng.poisson(density, size=(3, 10001)).astype(float)
+    pulse    = np.exp(-np.arange(pulse_len) / pulse_len * 4)
+    expected = [FE.daq_decimator(FE.f_mc, FE.f_sample, signal.convolve(s, pulse))
+                for s in signals]
+
+    decimate = FE.pulse_decimator(pulse, FE.f_mc, FE.f_sample, method)
+    got      = decimate(signals)
+    assert got.shape == (3, len(expected[0]))
+    np.testing.assert_allclose(got, expected, rtol=1e-9, atol=1e-9 * np.max(np.abs(expected)))
+    np.testing.assert_allclose(decimate(signals[0]), got[0])
+
+
+def test_pulse_decimator_raises_ValueError_with_invalid_method():
+    with pytest.raises(ValueError):
+        FE.pulse_decimator(np.ones(3), FE.f_mc, FE.f_sample, "polyphase")
+
+
+def convolve_and_decimate(signals, pulse):
+    # Previous implementation, one PMT at a time
+    return [FE.daq_decimator(FE.f_mc, FE.f_sample, signal.convolve(s, pulse))
+            for s in signals]
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("pulse_len density faster".split(),
+                         ((  11, 0.005, True ),
+                          (2001, 0.005, True ),
+                          (2001, 1    , True ),
+                          # Both methods cost about the same as the
+                          # previous implementation here
+                          (  11, 1    , False)))
+def test_pulse_decimator_auto_picks_fastest_method(pulse_len, density, faster):
+    # Both sides of the crossover between the direct and fft methods
+    rng     = np.random.default_rng(pulse_len)
+    signals = rng.poisson(density, size=(12, 200000)).astype(float)
+    pulse   = np.exp(-np.arange(pulse_len) / pulse_len * 4)
+
+    reference = execution_time(convolve_and_decimate, signals, pulse)
+    times     = {method: execution_time(FE.pulse_decimator(pulse, FE.f_mc, FE.f_sample, method),
+                                        signals)
+                 for method in ("auto", "direct", "fft")}
+    print(f"pulse of {pulse_len} samples, {density} pe/ns: " +
+          ", ".join(f"{method} {t * 1e3:.1f} ms" for method, t in times.items()) +
+          f", convolve and decimate {reference * 1e3:.1f} ms")
+    assert times["auto"] < reference or not faster
+    # "auto" picks the fastest method, or one that is close to it
+    assert times["auto"] < 1.5 * min(times["direct"], times["fft"])
+
+
+@pytest.mark.benchmark
+def test_pulse_decimator_faster_than_convolve_and_decimate_next100():
+    # NEXT-100: 60 PMTs and 1.3 ms buffers at 1 ns, with a small
+    # background and a 50 us long S2. The FEE filter is applied after
+    # the decimation in both cases and is not included.
+    rng     = np.random.default_rng(100)
+    signals = rng.poisson(0.005, size=(60, 1300000)).astype(float)
+    signals[:, 650000:700000] += rng.poisson(2, size=(60, 50000))
+    spe     = FE.SPE()
+
+    reference = execution_time(convolve_and_decimate, signals, spe.spe, repeat=1)
+    decimate  = FE.pulse_decimator(spe.spe, FE.f_mc, FE.f_sample)
+    fused     = execution_time(decimate, signals, repeat=1)
+    print(f"60 PMTs x 1.3 ms: pulse_decimator {fused * 1e3:.0f} ms, "
+          f"convolve and decimate {reference * 1e3:.0f} ms")
+    assert fused < reference
@@ -51,48 +51,59 @@ def buffer_and_limits(buffer_length, buffer_bin_width, FE_data):
     return freq_contribution, frequency_low, frequency_high
 
 
-def low_frequency_noise(detector_db, run_number, buffer_length, buffer_bin_width=25e-9):
+def low_frequency_noise_sampler(detector_db, run_number, buffer_bin_width=25e-9):
     """
-    Randomises frequencies, magnitudes and phases and
-    returns a function that can be used to get the
-    simulated low frequency noise for a particular PMT
+    Reads the low frequency noise tables of the run once and returns
+    a function that randomises frequencies, magnitudes and phases and
+    returns the simulated low frequency noise of all PMTs (one row
+    per PMT) for a buffer of a given length.
+    The random numbers are drawn from the generator passed to the
+    returned function (numpy's global random state if None), in the
+    same order as in `low_frequency_noise`.
     """
 
     FE_mapping, FE_data = DB.PMTLowFrequencyNoise(detector_db, run_number)
 
     ## Need to protect for old runs where PMT indx != sensorID
-    sens_id       = DB.DataPMT(detector_db, run_number).SensorID.values
+    sens_id   = DB.DataPMT(detector_db, run_number).SensorID.values
+    pmt_febox = np.array([FE_mapping.FEBox[FE_mapping.SensorID == sid].values[0]
+                          for sid in sens_id])
 
-    n_febox       = FE_data.shape[1] - 1
-    n_frequencies = FE_data.shape[0]
+    _, freq_low, freq_high = buffer_and_limits(0, buffer_bin_width, FE_data[:, 0])
+    magnitude_means        = FE_data[:, 1:]
 
-    freq_contrib, freq_low, freq_high = buffer_and_limits(buffer_length,
-                                                          buffer_bin_width,
-                                                          FE_data[:, 0])
+    def sample_low_frequency_noise(buffer_length, rng=None):
+        rng   = np.random if rng is None else rng
+        times = buffer_bin_width * np.arange(buffer_length)
 
-    ## Randomise frequencies
-    rot_frequencies = 2 * np.pi * np.random.uniform(freq_low, freq_high)
-    rot_frequencies = np.tile(rot_frequencies, n_febox)
+        ## Randomise frequencies, the same for all feboxes
+        rot_frequencies = 2 * np.pi * rng.uniform(freq_low, freq_high)
 
-    ## Randomise magnitudes and phases. mag_rms ~ 0.5 * mag_mean
-    magnitudes = np.array(tuple(map(np.random.normal    ,
-                                    FE_data[:, 1:]      ,
-                                    FE_data[:, 1:] * 0.5)))
-    ## Reshape to ease mapping
-    magnitudes = magnitudes.T.reshape(magnitudes.size,)
+        ## Randomise magnitudes and phases. mag_rms ~ 0.5 * mag_mean
+        magnitudes = rng.normal(magnitude_means, magnitude_means * 0.5).T
+        phases     = rng.uniform(-np.pi, np.pi, magnitudes.size).reshape(magnitudes.shape)
 
-    phases     = np.random.uniform(-np.pi, np.pi, magnitudes.shape)
+        ## 2 m cos(w t + p) = 2 m cos(p) cos(w t) - 2 m sin(p) sin(w t),
+        ## so only one cosine and one sine per frequency are needed
+        wt    = np.outer(rot_frequencies, times)
+        noise = ((2 * magnitudes * np.cos(phases)) @ np.cos(wt) -
+                 (2 * magnitudes * np.sin(phases)) @ np.sin(wt))
+        return noise[pmt_febox]
 
-    noise = np.array(tuple(map(freq_contrib   ,
-                               rot_frequencies,
-                               magnitudes     ,
-                               phases         )))
-    noise = noise.reshape(n_febox, n_frequencies, buffer_length).sum(axis=1)
+    return sample_low_frequency_noise
+
+
+def low_frequency_noise(detector_db, run_number, buffer_length, buffer_bin_width=25e-9):
+    """
+    Randomises frequencies, magnitudes and phases and
+    returns a function that can be used to get the
+    simulated low frequency noise for a particular PMT
+    """
+    sampler = low_frequency_noise_sampler(detector_db, run_number, buffer_bin_width)
+    noise   = sampler(buffer_length)
 
     def get_low_frequency_noise(indx_pmt):
         """ Returns the appropriate vector """
-
-        febox = FE_mapping.FEBox[FE_mapping.SensorID==sens_id[indx_pmt]].values
-        return noise[febox[0]]
+        return noise[indx_pmt]
 
     return get_low_frequency_noise
@@ -2,6 +2,7 @@ import numpy as np
 
 from numpy.testing import assert_allclose
 
+from ..  database    import load_db             as DB
 from .             import low_frequency_noise as lfn
 
 
@@ -53,3 +54,28 @@ def test_low_frequency_noise(dbnew):
     assert np.any(np.diff(pmt_noise, axis = 0))
     ## then that not all are
     assert not np.all(np.diff(pmt_noise, axis = 0))
+
+
+def test_low_frequency_noise_sampler_same_as_sum_of_frequencies(dbnew):
+    run_no     = 6000
+    buffer_len = 4000
+    sampler    = lfn.low_frequency_noise_sampler(dbnew, run_no)
+
+    np.random.seed(123)
+    pmt_noise = sampler(buffer_len)
+
+    ## Same random numbers, one cosine per frequency and febox
+    FE_mapping, FE_data = DB.PMTLowFrequencyNoise(dbnew, run_no)
+    sens_id             = DB.DataPMT(dbnew, run_no).SensorID.values
+    freq_contrib, low, high = lfn.buffer_and_limits(buffer_len, 25e-9, FE_data[:, 0])
+
+    np.random.seed(123)
+    rot_frequencies = 2 * np.pi * np.random.uniform(low, high)
+    magnitudes      = np.random.normal(FE_data[:, 1:], FE_data[:, 1:] * 0.5).T
+    phases          = np.random.uniform(-np.pi, np.pi, magnitudes.shape)
+    febox_noise     = [sum(map(freq_contrib, rot_frequencies, mags, phs))
+                       for mags, phs in zip(magnitudes, phases)]
+
+    for pmt, sid in enumerate(sens_id):
+        febox = FE_mapping.FEBox[FE_mapping.SensorID == sid].values[0]
+        assert_allclose(pmt_noise[pmt], febox_noise[febox], atol=1e-9)
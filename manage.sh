@@ -214,6 +214,14 @@ function download_test_db {
     python $ICDIR/database/download.py $ARGUMENT
 }
 
+function regenerate_exact_results {
+    echo Regenerating the reference files of the exact-result tests
+    for CITY in diomira hypathia
+    do
+        city $CITY $ICDIR/database/test_data/config/${CITY}_exact_result.conf || return 1
+    done
+}
+
 function compile_cython_components {
     python setup.py develop
 }
@@ -263,6 +271,7 @@ case $COMMAND in
     compile_and_test)                compile_and_test ;;
     compile_and_test_par)            compile_and_test_par ;;
     download_test_db)                download_test_db ;;
+    regenerate_exact_results)        regenerate_exact_results ;;
     clean)                           clean ;;
     show_ic_env)                     show_ic_env ;;
 
@@ -281,6 +290,7 @@ case $COMMAND in
        echo "bash   $THIS compile_and_test"
        echo "bash   $THIS compile_and_test_par"
        echo "bash   $THIS download_test_db"
+       echo "bash   $THIS regenerate_exact_results"
        echo "bash   $THIS clean"
        echo "bash   $THIS show_ic_env"
        ;;